@@ -15,17 +15,33 @@ class Config:
     config_file: str = None
     check_only: bool = False
     full_sync_at_startup: bool = False
+    full_sync_bulk_fetch: bool = False
+    full_sync_workers: int = 1
+    full_sync_reconcile: bool = False
+    full_sync_commit: str = 'each'
+    incremental_sync_at_startup: bool = False
+    full_sync_interval: float = 0
+    full_sync_budget: float = None
+    incremental_sync_interval: float = 0
+    incremental_sync_budget: float = None
+    sync_jitter: float = 0
     listen: bool = False
     bind: str = '127.0.0.1'
     port: int = 8001
+    server: str = 'threading'
     secret: str = None
     secret_header: str = 'X-netbox2kea-secret'
+    event_debounce: float = 1.0
     log_level: str = 'warning'
     ext_log_level: str = 'warning'
     syslog_level_prefix: bool = False
     kea_url: str = None
+    kea_fine_grained: bool = False
+    state_file: str = None
     netbox_url: str = None
     netbox_token: str = None
+    netbox_backend: str = 'pynetbox'
+    netbox_concurrency: int = 8
     prefix_filter: dict = field(default_factory=lambda: {
         'cf_dhcp_enabled': True})
     ipaddress_filter: dict = field(default_factory=lambda: {'status': 'dhcp'})
@@ -69,6 +85,10 @@ def get_config():
     parser.add_argument(
         '-s', '--sync-now', action='store_true', dest='full_sync_at_startup',
         default=None, help='')
+    parser.add_argument(
+        '-i', '--sync-changes', action='store_true',
+        dest='incremental_sync_at_startup', default=None,
+        help='Sync objects changed since last sync (full sync if none)')
     parser.add_argument(
         '--check', action='store_true', dest='check_only', default=None,
         help='')
@@ -1,57 +1,191 @@
 import logging
+import threading
 
-from ipaddress import ip_interface
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter, itemgetter
+from time import monotonic
 
-from .kea.exceptions import (KeaError, KeaClientError, SubnetNotEqual,
-                             SubnetNotFound)
+from .ip import host
+from .ipindex import PrefixIndex
+from .kea.app import HASH, USR_CTX
+from .kea.exceptions import (ChangesRejected, KeaError, KeaClientError,
+                             SubnetNotEqual, SubnetNotFound)
+from .state import ObjectState
 
 
-def _get_nested(obj, attrs, sep='.'):
-    """ Get value from a nested list of attributes or keys separated by sep """
+# Netbox models whose events are synced (by sync_<model> methods)
+EVENT_MODELS = frozenset({'prefix', 'iprange', 'ipaddress', 'interface',
+                          'device', 'vminterface', 'virtualmachine'})
 
-    value = obj
-    for a in attrs.split(sep):
-        # getattr must be tried before dict.get because it is able to trigger
-        # additionnal queries to netbox API.
+
+class SyncTimeout(Exception):
+    """ Sync aborted as it lasted longer than its budget """
+
+
+# Attributes of objects nested into netbox IP addresses. Reading other
+# attributes requires to fetch the full object.
+_NESTED_ATTRS = {
+    'assigned_object': {'id', 'url', 'display', 'name', 'device',
+                        'virtual_machine', 'cable', '_occupied'},
+    'assigned_object.device': {'id', 'url', 'display', 'name'},
+    'assigned_object.virtual_machine': {'id', 'url', 'display', 'name'}}
+
+
+def _mk_getter(attrs, sep='.'):
+    """
+    Return a function that gets value from a nested list of attributes or keys
+    separated by sep. The accessor of each level (key for
+    dictionaries, attribute otherwise) is learnt on first call then reused, as
+    netbox objects of a same type share the same structure.
+    """
+
+    keys = attrs.split(sep)
+    chain = ()
+
+    def getter(obj):
+        nonlocal chain
+        if chain:
+            try:
+                value = obj
+                for accessor in chain:
+                    value = accessor(value)
+                return value
+            except (AttributeError, TypeError):
+                # Object structure differs from the learnt one
+                pass
+
+        # Accessors are kept even if the last key is missing, in order to not
+        # learn them again.
+        value, accessors, learnable = obj, [], True
         try:
-            value = getattr(value, a)
-        except AttributeError:
-            value = value[a]
+            for k in keys:
+                if isinstance(value, dict):
+                    accessors.append(itemgetter(k))
+                    value = value[k]
+                else:
+                    accessors.append(attrgetter(k))
+                    try:
+                        value = getattr(value, k)
+                    except AttributeError:
+                        learnable = False
+                        value = value[k]
+        finally:
+            if learnable and len(accessors) == len(keys):
+                chain = tuple(accessors)
+        return value
 
-    return value
+    return getter
 
 
-def _set_dhcp_attr(dhcp_item, key, value):
+def _mk_setter(key):
     """
-    Set value to DHCP item dictionary. Key may be nested keys separated
-    by dots, in which case each key represents a nested dictionary (or list, if
-    the parent attribut is known to use a list).
+    Return a function that sets value to DHCP item dictionary. Key may be
+    nested keys separated by dots, in which case each key represents a nested
+    dictionary (or list, if the parent attribut is known to use a list).
     """
 
     k1, _, k2 = key.partition('.')
     if not k2:
-        dhcp_item[key] = value
+        def setter(dhcp_item, value):
+            dhcp_item[key] = value
     elif k1 in ['option-data']:
         # Some keys hold a list of name/data dicts
-        dhcp_item.setdefault(k1, []).append(
-            {'name': k2, 'data': value})
+        def setter(dhcp_item, value):
+            dhcp_item.setdefault(k1, []).append({'name': k2, 'data': value})
     else:
-        dhcp_item.setdefault(k1, {})[k2] = value
+        def setter(dhcp_item, value):
+            dhcp_item.setdefault(k1, {})[k2] = value
+
+    return setter
+
+
+def _compile_map(mapping):
+    """
+    Compile a map between DHCP settings and netbox attributes into a list of
+    (getters, setter) tuples, getters being in order of preference.
+    """
+
+    return [(tuple(_mk_getter(a) for a in (
+                [nb_attr] if isinstance(nb_attr, str) else nb_attr)),
+             _mk_setter(dhcp_attr))
+            for dhcp_attr, nb_attr in mapping.items()]
+
+
+def _related_objects(mapping):
+    """
+    Return the set of nested objects (keys of _NESTED_ATTRS) whose full
+    version is required by the mapping
+    """
+
+    related = set()
+    for nb_attr in mapping.values():
+        for a in [nb_attr] if isinstance(nb_attr, str) else nb_attr:
+            attrs = a.split('.')
+            for nested, nested_attrs in _NESTED_ATTRS.items():
+                n = nested.count('.') + 1
+                if (len(attrs) > n and '.'.join(attrs[:n]) == nested
+                        and attrs[n] not in nested_attrs):
+                    related.add(nested)
 
+    return related
 
-def _mk_dhcp_item(nb_obj, mapping):
+
+def netbox_fields(prefix_subnet_map, pool_iprange_map,
+                  reservation_ipaddr_map):
+    """
+    Return the fields of netbox objects read by the connector with the given
+    maps, by endpoint, so that netbox only serves those
+    """
+
+    fields = {
+        'ipam.prefixes': {'id', 'display', 'last_updated', 'prefix'},
+        'ipam.ip_ranges': {'id', 'display', 'last_updated', 'start_address',
+                           'end_address'},
+        'ipam.ip_addresses': {'id', 'display', 'last_updated', 'address',
+                              'assigned_object', 'assigned_object_id',
+                              'assigned_object_type'},
+        'dcim.interfaces': {'id', 'display', 'name', 'device'},
+        'virtualization.interfaces': {'id', 'display', 'name',
+                                      'virtual_machine'},
+        'dcim.devices': {'id', 'display', 'name'},
+        'virtualization.virtual_machines': {'id', 'display', 'name'}}
+    for endpoint, mapping in (('ipam.prefixes', prefix_subnet_map),
+                              ('ipam.ip_ranges', pool_iprange_map),
+                              ('ipam.ip_addresses', reservation_ipaddr_map)):
+        for nb_attr in mapping.values():
+            for a in [nb_attr] if isinstance(nb_attr, str) else nb_attr:
+                attrs = a.split('.')
+                fields[endpoint].add(attrs[0])
+                # Full assigned objects may be fetched (see _NESTED_ATTRS)
+                if attrs[0] != 'assigned_object' or len(attrs) < 2:
+                    continue
+                fields['dcim.interfaces'].add(attrs[1])
+                fields['virtualization.interfaces'].add(attrs[1])
+                if len(attrs) > 2 and attrs[1] == 'device':
+                    fields['dcim.devices'].add(attrs[2])
+                elif len(attrs) > 2 and attrs[1] == 'virtual_machine':
+                    fields['virtualization.virtual_machines'].add(attrs[2])
+    return fields
+
+
+def _item_hash(item):
+    """ Return the hash set by DHCP4App to an item it was given """
+
+    return item.get(USR_CTX, {}).get(HASH)
+
+
+def _mk_dhcp_item(nb_obj, plan):
     """ Convert a netbox object to a DHCP dictionary item """
 
     dhcp_item = {}
-    for dhcp_attr, nb_attr in mapping.items():
-        # Get value from netbox object
-        attrs = [nb_attr] if isinstance(nb_attr, str) else nb_attr
-        # Map value is expected to be list of attributes. The first
-        # existing and non-null attribute will be used as the DHCP value
+    for getters, setter in plan:
+        # The first existing and non-null attribute will be used as the DHCP
+        # value
         value = None
-        for a in attrs:
+        for get in getters:
             try:
-                value = _get_nested(nb_obj, a)
+                value = get(nb_obj)
             except (TypeError, KeyError):
                 continue
             if value:
@@ -60,7 +194,7 @@ def _mk_dhcp_item(nb_obj, mapping):
         # Set value to DHCP setting
         # Kea don’t like None value (TODO even if JSON converts it to "null"?)
         if value is not None:
-            _set_dhcp_attr(dhcp_item, dhcp_attr, value)
+            setter(dhcp_item, value)
 
     return dhcp_item
 
@@ -69,153 +203,623 @@ class Connector:
     """ Main class that connects Netbox objects to Kea DHCP config items """
 
     def __init__(self, nb, kea, prefix_subnet_map, pool_iprange_map,
-                 reservation_ipaddr_map, check=False):
+                 reservation_ipaddr_map, check=False, bulk_fetch=False,
+                 workers=1, reconcile=False, commit_strategy='each',
+                 state=None, incremental=False):
         self.nb = nb
         self.kea = kea
         self.subnet_prefix_map = prefix_subnet_map
         self.pool_iprange_map = pool_iprange_map
         self.reservation_ipaddr_map = reservation_ipaddr_map
+        # Maps compiled once for all
+        self._subnet_plan = _compile_map(prefix_subnet_map)
+        self._pool_plan = _compile_map(pool_iprange_map)
+        self._resa_plan = _compile_map(reservation_ipaddr_map)
         self.check = check
+        self.bulk_fetch = bulk_fetch
+        # Number of threads fetching and building prefixes during a full sync
+        self.workers = workers
+        # Full sync only applies the differences with current DHCP config
+        self.reconcile = reconcile
+        # During a full sync, the DHCP server checks the config after each
+        # prefix ("each"), or once before push ("final"), intermediate
+        # commits relying on local checks only
+        if commit_strategy not in ('each', 'final'):
+            raise ValueError(f'unknown commit strategy "{commit_strategy}"')
+        self.commit_strategy = commit_strategy
+        # Objects related to IP addresses to fetch by batch, and their cache
+        # during a full sync
+        self._ipaddr_relations = _related_objects(reservation_ipaddr_map)
+        self._nb_cache = None
+        # Serialize DHCP config updates (full sync, event batches)
+        self._lock = threading.Lock()
+        # Local index of netbox prefixes to find parents of IP addresses and
+        # ranges, loaded on first use and kept up to date by prefix events
+        self._prefixes = None
+        # Persistent state of objects pushed to DHCP server (StateStore), and
+        # (netbox last update time, DHCP item) of objects read since last
+        # push, by (model, ID)
+        self.state = state
+        self._seen = {}
+        # Time from which the next incremental sync looks for changes (also
+        # kept in the state store, if any), recorded by full syncs if
+        # incremental syncs are run or there is a state store
+        self.incremental = incremental
+        self._watermark = None
+        # Time (monotonic clock) at which the running sync must be aborted
+        self._deadline = None
+
+    def sync_all(self, blocking=True, budget=None):
+        """
+        Replace current DHCP configuration by a new generated one. In
+        reconcile mode, only the differences are applied, and nothing is pushed
+        if there is none.
+
+        If not blocking, return False at once when another sync or an event
+        batch is in progress. With a budget (in seconds), the sync is aborted
+        with SyncTimeout when it lasts longer, and nothing is pushed.
+        """
+
+        return self._run_sync(self._sync_all, blocking, budget)
+
+    def _run_sync(self, sync, blocking, budget):
+        """ Run sync function with the lock, within budget """
+
+        if not self._lock.acquire(blocking):
+            return False
+        try:
+            if budget is not None:
+                self._deadline = monotonic() + budget
+            sync()
+        except SyncTimeout:
+            # Pending changes are dropped by the next pull, which can’t be
+            # skipped as DHCP config has not been pushed
+            self._seen.clear()
+            raise
+        finally:
+            self._deadline = None
+            self._lock.release()
+        return True
+
+    def _check_deadline(self):
+        if self._deadline is not None and monotonic() > self._deadline:
+            raise SyncTimeout('sync budget exceeded')
+
+    def _sync_all(self, incremental=False):
+        # Changes made from now on will be looked for by the next incremental
+        # sync, even those made while this sync is running
+        watermark = None
+        if not self.check and (
+                incremental or self.incremental or self.state is not None):
+            watermark = self._last_change_time()
+        self.kea.pull()
+        self._nb_cache = {}
+        try:
+            prefixes = list(self._all_prefixes())
+            self._prefixes = PrefixIndex(p for p, _, _ in prefixes)
+            self._del_subnets(prefixes, self.commit_strategy == 'each')
+            all_failed = self._sync_prefixes(prefixes)
+        finally:
+            self._nb_cache = None
+            self.kea.auto_commit = True
+
+        if all_failed is not True and self.push_to_dhcp() is not False:
+            self._set_watermark(watermark)
+
+    def sync_changes(self, blocking=True, budget=None):
+        """
+        Sync the prefixes, IP ranges and IP addresses created, updated or
+        deleted in netbox since the last sync, according to their last update
+        time and netbox change log. Do a full sync if there was none. See
+        sync_all() about blocking and budget.
+        """
+
+        return self._run_sync(self._sync_changes, blocking, budget)
+
+    def _sync_changes(self):
+        since = self._get_watermark()
+        if since is None:
+            logging.info('no previous sync: full sync')
+            self._sync_all(incremental=True)
+            return
 
-    def sync_all(self):
-        """ Replace current DHCP configuration by a new generated one """
+        watermark = self._last_change_time()
+        # Objects at the watermark time are looked at again, as others may
+        # have been updated at the same time. Changed objects are kept to
+        # be synced without fetching them again (None if deleted or out of
+        # the filters).
+        objs = {}
+        for model in ('prefix', 'iprange', 'ipaddress'):
+            for id_, obj in self.nb.updated_since(model, since):
+                objs[model, id_] = obj
+            self._check_deadline()
+        for model, id_, _ in self.nb.deleted_since(since):
+            objs[model, id_] = None
+        logging.info(f'{len(objs)} object(s) changed since {since}')
+        # Changes will be looked for again if they could not be pushed
+        if not objs or self._sync_event_batch(list(objs), objs) is not False:
+            self._set_watermark(watermark)
+
+    def _last_change_time(self):
+        """ Return time of netbox latest change, None if it can’t be read """
 
-        self.kea.pull()
-        self.kea.del_all_subnets()
-
-        # Create DHCP configuration for each prefix
-        all_failed = None
-        for p in self.nb.all_prefixes():
-            if all_failed is None:
-                all_failed = True
-            pl = f'prefix {p}: '
+        try:
+            return self.nb.last_change_time()
+        except Exception as e:
+            logging.warning(f'unable to read netbox change log: {e}')
+            return None
+
+    def _get_watermark(self):
+        if self._watermark is None and self.state is not None:
+            self._watermark = self.state.get_meta('watermark')
+        return self._watermark
+
+    def _set_watermark(self, time):
+        if time is None or self.check:
+            return
+        self._watermark = time
+        if self.state is not None:
+            self.state.set_meta('watermark', time)
+
+    def _del_subnets(self, prefixes, check):
+        """ Delete subnets before a full sync of prefixes """
+
+        self.kea.auto_commit = False
+        if self.reconcile:
+            # Delete subnets of missing prefixes first: a new prefix may
+            # have the same network address.
+            self.kea.del_subnets_except(p.id for p, _, _ in prefixes)
+        else:
+            self.kea.del_all_subnets()
+        self.kea.commit(check=check)
+
+    def _sync_prefixes(self, prefixes):
+        """
+        Create DHCP configuration for each (prefix, IP addresses, IP ranges)
+        tuple. Return None if there is no prefix, True if all prefixes failed.
+        """
+
+        built, passed = False, set()
+        # With the final strategy, changes of all prefixes are checked at once
+        server_check = self.commit_strategy == 'each'
+        for items in self._built_prefixes(prefixes):
+            self._check_deadline()
+            built = True
+            pref = items[0]
+            pl = f'prefix {pref}: '
             logging.debug(f'{pl}generate DHCP config')
             # Speed up things by disabling auto-commit
             self.kea.auto_commit = False
             try:
-                self._prefix_to_subnet(p, fullsync=True)
+                self._apply_prefix(*items)
             except KeaError as e:
                 logging.error(f'{pl}config failed. Error: {e}')
                 continue
 
             # Make intermediate commits only when not in check mode to avoid
             # false errors of missing, not yet created, subnets.
-            if not self.check:
+            if not self.check and server_check:
                 try:
-                    self.kea.commit()
+                    self.kea.commit(isolate=True)
+                except ChangesRejected as e:
+                    self._rejected(e)
+                    if ('prefix', pref.id) in e.rejected:
+                        continue
                 except KeaError as e:
                     logging.error(f'{pl}commit failed. Error: {e}')
-                    # Retry with auto-commit enabled to catch the faulty item
-                    logging.warning(f'{pl}retry with auto commit on')
-                    self.kea.auto_commit = True
-                    try:
-                        self._prefix_to_subnet(p, fullsync=True)
-                    except KeaError as e:
-                        logging.error(f'{pl}config failed. Error: {e}')
-                        continue
+                    continue
+            passed.add(pref.id)
 
-            all_failed = False
+        if passed and not self.check and not server_check:
+            try:
+                logging.debug('check the whole config')
+                self.kea.commit(isolate=True)
+            except ChangesRejected as e:
+                self._rejected(e)
+                passed.difference_update(
+                    id_ for model, id_ in e.rejected if model == 'prefix')
+            except KeaError as e:
+                logging.error(f'config check failed. Error: {e}')
+                passed.clear()
+        return not passed if built else None
+
+    def _built_prefixes(self, prefixes):
+        """
+        Yield DHCP items of prefixes (see _build_prefix). With more than
+        one worker, prefixes are fetched and built concurrently but still
+        yielded in netbox order, so that the resulting config is the same.
+        """
+
+        if self.workers <= 1:
+            for p, ipaddrs, ipranges in prefixes:
+                yield self._build_prefix(p, ipaddrs, ipranges)
+            return
 
-        self.kea.auto_commit = True
-        if all_failed is not True:
-            self.push_to_dhcp()
+        executor = ThreadPoolExecutor(
+            self.workers, thread_name_prefix='netboxkea-sync')
+        pending = deque()
+        try:
+            for p, ipaddrs, ipranges in prefixes:
+                pending.append(executor.submit(
+                    self._build_prefix, p, ipaddrs, ipranges))
+                # Bound the number of built prefixes waiting to be applied
+                if len(pending) > 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def _all_prefixes(self):
+        """
+        Yield prefixes with their IP addresses and IP ranges if bulk fetch is
+        enabled, or with None values to let them be queried by prefix.
+        """
+
+        if self.bulk_fetch:
+            prefixes = list(self.nb.all_prefixes_with_children())
+            # Fetch related objects of all IP addresses at once
+            self._prefetch_ipaddrs(i for _, ipaddrs, _ in prefixes
+                                   for i in ipaddrs)
+            yield from prefixes
+        else:
+            for p in self.nb.all_prefixes():
+                yield p, None, None
+
+    def _prefetch_ipaddrs(self, ipaddrs):
+        """ Fetch by batch the objects related to IP addresses, if any """
+
+        if self._ipaddr_relations:
+            ipaddrs = self.nb.prefetch_assigned_objects(
+                ipaddrs, self._ipaddr_relations,
+                {} if self._nb_cache is None else self._nb_cache)
+        return ipaddrs
+
+    def sync_events(self, events):
+        """
+        Apply a batch of (model, ID) netbox events with one pull, one commit
+        and one push. If the commit fails, the rejected changes are isolated
+        and the other ones are kept.
+        """
+
+        with self._lock:
+            self._sync_event_batch(events)
+
+    def _sync_event_batch(self, events, objs=None):
+        """
+        Sync events (see sync_events). Objs holds netbox objects already
+        fetched (None if deleted), by (model, ID), and gets those fetched to
+        check if they are unchanged.
+        """
+
+        objs = {} if objs is None else objs
+        if self.state is not None:
+            events = [e for e in events if not self._unchanged(*e, objs)]
+            if not events:
+                logging.info('events: objects unchanged since last push')
+                return None
+        self.reload_dhcp_config()
+        self.kea.auto_commit = False
+        try:
+            self._sync_events(events, objs)
+            try:
+                self.kea.commit(isolate=True)
+            except ChangesRejected as e:
+                self._rejected(e)
+            except KeaError as e:
+                logging.error(f'events commit failed. Error: {e}')
+        finally:
+            self.kea.auto_commit = True
+        return self.push_to_dhcp()
+
+    def _sync_events(self, events, objs):
+        for model, id_ in events:
+            self._check_deadline()
+            if model not in EVENT_MODELS:
+                # Other sync_ methods (sync_all…) take the lock
+                logging.error(f'{model} id={id_}: unsupported event model')
+                continue
+            logging.info(f'process event: {model} id={id_}')
+            try:
+                if (model, id_) in objs:
+                    getattr(self, f'_sync_{model}')(id_, objs[model, id_])
+                else:
+                    getattr(self, f'sync_{model}')(id_)
+            except KeaError as e:
+                logging.error(f'{model} id={id_}: sync failed. Error: {e}')
+
+    def _unchanged(self, model, id_, objs):
+        """
+        Tell if a prefix, IP range or IP address is the same as when it was
+        last pushed, according to its netbox last update time. The object is
+        taken from objs, or fetched and added to it.
+        """
+
+        get = {'prefix': self.nb.prefix, 'iprange': self.nb.ip_range,
+               'ipaddress': self.nb.ip_address}.get(model)
+        if get is None:
+            return False
+        if (model, id_) not in objs:
+            objs[model, id_] = get(id_)
+        stored = self.state.get(model, id_)
+        obj = objs[model, id_]
+        if obj is None:
+            return stored is None
+        return (stored is not None and stored.last_updated is not None
+                and stored.last_updated == getattr(obj, 'last_updated', None))
+
+    def _rejected(self, error):
+        """ Log netbox objects whose changes were rejected by DHCP server """
+
+        for model, id_ in error.rejected:
+            logging.error(f'{model} id={id_}: rejected by DHCP server')
+            # Their next events must not be taken as unchanged
+            self._seen[model, id_] = None
+
+    def _saw(self, model, obj, item):
+        if self.state is not None:
+            self._seen[model, obj.id] = (
+                getattr(obj, 'last_updated', None), item)
 
     def push_to_dhcp(self):
+        """
+        Push DHCP config to server. Return True if pushed, False if rejected
+        by the server, None if there was nothing to push (or in check mode).
+        """
+
+        pushed = None
         if self.check:
             logging.info('check mode on: config will NOT be pushed to server')
+        elif self.state is None:
+            pushed = self.kea.push()
         else:
-            self.kea.push()
+            changes = self.kea.changed_objects()
+            pushed = self.kea.push()
+            if pushed is not False:
+                # Without push, objects may still have been read again
+                self._save_state(changes if pushed else {})
+        self._seen.clear()
+        return pushed
+
+    def _save_state(self, changes):
+        """
+        Record the state of objects pushed to DHCP server, and the last
+        update time of objects read from netbox whose items were already up
+        to date
+        """
+
+        states = {}
+        for key, change in changes.items():
+            if change is None:
+                states[key] = None
+                continue
+            prefixes, item = change
+            stored = self.state.get(*key)
+            states[key] = ObjectState(
+                prefixes, item, _item_hash(item),
+                self._last_updated(key, item, stored))
+        for key in self._seen.keys() - changes.keys():
+            stored = self.state.get(*key)
+            if stored is None:
+                continue
+            last_updated = self._last_updated(key, stored.item, stored)
+            if last_updated != stored.last_updated:
+                states[key] = stored._replace(last_updated=last_updated)
+        self.state.update(states)
+        logging.debug(f'state of {len(states)} object(s) saved')
+
+    def _last_updated(self, key, item, stored):
+        """
+        Return the netbox last update time of the object read since last
+        push if item is the one built from it, else the stored one (the
+        object was not read, or its item was rejected or not committed)
+        """
+
+        seen = self._seen.get(key)
+        digest = _item_hash(seen[1]) if seen and seen[1] else None
+        if digest is not None and digest == _item_hash(item):
+            return seen[0]
+        return stored.last_updated if stored else None
 
     def reload_dhcp_config(self):
-        self.kea.pull()
+        self.kea.refresh()
 
     def sync_prefix(self, id_):
-        p = self.nb.prefix(id_)
+        self._sync_prefix(id_, self.nb.prefix(id_))
+
+    def _sync_prefix(self, id_, p):
+        """ Sync prefix already fetched from netbox (None if deleted) """
+
+        if self._prefixes is not None:
+            self._prefixes.add(p) if p else self._prefixes.remove(id_)
         self._prefix_to_subnet(p) if p else self.kea.del_subnet(id_)
 
     def sync_iprange(self, id_):
-        r = self.nb.ip_range(id_)
+        self._sync_iprange(id_, self.nb.ip_range(id_))
+
+    def _sync_iprange(self, id_, r):
         self._iprange_to_pool(r) if r else self.kea.del_pool(id_)
 
     def sync_ipaddress(self, id_):
-        i = self.nb.ip_address(id_)
-        self._ipaddr_to_resa(i) if i else self.kea.del_resa(id_)
+        self._sync_ipaddress(id_, self.nb.ip_address(id_))
+
+    def _sync_ipaddress(self, id_, i):
+        # Related objects are fetched as in the other paths: slim records
+        # don’t load them on attribute access
+        self._sync_ipaddresses([i]) if i else self.kea.del_resa(id_)
 
     def sync_interface(self, id_):
-        for i in self.nb.ip_addresses(interface_id=id_):
-            self.sync_ipaddress(i.id)
+        self._sync_ipaddresses(self.nb.ip_addresses(interface_id=id_))
 
     def sync_device(self, id_):
-        for i in self.nb.ip_addresses(device_id=id_):
-            self.sync_ipaddress(i.id)
+        self._sync_ipaddresses(self.nb.ip_addresses(device_id=id_))
 
     def sync_vminterface(self, id_):
-        for i in self.nb.ip_addresses(vminterface_id=id_):
-            self.sync_ipaddress(i.id)
+        self._sync_ipaddresses(self.nb.ip_addresses(vminterface_id=id_))
 
     def sync_virtualmachine(self, id_):
-        for i in self.nb.ip_addresses(virtual_machine_id=id_):
-            self.sync_ipaddress(i.id)
+        self._sync_ipaddresses(self.nb.ip_addresses(virtual_machine_id=id_))
+
+    def _sync_ipaddresses(self, ipaddrs):
+        """
+        Sync IP addresses already fetched from netbox, with one lookup of
+        their parent prefixes and one commit (unless the caller commits)
+        """
+
+        ipaddrs = self._prefetch_ipaddrs(ipaddrs)
+        if not ipaddrs:
+            return
+        parents = self._parent_prefixes(ipaddrs)
+        if not self.kea.auto_commit:
+            self._ipaddrs_to_resas(ipaddrs, parents)
+            return
+
+        self.kea.auto_commit = False
+        try:
+            self._ipaddrs_to_resas(ipaddrs, parents)
+            try:
+                self.kea.commit(isolate=True)
+            except ChangesRejected as e:
+                self._rejected(e)
+            except KeaError as e:
+                logging.error(f'IP addresses commit failed. Error: {e}')
+        finally:
+            self.kea.auto_commit = True
+
+    def _ipaddrs_to_resas(self, ipaddrs, parents):
+        for i in ipaddrs:
+            try:
+                self._ipaddr_to_resa(i, prefixes=parents[i.id])
+            except KeaClientError as e:
+                logging.error(f'IP {i}: {e}')
+
+    def _parent_prefixes(self, ipaddrs):
+        """ Return prefixes containing each IP address, by IP address ID """
+
+        index = self._prefix_index()
+        return {i.id: index.lookup(i.address) for i in ipaddrs}
+
+    def _prefix_index(self):
+        if self._prefixes is None:
+            logging.info('load prefixes index')
+            self._prefixes = PrefixIndex(self.nb.all_prefixes())
+        return self._prefixes
 
     def _prefix_to_subnet(self, pref, fullsync=False):
-        subnet = _mk_dhcp_item(pref, self.subnet_prefix_map)
-        subnet['subnet'] = pref.prefix
         if not fullsync:
             try:
-                self.kea.update_subnet(pref.id, subnet)
+                self.kea.update_subnet(pref.id, self._mk_subnet(pref))
+                return
             except (SubnetNotEqual, SubnetNotFound):
                 # Subnet address has changed or subnet is missing, recreate it
-                fullsync = True
-
-        if fullsync:
+                pass
+
+        self._apply_prefix(*self._build_prefix(pref))
+
+    def _build_prefix(self, pref, ipaddrs=None, ipranges=None):
+        """
+        Fetch IP addresses and IP ranges of prefix (unless given) and return
+        the tuple (prefix, subnet, [(ipaddr, reservation)], [(iprange, pool)]).
+        Reservation is None if IP address has no hardware address. Kea is not
+        involved, so that prefixes may be built concurrently.
+        """
+
+        subnet = self._mk_subnet(pref)
+        if ipaddrs is None:
+            ipaddrs = self._prefetch_ipaddrs(
+                self.nb.ip_addresses(parent=pref.prefix))
+        resas = [(i, self._mk_resa(i)) for i in ipaddrs]
+        if ipranges is None:
+            ipranges = self.nb.ip_ranges(parent=pref.prefix)
+        pools = [(r, self._mk_pool(r)) for r in ipranges]
+        return pref, subnet, resas, pools
+
+    def _apply_prefix(self, pref, subnet, resas, pools):
+        """
+        Replace subnet of prefix by the items built by _build_prefix. In
+        reconcile mode, unchanged subnet and items are kept as is.
+        """
+
+        if self.reconcile:
+            try:
+                self.kea.update_subnet(pref.id, subnet)
+            except (SubnetNotEqual, SubnetNotFound):
+                self.kea.set_subnet(pref.id, subnet)
+        else:
             self.kea.set_subnet(pref.id, subnet)
-            # Add host reservations
-            for i in self.nb.ip_addresses(parent=pref.prefix):
-                try:
-                    self._ipaddr_to_resa(i, prefix=pref)
-                except KeaClientError as e:
-                    logging.error(f'prefix {pref} > IP {i}: {e}')
-            # Add pools
-            for r in self.nb.ip_ranges(parent=pref.prefix):
-                try:
-                    self._iprange_to_pool(r, prefix=pref)
-                except KeaClientError as e:
-                    logging.error(f'prefix {pref} > range {r}: {e}')
-
-    def _iprange_to_pool(self, iprange, prefix=None):
-        prefixes = [prefix] if prefix else self.nb.prefixes(
-            contains=iprange.start_address)
-        pool = _mk_dhcp_item(iprange, self.pool_iprange_map)
-        start = str(ip_interface(iprange.start_address).ip)
-        end = str(ip_interface(iprange.end_address).ip)
-        pool['pool'] = f'{start}-{end}'
+        # Add host reservations
+        ipaddr_ids = []
+        for i, resa in resas:
+            try:
+                if resa is None:
+                    self.kea.del_resa(i.id)
+                else:
+                    self.kea.set_reservation(pref.id, i.id, resa)
+                    ipaddr_ids.append(i.id)
+            except KeaClientError as e:
+                logging.error(f'prefix {pref} > IP {i}: {e}')
+        # Add pools
+        iprange_ids = []
+        for r, pool in pools:
+            try:
+                self.kea.set_pool(pref.id, r.id, pool)
+                iprange_ids.append(r.id)
+            except KeaClientError as e:
+                logging.error(f'prefix {pref} > range {r}: {e}')
+        if self.reconcile:
+            # Drop the items that a full replacement wouldn’t have
+            self.kea.prune_subnet(pref.id, ipaddr_ids, iprange_ids)
+
+    def _mk_subnet(self, pref):
+        subnet = _mk_dhcp_item(pref, self._subnet_plan)
+        subnet['subnet'] = pref.prefix
+        self._saw('prefix', pref, subnet)
+        return subnet
+
+    def _mk_pool(self, iprange):
+        pool = _mk_dhcp_item(iprange, self._pool_plan)
+        pool['pool'] = (
+            f'{host(iprange.start_address)}-{host(iprange.end_address)}')
+        self._saw('iprange', iprange, pool)
+        return pool
+
+    def _mk_resa(self, ip):
+        resa = _mk_dhcp_item(ip, self._resa_plan)
+        if not resa.get('hw-address'):
+            self._saw('ipaddress', ip, None)
+            return None
+        resa['ip-address'] = host(ip.address)
+        self._saw('ipaddress', ip, resa)
+        return resa
+
+    def _iprange_to_pool(self, iprange):
+        prefixes = self._prefix_index().lookup_range(
+            iprange.start_address, iprange.end_address)
+        pool = self._mk_pool(iprange)
         for pref in prefixes:
             try:
                 self.kea.set_pool(pref.id, iprange.id, pool)
             except SubnetNotFound:
-                if not prefix:
-                    logging.warning(
-                        f'subnet {pref.prefix} is missing, sync it again')
-                    self._prefix_to_subnet(pref, fullsync=True)
-                else:
-                    logging.error(f'requested subnet {pref.prefix} not found')
+                logging.warning(
+                    f'subnet {pref.prefix} is missing, sync it again')
+                self._prefix_to_subnet(pref, fullsync=True)
 
-    def _ipaddr_to_resa(self, ip, prefix=None):
-        prefixes = [prefix] if prefix else self.nb.prefixes(
-            contains=ip.address)
-        resa = _mk_dhcp_item(ip, self.reservation_ipaddr_map)
-        if not resa.get('hw-address'):
+    def _ipaddr_to_resa(self, ip, prefixes=None):
+        """ Set reservation in subnets of prefixes (looked up if None) """
+
+        resa = self._mk_resa(ip)
+        if resa is None:
             self.kea.del_resa(ip.id)
             return
 
-        resa['ip-address'] = str(ip_interface(ip.address).ip)
+        if prefixes is None:
+            prefixes = self._prefix_index().lookup(ip.address)
         for pref in prefixes:
             try:
                 self.kea.set_reservation(pref.id, ip.id, resa)
             except SubnetNotFound:
-                if not prefix:
-                    logging.warning(
-                        f'subnet {pref.prefix} is missing, sync it again')
-                    self._prefix_to_subnet(pref)
-                else:
-                    logging.error(f'requested subnet {pref.prefix} not found')
+                logging.warning(
+                    f'subnet {pref.prefix} is missing, sync it again')
+                self._prefix_to_subnet(pref)
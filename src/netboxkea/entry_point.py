@@ -1,11 +1,13 @@
 import logging
 
 from .config import get_config
-from .connector import Connector
+from .connector import Connector, netbox_fields
 from .kea.app import DHCP4App
 from .listener import WebhookListener
 from .logger import init_logger
 from .netbox import NetboxApp
+from .scheduler import Job, SyncScheduler
+from .state import StateStore
 
 
 def run():
@@ -17,24 +19,52 @@ def run():
     nb = NetboxApp(
         conf.netbox_url, conf.netbox_token, prefix_filter=conf.prefix_filter,
         iprange_filter=conf.iprange_filter,
-        ipaddress_filter=conf.ipaddress_filter)
-    kea = DHCP4App(conf.kea_url)
+        ipaddress_filter=conf.ipaddress_filter, backend=conf.netbox_backend,
+        concurrency=conf.netbox_concurrency, fields=netbox_fields(
+            conf.subnet_prefix_map, conf.pool_iprange_map,
+            conf.reservation_ipaddr_map))
+    kea = DHCP4App(conf.kea_url, fine_grained=conf.kea_fine_grained)
     conn = Connector(
         nb, kea, conf.subnet_prefix_map, conf.pool_iprange_map,
-        conf.reservation_ipaddr_map, check=conf.check_only)
+        conf.reservation_ipaddr_map, check=conf.check_only,
+        bulk_fetch=conf.full_sync_bulk_fetch, workers=conf.full_sync_workers,
+        reconcile=conf.full_sync_reconcile,
+        commit_strategy=conf.full_sync_commit,
+        state=StateStore(conf.state_file) if conf.state_file else None,
+        incremental=bool(conf.incremental_sync_at_startup
+                         or conf.incremental_sync_interval))
 
-    if not conf.full_sync_at_startup and not conf.listen:
-        logging.warning('Neither full sync nor listen mode has been asked')
+    # Periodic syncs
+    jobs = []
+    if conf.full_sync_interval:
+        jobs.append(Job('full', conn.sync_all, conf.full_sync_interval,
+                        conf.sync_jitter, conf.full_sync_budget))
+    if conf.incremental_sync_interval:
+        jobs.append(Job(
+            'incremental', conn.sync_changes, conf.incremental_sync_interval,
+            conf.sync_jitter, conf.incremental_sync_budget))
+    scheduler = SyncScheduler(jobs) if jobs else None
 
-    # Start a full synchronisation
+    if not (conf.full_sync_at_startup or conf.incremental_sync_at_startup
+            or conf.listen or scheduler):
+        logging.warning('Neither sync nor listen mode has been asked')
+
+    # Start a full or incremental synchronisation
     if conf.full_sync_at_startup:
         logging.info('Start full sync')
         conn.sync_all()
+    elif conf.incremental_sync_at_startup:
+        logging.info('Start incremental sync')
+        conn.sync_changes()
 
     # Start listening for events
     if conf.listen:
         logging.info(f'Listen for events on {conf.bind}:{conf.port}')
         server = WebhookListener(
             connector=conn, host=conf.bind, port=conf.port, secret=conf.secret,
-            secret_header=conf.secret_header)
+            secret_header=conf.secret_header, debounce=conf.event_debounce,
+            server=conf.server, scheduler=scheduler)
         server.run()
+    elif scheduler is not None:
+        logging.info('Run scheduled syncs')
+        scheduler.run()
@@ -0,0 +1,58 @@
+import logging
+import threading
+
+
+class EventQueue:
+    """
+    Queue of netbox events, applied by batch in a background thread.
+
+    Events on a same object are coalesced, as the sync of an object always
+    queries netbox for its current state. A batch is applied "debounce"
+    seconds after its first event, with one pull, commit and push.
+    """
+
+    def __init__(self, connector, debounce=1.0):
+        self.conn = connector
+        self.debounce = debounce
+        # (model, ID) keys in order of first arrival
+        self._events = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name='netboxkea-events', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Apply pending events and stop the background thread """
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+
+    def put(self, model, id_):
+        with self._cond:
+            self._events.setdefault((model, id_), None)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._events or self._stopping)
+                if not self._events:
+                    return
+                # Let further events join the batch
+                self._cond.wait_for(lambda: self._stopping, self.debounce)
+                events, self._events = list(self._events), {}
+            self._apply(events)
+
+    def _apply(self, events):
+        logging.info(f'process {len(events)} event(s)')
+        try:
+            self.conn.sync_events(events)
+        except Exception:
+            logging.exception('event processing failed')
@@ -0,0 +1,83 @@
+"""
+IP addresses as (version, integer) values.
+
+Netbox and Kea exchange addresses as strings; they are converted to
+integers once at the edges, with the C socket functions, instead of
+building ipaddress objects in the sync hot paths.
+"""
+
+from socket import AF_INET, AF_INET6, inet_ntop, inet_pton
+
+_FAMILIES = {4: AF_INET, 6: AF_INET6}
+_BITS = {4: 32, 6: 128}
+
+
+def to_int(address):
+    """
+    Return IP version and integer value of an address, written with or
+    without prefix length. Raise ValueError on invalid address.
+    """
+
+    addr = address.partition('/')[0]
+    version = 6 if ':' in addr else 4
+    try:
+        return version, int.from_bytes(
+            inet_pton(_FAMILIES[version], addr), 'big')
+    except OSError:
+        raise ValueError(f'invalid IP address: {address!r}')
+
+
+def to_str(version, value):
+    """ Return the string of an IP address given as integer """
+
+    return inet_ntop(
+        _FAMILIES[version], value.to_bytes(_BITS[version] // 8, 'big'))
+
+
+def host(address):
+    """ Return an address without its prefix length, in canonical form """
+
+    addr = address.partition('/')[0]
+    try:
+        family = AF_INET6 if ':' in addr else AF_INET
+        return inet_ntop(family, inet_pton(family, addr))
+    except OSError:
+        raise ValueError(f'invalid IP address: {address!r}')
+
+
+def network(prefix):
+    """
+    Return IP version, prefix length, first and last addresses of a
+    network. Host bits of the address are ignored.
+    """
+
+    addr, _, plen = prefix.partition('/')
+    version, value = to_int(addr)
+    bits = _BITS[version]
+    try:
+        plen = int(plen) if plen else bits
+    except ValueError:
+        raise ValueError(f'invalid prefix length: {prefix!r}')
+    if not 0 <= plen <= bits:
+        raise ValueError(f'invalid prefix length: {prefix!r}')
+    host_mask = (1 << bits - plen) - 1
+    first = value & ~host_mask
+    return version, plen, first, first | host_mask
+
+
+def ip_range(text):
+    """
+    Return IP version, first and last addresses of a "-" separated range
+    or of a network (the forms of a Kea pool)
+    """
+
+    try:
+        start, end = text.split('-')
+    except ValueError:
+        version, _, first, last = network(text.strip())
+        return version, first, last
+    version, first = to_int(start.strip())
+    end_version, last = to_int(end.strip())
+    if version != end_version:
+        raise ValueError(f'mixed IP versions in range: {text!r}')
+    return version, first, last
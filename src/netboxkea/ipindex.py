@@ -0,0 +1,71 @@
+from bisect import insort
+
+from .ip import network, to_int
+
+
+class PrefixIndex:
+    """
+    Find netbox prefixes containing an IP address without querying netbox.
+
+    Networks are stored in one hash table per prefix length, so that a lookup
+    costs one table access per distinct prefix length (at most 32 for IPv4).
+    """
+
+    def __init__(self, prefixes=()):
+        # (IP version, prefix length) → {network address → [prefix, …]}
+        self._tables = {}
+        # IP version → sorted prefix lengths of the tables
+        self._lengths = {}
+        # Prefix ID → (table key, network address, broadcast address)
+        self._ids = {}
+        for p in prefixes:
+            self.add(p)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, prefix):
+        """ Add or replace a netbox prefix """
+
+        self.remove(prefix.id)
+        version, plen, addr, last = network(prefix.prefix)
+        key = version, plen
+        if key not in self._tables:
+            self._tables[key] = {}
+            insort(self._lengths.setdefault(version, []), plen)
+        self._tables[key].setdefault(addr, []).append(prefix)
+        self._ids[prefix.id] = key, addr, last
+
+    def remove(self, prefix_id):
+        """ Remove a netbox prefix. Silently ignore non-existent prefix """
+
+        try:
+            key, addr, _ = self._ids.pop(prefix_id)
+        except KeyError:
+            return
+        table = self._tables[key]
+        table[addr] = [p for p in table[addr] if p.id != prefix_id]
+        if not table[addr]:
+            del table[addr]
+            if not table:
+                del self._tables[key]
+                self._lengths[key[0]].remove(key[1])
+
+    def lookup(self, address):
+        """ Return prefixes containing address, longest prefix first """
+
+        ip_version, addr = to_int(address)
+        bits = 32 if ip_version == 4 else 128
+        prefixes = []
+        for plen in reversed(self._lengths.get(ip_version, ())):
+            host_bits = bits - plen
+            prefixes.extend(self._tables[ip_version, plen].get(
+                addr >> host_bits << host_bits, ()))
+        return prefixes
+
+    def lookup_range(self, start_address, end_address):
+        """ Return prefixes containing the whole range, longest first """
+
+        _, end = to_int(end_address)
+        return [p for p in self.lookup(start_address)
+                if end <= self._ids[p.id][2]]
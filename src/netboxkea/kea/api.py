@@ -1,10 +1,29 @@
 import json
+from copy import deepcopy
 import logging
 import requests
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from .exceptions import KeaServerError, KeaCmdError
 
 
+def _dumps(obj):
+    """ Serialize obj to compact JSON bytes, with orjson if available """
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def _loads(data):
+    """ Deserialize JSON bytes, with orjson if available """
+
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
 class FileAPI:
     """ Fake Kea DHCP4 API that keep configuration in memory and file """
 
@@ -13,26 +32,36 @@ class FileAPI:
         if self.config_file:
             try:
                 with open(self.config_file, 'rb') as f:
-                    self.conf = json.load(f)
+                    self.conf = _loads(f.read())
             except FileNotFoundError:
                 self.conf = {}
         else:
             self.conf = {}
 
+    def list_commands(self):
+        return []
+
     def get_conf(self):
         return self.conf.get('Dhcp4', {})
 
+    def get_conf_and_hash(self):
+        return self.get_conf(), None
+
+    def get_conf_hash(self):
+        return None
+
     def raise_conf_error(self, config):
-        json.dumps(config)
+        _dumps(config)
 
     def set_conf(self, config):
         self.raise_conf_error(config)
-        self.conf['Dhcp4'] = config
+        # Keep a snapshot, as the application updates its config in place
+        self.conf['Dhcp4'] = deepcopy(config)
 
     def write_conf(self):
         if self.config_file:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.conf, f, indent=4)
+            with open(self.config_file, 'wb') as f:
+                f.write(_dumps(self.conf))
 
 
 class DHCP4API:
@@ -46,11 +75,14 @@ class DHCP4API:
         payload = {'command': command, 'service': ['dhcp4']}
         if arguments:
             payload['arguments'] = arguments
+        # Serialize the payload (a whole configuration for some commands)
+        # at once: Kea control agent needs its length, not a chunked body
         try:
-            r = self.session.post(self.url, json=payload)
+            r = self.session.post(self.url, data=_dumps(payload), headers={
+                'Content-Type': 'application/json'})
             r.raise_for_status()
-            rj = r.json()
-        except requests.exceptions.RequestException as e:
+            rj = _loads(r.content)
+        except (requests.exceptions.RequestException, ValueError) as e:
             raise KeaServerError(f'API error: {e}')
         # One single command should return a list with one single item
         assert len(rj) == 1
@@ -62,11 +94,30 @@ class DHCP4API:
             logging.debug(f'command "{command}" OK (text: {text})')
             return rj.get('arguments')
 
+    def list_commands(self):
+        """ Return the list of commands supported by the DHCP server """
+
+        return self._request_kea('list-commands')
+
     def get_conf(self):
         """ Return configuration from Kea """
 
         return self._request_kea('config-get')['Dhcp4']
 
+    def get_conf_and_hash(self):
+        """
+        Return configuration from Kea and its hash (None if Kea doesn’t
+        provide it, i.e. before version 2.4)
+        """
+
+        args = self._request_kea('config-get')
+        return args['Dhcp4'], args.get('hash')
+
+    def get_conf_hash(self):
+        """ Return hash of current configuration """
+
+        return self._request_kea('config-hash-get')['hash']
+
     def raise_conf_error(self, config):
         """ Test configuration and raise errors """
 
@@ -81,3 +132,26 @@ class DHCP4API:
         """ On DHCP server write configuration to persitent storage """
 
         self._request_kea('config-write')
+
+    # Commands of hook libraries subnet_cmds and host_cmds. They update the
+    # runtime configuration, which config-write saves. Host commands target
+    # the configuration reservations ("memory"), not a hosts database.
+
+    def add_subnet(self, subnet):
+        self._request_kea('subnet4-add', {'subnet4': [subnet]})
+
+    def update_subnet(self, subnet):
+        self._request_kea('subnet4-update', {'subnet4': [subnet]})
+
+    def del_subnet(self, subnet_id):
+        self._request_kea('subnet4-del', {'id': subnet_id})
+
+    def add_reservation(self, subnet_id, reservation):
+        self._request_kea('reservation-add', {
+            'reservation': dict(reservation, **{'subnet-id': subnet_id}),
+            'operation-target': 'memory'})
+
+    def del_reservation(self, subnet_id, ip_address):
+        self._request_kea('reservation-del', {
+            'subnet-id': subnet_id, 'ip-address': ip_address,
+            'operation-target': 'memory'})
@@ -1,10 +1,15 @@
+import json
 import logging
-from copy import deepcopy
-from ipaddress import ip_interface, ip_network
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from collections.abc import Iterator
+from functools import partial
+from hashlib import blake2b
 
+from ..ip import ip_range, network, to_int
 from .api import DHCP4API, FileAPI
-from .exceptions import (DuplicateValue, KeaCmdError, SubnetNotEqual,
-                         SubnetNotFound)
+from .exceptions import (ChangesRejected, DuplicateValue, InvalidValue,
+                         KeaCmdError, KeaError, SubnetNotEqual, SubnetNotFound)
 
 # Kea configuration keys
 SUBNETS = 'subnet4'
@@ -14,37 +19,245 @@ RESAS = 'reservations'
 PREFIX = 'id'
 IP_RANGE = 'netbox_ip_range_id'
 IP_ADDR = 'netbox_ip_address_id'
+HASH = 'netbox_hash'
 
+# Netbox models of subnet items
+_MODELS = {RESAS: 'ipaddress', POOLS: 'iprange'}
 
-def _autocommit(func):
-    """ Decorator to autocommit changes after method execution """
+# Beyond this number of subnet/host commands, setting the whole config is
+# more efficient
+_MAX_COMMANDS = 100
 
-    def wrapper(self, *args, **kwargs):
-        res = func(self, *args, **kwargs)
-        commit_arg = kwargs.get('commit')
-        if commit_arg is True or (commit_arg is None and self.auto_commit):
-            self.commit()
-        return res
-    return wrapper
+
+def _autocommit(model, id_arg=0):
+    """
+    Decorator to autocommit changes after method execution. Uncommitted
+    changes are recorded with the netbox model and ID (the id_arg positional
+    argument, if any) they come from, so that they can be applied again to
+    isolate the ones rejected by Kea.
+    """
+
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            # Iterators would be exhausted when the change is applied again
+            args = [tuple(a) if isinstance(a, Iterator) else a for a in args]
+            res = func(self, *args, **kwargs)
+            commit_arg = kwargs.get('commit')
+            if commit_arg is True or (commit_arg is None and self.auto_commit):
+                self.commit()
+            elif self._units is not None:
+                id_ = args[id_arg] if id_arg is not None else None
+                self._units.append(
+                    ((model, id_), partial(func, self, *args, **kwargs)))
+            return res
+        return wrapper
+    return decorator
+
+
+def _digest(item):
+    """
+    Return a stable hash of a DHCP item content, excluding the keys we set
+    (IDs, hash, nested reservations and pools)
+    """
+
+    content = {k: v for k, v in item.items()
+               if k not in (PREFIX, USR_CTX, RESAS, POOLS)}
+    ctx = {k: v for k, v in item.get(USR_CTX, {}).items()
+           if k not in (IP_RANGE, IP_ADDR, HASH)}
+    if ctx:
+        content[USR_CTX] = ctx
+    return blake2b(json.dumps(
+        content, sort_keys=True, separators=(',', ':'), default=str).encode(),
+        digest_size=16).hexdigest()
+
+
+def _same_digest(item, digest):
+    return item.get(USR_CTX, {}).get(HASH) == digest
+
+
+def _without(item, key):
+    return {k: v for k, v in item.items() if k != key}
+
+
+def _content(item):
+    """
+    Return what tells if a DHCP item has changed: its hash and netbox IDs
+    if we set them, as Kea fills in default values of pulled items, else
+    the item itself (without nested reservations and pools)
+    """
+
+    ctx = item.get(USR_CTX, {})
+    if HASH in ctx:
+        return ctx[HASH], ctx.get(IP_ADDR), ctx.get(IP_RANGE)
+    return json.dumps({k: v for k, v in item.items() if k not in (
+        RESAS, POOLS)}, sort_keys=True, default=str)
 
 
-def _boundaries(ip_range):
-    """ Return a tuple of first and last ip_interface of the pool """
+def _items_content(subnet, item_list):
+    return Counter(_content(i) for i in subnet.get(item_list, []))
+
+
+def _resas_by_ip(subnet):
+    """
+    Return reservations of exported subnet (or None) by IP address, or None
+    if some of them have no or the same IP address
+    """
+
+    resas = [] if subnet is None else subnet.get(RESAS, [])
+    by_ip = {r.get('ip-address'): r for r in resas}
+    return None if None in by_ip or len(by_ip) < len(resas) else by_ip
+
+
+def _same_subnet(old, new):
+    """ Tell if exported subnets (or None) have the same content """
+
+    if old is new:
+        return True
+    return (old is not None and new is not None
+            and _content(old) == _content(new)
+            and all(_items_content(old, k) == _items_content(new, k)
+                    for k in (RESAS, POOLS)))
+
+
+def _pool_range(pool):
+    """ Return first and last addresses of a pool as integers """
 
     # pool may be expressed by a "-" seperated range or by a network
+    _, start, end = ip_range(pool)
+    return start, end
+
+
+def _address(ip):
+    """ Return an IP address as integer, raise InvalidValue if invalid """
+
     try:
-        start, end = ip_range.split('-')
-    except ValueError:
-        net = ip_network(ip_range)
-        return ip_interface(net.network_address), ip_interface(
-            net.broadcast_address)
-    else:
-        return ip_interface(start), ip_interface(end)
+        return to_int(ip)[1]
+    except ValueError as e:
+        raise InvalidValue(str(e))
+
+
+class _Subnet:
+    """
+    Subnet options with its reservations and pools. Items are indexed by
+    their netbox ID (or by a private key for items not managed by us).
+    Reservations are also indexed by hardware and IP address, and pools by
+    address range, to speed up duplicate and overlap checks.
+    """
+
+    __slots__ = ('_item', 'items', 'addrs', 'pool_starts', 'pool_ranges',
+                 'pool_bounds', '_bounds', '_export')
+
+    def __init__(self, item):
+        self._item = item
+        self.items = {RESAS: {}, POOLS: {}}
+        self.addrs = {'hw-address': {}, 'ip-address': {}}
+        # Pool ranges as (first, last, key) integer tuples sorted by first
+        # address (with the list of first addresses for bisection), and
+        # bounds of each pool by key
+        self.pool_starts = []
+        self.pool_ranges = []
+        self.pool_bounds = {}
+        self._bounds = None
+        self._export = None
+
+    @property
+    def item(self):
+        return self._item
+
+    @item.setter
+    def item(self, item):
+        self._item = item
+        self._bounds = None
+        self._export = None
+
+    def raise_outside(self, start, end, display):
+        """ Raise InvalidValue if range start-end is not in the subnet """
+
+        if self._bounds is None:
+            try:
+                self._bounds = network(self._item['subnet'])[2:]
+            except (KeyError, ValueError):
+                # Not a valid subnet: Kea will tell
+                self._bounds = None, None
+        first, last = self._bounds
+        if first is not None and not first <= start <= end <= last:
+            raise InvalidValue(
+                f'{display} is outside subnet {self._item["subnet"]}')
+
+    def put(self, item_list, key, item):
+        """ Add or replace an item """
+
+        self.pop(item_list, key)
+        self.items[item_list][key] = item
+        self._export = None
+        if item_list == RESAS:
+            for k, index in self.addrs.items():
+                if k in item:
+                    index.setdefault(item[k], set()).add(key)
+        else:
+            try:
+                start, end = _pool_range(item['pool'])
+            except (KeyError, ValueError):
+                # Not a valid pool: Kea will tell
+                return
+            i = bisect_right(self.pool_starts, start)
+            self.pool_starts.insert(i, start)
+            self.pool_ranges.insert(i, (start, end, key))
+            self.pool_bounds[key] = start, end
+
+    def pop(self, item_list, key):
+        """ Remove an item and return it, or None if it doesn’t exist """
+
+        item = self.items[item_list].pop(key, None)
+        if item is not None:
+            self._export = None
+        if item is not None and item_list == RESAS:
+            for k, index in self.addrs.items():
+                keys = index.get(item.get(k))
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del index[item[k]]
+        elif item is not None and key in self.pool_bounds:
+            start, end = self.pool_bounds.pop(key)
+            i = self.pool_ranges.index(
+                (start, end, key), bisect_left(self.pool_starts, start))
+            del self.pool_starts[i]
+            del self.pool_ranges[i]
+        return item
+
+    def conflicts(self, addr_key, value, key):
+        """ Return True if address is used by a reservation other than key """
+
+        return bool(self.addrs[addr_key].get(value, set()) - {key})
+
+    def pool_overlap(self, start, end, key):
+        """
+        Return the pool, other than key, overlapping the range of integer
+        addresses start-end, or None
+        """
+
+        # Pools don’t overlap each other: only the last pool starting before
+        # range end may overlap (or the one before, if the last one is key).
+        i = bisect_right(self.pool_starts, end)
+        for first, last, k in reversed(self.pool_ranges[max(i - 2, 0):i]):
+            if k != key:
+                return self.items[POOLS][k] if last >= start else None
+        return None
+
+    def export(self):
+        """ Return subnet as a Kea configuration item """
+
+        # Cache the result: only modified subnets are rebuilt on each commit
+        if self._export is None:
+            self._export = dict(self._item, **{
+                k: list(v.values()) for k, v in self.items.items()})
+        return self._export
 
 
 class DHCP4App:
 
-    def __init__(self, url=None):
+    def __init__(self, url=None, fine_grained=False):
         if url.startswith('http://') or url.startswith('https://'):
             self.api = DHCP4API(url)
         elif url.startswith('file://'):
@@ -52,59 +265,470 @@ class DHCP4App:
         else:
             raise ValueError(
                 'Kea URL must starts either with "http(s)://" or "file://"')
-        self.conf = None
-        self.commit_conf = None
+        self._globals = None
+        self._subnets = {}
+        self._conf = None
+        # Position of each subnet in the Kea subnet list, and reverse list
+        self._positions = {}
+        self._ids = []
+        self._stale = set()
+        # Undo journal of uncommitted changes, as a list of callables, and
+        # uncommitted changes as a list of ((netbox model, ID), callable)
+        # tuples (None if unknown)
+        self._journal = []
+        self._units = []
         self._has_commit = False
         self.auto_commit = True
+        # Push changes with subnet and host commands instead of setting the
+        # whole config, if Kea supports them
+        self.fine_grained = fine_grained
+        self._kea_commands = None
+        # Subnet states before their first change since last pull/push, to
+        # push only actual changes (None means that changes are unknown)
+        self._changes = {}
+        # Hash of server config when it was last pulled or pushed, to know
+        # if the working config is still current (None if unknown)
+        self._conf_hash = None
+        # (netbox model, ID) of objects changed since last pull/push
+        self._dirty = set()
+
+    @property
+    def conf(self):
+        """
+        Working configuration, as expected by Kea. It is rebuilt from the
+        model after changes and must be considered as read-only.
+        """
+
+        # Kea subnet list is kept up to date, only the modified subnets are
+        # exported again.
+        for prefix_id in self._stale:
+            self._conf[SUBNETS][self._positions[prefix_id]] = self._subnets[
+                prefix_id].export()
+        self._stale.clear()
+        return self._conf
+
+    @conf.setter
+    def conf(self, conf):
+        # Replacing the whole configuration is a change like others
+        old = self.conf
+        self._load(conf)
+        self._changes = None
+        self._units = None
+        if old is not None:
+            self._journal.append(partial(
+                self._load, dict(old, **{SUBNETS: list(old[SUBNETS])})))
+
+    def _load(self, conf):
+        """ Load Kea configuration and build indexes """
+
+        self._globals = dict(conf)
+        self._subnets = {}
+        self._conf = dict(self._globals, **{SUBNETS: []})
+        self._positions = {}
+        self._ids = []
+        self._stale = set()
+        # Reverse indexes: subnet network address → prefix ID and netbox item
+        # ID → set of prefix IDs (an item may belong to nested subnets).
+        self._nets = {}
+        self._item_subnets = {RESAS: {}, POOLS: {}}
+        for s in self._globals.pop(SUBNETS, []):
+            # Subnets without ID are not managed by us: give them a private key
+            self._link_subnet(s.get(PREFIX, object()), self._mk_subnet(s))
+
+    def _mk_subnet(self, subnet_item):
+        """ Build subnet from a Kea subnet item and its nested items """
+
+        sub = _Subnet({k: v for k, v in subnet_item.items()
+                       if k not in (RESAS, POOLS)})
+        for item_list, item_key in ((RESAS, IP_ADDR), (POOLS, IP_RANGE)):
+            for i in subnet_item.get(item_list, []):
+                item_id = i.setdefault(USR_CTX, {}).setdefault(item_key, None)
+                # Items not managed by us have no ID: give them a private key
+                sub.put(item_list, object() if item_id is None else item_id, i)
+        return sub
+
+    # Journaled changes. Each one records the way to undo it.
+
+    def _add_subnet(self, prefix_id, sub):
+        self._track(prefix_id, sub)
+        self._link_subnet(prefix_id, sub)
+        self._journal.append(partial(self._unlink_subnet, prefix_id))
+
+    def _remove_subnet(self, prefix_id):
+        self._track(prefix_id, self._subnets[prefix_id])
+        sub = self._unlink_subnet(prefix_id)
+        self._journal.append(partial(self._link_subnet, prefix_id, sub))
+
+    def _set_subnet_options(self, prefix_id, item):
+        self._track(prefix_id)
+        old = self._set_options(prefix_id, item)
+        self._journal.append(partial(self._set_options, prefix_id, old))
+
+    def _put_item(self, prefix_id, item_list, key, item):
+        self._track(prefix_id)
+        self._dirty.add((_MODELS[item_list], key))
+        old = self._link_item(prefix_id, item_list, key, item)
+        self._journal.append(self._undo_item(prefix_id, item_list, key, old))
+
+    def _pop_item(self, prefix_id, item_list, key):
+        self._track(prefix_id)
+        self._dirty.add((_MODELS[item_list], key))
+        old = self._unlink_item(prefix_id, item_list, key)
+        self._journal.append(self._undo_item(prefix_id, item_list, key, old))
+
+    def _track(self, prefix_id, sub=None):
+        """
+        Record subnet state before its first change since pull/push, and
+        mark the prefix as changed, with the items of sub if the whole subnet
+        is added or removed
+        """
+
+        self._dirty.add(('prefix', prefix_id))
+        if sub is not None:
+            self._dirty.update((_MODELS[item_list], key)
+                               for item_list, items in sub.items.items()
+                               for key in items)
+        if self._changes is not None and prefix_id not in self._changes:
+            sub = self._subnets.get(prefix_id)
+            self._changes[prefix_id] = None if sub is None else sub.export()
+
+    def _undo_item(self, prefix_id, item_list, key, old):
+        if old is None:
+            return partial(self._unlink_item, prefix_id, item_list, key)
+        else:
+            return partial(self._link_item, prefix_id, item_list, key, old)
+
+    # Raw changes, maintaining indexes
+
+    def _link_subnet(self, prefix_id, sub):
+        self._subnets[prefix_id] = sub
+        self._nets[sub.item.get('subnet')] = prefix_id
+        for item_list, items in sub.items.items():
+            for key in items:
+                self._item_subnets[item_list].setdefault(key, set()).add(
+                    prefix_id)
+        subnets = self._conf[SUBNETS]
+        self._positions[prefix_id] = len(subnets)
+        subnets.append(None)
+        self._ids.append(prefix_id)
+        self._stale.add(prefix_id)
+
+    def _unlink_subnet(self, prefix_id):
+        sub = self._subnets.pop(prefix_id)
+        if self._nets.get(sub.item.get('subnet')) == prefix_id:
+            del self._nets[sub.item.get('subnet')]
+        for item_list, items in sub.items.items():
+            for key in items:
+                self._unindex_item(item_list, key, prefix_id)
+        # Fill the hole with the last subnet (Kea doesn’t care about order)
+        subnets = self._conf[SUBNETS]
+        pos = self._positions.pop(prefix_id)
+        last, last_id = subnets.pop(), self._ids.pop()
+        if pos < len(subnets):
+            subnets[pos], self._ids[pos] = last, last_id
+            self._positions[last_id] = pos
+        self._stale.discard(prefix_id)
+        return sub
+
+    def _set_options(self, prefix_id, item):
+        sub = self._subnets[prefix_id]
+        old, sub.item = sub.item, item
+        self._stale.add(prefix_id)
+        return old
+
+    def _link_item(self, prefix_id, item_list, key, item):
+        sub = self._subnets[prefix_id]
+        old = sub.pop(item_list, key)
+        sub.put(item_list, key, item)
+        self._item_subnets[item_list].setdefault(key, set()).add(prefix_id)
+        self._stale.add(prefix_id)
+        return old
+
+    def _unlink_item(self, prefix_id, item_list, key):
+        old = self._subnets[prefix_id].pop(item_list, key)
+        self._unindex_item(item_list, key, prefix_id)
+        self._stale.add(prefix_id)
+        return old
+
+    def _unindex_item(self, item_list, key, prefix_id):
+        prefix_ids = self._item_subnets[item_list].get(key)
+        if prefix_ids:
+            prefix_ids.discard(prefix_id)
+            if not prefix_ids:
+                del self._item_subnets[item_list][key]
+
+    def _rollback(self):
+        """ Undo uncommitted changes """
+
+        while self._journal:
+            self._journal.pop()()
+        self._units = []
+
+    def _keep_changes(self):
+        # Only changes need to be pushed
+        if self._journal:
+            self._has_commit = True
+        self._journal.clear()
+        self._units = []
 
     def pull(self):
         """ Fetch configuration from DHCP server  """
 
         logging.info('pull running config from DHCP server')
-        self.conf = self.api.get_conf()
-        # Set minimal expected keys
-        self.conf.setdefault(SUBNETS, [])
-        for s in self.conf[SUBNETS]:
-            for r in s.setdefault(RESAS, []):
-                r.setdefault(USR_CTX, {}).setdefault(IP_ADDR, None)
-            for p in s.setdefault(POOLS, []):
-                p.setdefault(USR_CTX, {}).setdefault(IP_RANGE, None)
+        conf, self._conf_hash = self.api.get_conf_and_hash()
+        self._load(conf)
+        self._journal.clear()
+        self._units = []
+        self._has_commit = False
+        self._changes = {}
+        self._dirty.clear()
+        self.ip_uniqueness = self._globals.get('ip-reservations-unique', True)
 
-        self.commit_conf = deepcopy(self.conf)
-        self.ip_uniqueness = self.conf.get('ip-reservations-unique', True)
+    def refresh(self):
+        """
+        Pull configuration from DHCP server, unless the last pulled or pushed
+        one is still current, as told by the server config hash
+        """
 
-    def commit(self):
-        """ Record changes to the configuration. Return True if success """
+        if (self._conf_hash is not None and not self._journal
+                and not self._has_commit
+                and self._get_conf_hash() == self._conf_hash):
+            logging.debug('server config unchanged, skip pull')
+        else:
+            self.pull()
 
+    def _get_conf_hash(self):
         try:
-            logging.debug('check configuration')
-            self.api.raise_conf_error(self.conf)
-        except KeaCmdError:
-            # Drop current working config
-            logging.error('config check failed, drop uncommited changes')
-            self.conf = deepcopy(self.commit_conf)
-            raise
-        else:
-            logging.debug('commit configuration')
-            self.commit_conf = deepcopy(self.conf)
-            self._has_commit = True
+            return self.api.get_conf_hash()
+        except KeaError as e:
+            logging.warning(f'unable to get config hash: {e}')
+            return None
+
+    def commit(self, check=True, isolate=False):
+        """
+        Record changes to the configuration. Return True if success. Without
+        check, the configuration is not tested by the server and only relies
+        on the checks done by the set methods (duplicates, values outside
+        subnet).
+
+        With isolate, rejected changes are looked for by applying them again
+        by halves: the accepted ones are committed and ChangesRejected is
+        raised with the (netbox model, ID) of the rejected ones.
+        """
+
+        if not self._journal:
+            # Set methods didn’t change anything
+            logging.debug('nothing to commit')
+            self._units = []
             return True
+        if check:
+            try:
+                logging.debug('check configuration')
+                self.api.raise_conf_error(self.conf)
+            except KeaCmdError as e:
+                # Drop current working config
+                logging.error('config check failed, drop uncommited changes')
+                units = self._units
+                self._rollback()
+                if not isolate or not units:
+                    raise
+                rejected = self._isolate(units)
+                raise ChangesRejected(
+                    f'{len(rejected)} change(s) rejected: {e}', rejected)
+        logging.debug('commit configuration')
+        self._keep_changes()
+        return True
+
+    def _isolate(self, units):
+        """
+        Apply changes again and check them by halves, down to the rejected
+        ones, in O(k log n) checks for k rejected changes among n. Accepted
+        changes are committed. Return the labels of rejected changes.
+        """
+
+        rejected = []
+
+        def check(group):
+            for label, change in group:
+                try:
+                    change()
+                except KeaError as e:
+                    # Previous changes of the group are not the same anymore
+                    logging.error(f'{label[0]} id={label[1]}: {e}')
+                    rejected.append(label)
+            if not self._journal:
+                return
+            try:
+                self.api.raise_conf_error(self.conf)
+            except KeaCmdError:
+                self._rollback()
+                if len(group) == 1:
+                    rejected.append(group[0][0])
+                else:
+                    check(group[:len(group) // 2])
+                    check(group[len(group) // 2:])
+            else:
+                self._keep_changes()
+
+        logging.info(f'isolate rejected changes among {len(units)}')
+        check(units)
+        return rejected
 
     def push(self):
-        """ Update DHCP server configuration """
+        """
+        Update DHCP server configuration. Return True if success, False if
+        Kea rejected the config, None if there was nothing to push.
+        """
 
-        if self._has_commit:
+        pushed = None
+        if self._has_commit and self._journal:
+            logging.warning('drop uncommited changes before push')
+            self._rollback()
+        if self._has_commit and not self._modified():
+            # Changes have been reverted: don’t reset Kea for nothing
+            logging.info('config unchanged since last pull/push, skip push')
+        elif self._has_commit:
             logging.info('push configuration to runtime DHCP server')
+            # Server config has changed: get its new hash, if Kea has one
+            hash_supported, self._conf_hash = self._conf_hash, None
             try:
-                self.api.set_conf(self.commit_conf)
+                if not self._push_changes():
+                    self.api.set_conf(self.conf)
                 logging.info('write configuration to permanent file')
                 self.api.write_conf()
             except KeaCmdError as e:
                 logging.error(f'config push or write rejected: {e}')
-
-            self._has_commit = None
+                pushed = False
+            else:
+                if hash_supported:
+                    self._conf_hash = self._get_conf_hash()
+                pushed = True
         else:
             logging.debug('no commit to push')
+        self._has_commit = False
+        self._changes = {}
+        self._dirty.clear()
+        return pushed
+
+    def _modified(self):
+        """
+        Tell if the working config differs from the last pulled or pushed
+        one, by comparing the content of changed subnets with their former
+        state (see _content). The order of subnets doesn’t matter to Kea,
+        which identifies them by ID.
+        """
+
+        if self._changes is None:
+            return True
+        for prefix_id, old in self._changes.items():
+            sub = self._subnets.get(prefix_id)
+            if not _same_subnet(old, None if sub is None else sub.export()):
+                return True
+        return False
+
+    def changed_objects(self):
+        """
+        Return the netbox objects changed since last pull/push, as a
+        dictionary of (netbox model, ID) → (IDs of prefixes whose subnets
+        hold the object item, item), or None if the object has no item
+        anymore
+        """
+
+        changed = {}
+        for model, key in self._dirty:
+            if not isinstance(key, int):
+                # Not managed by us
+                continue
+            if model == 'prefix':
+                sub = self._subnets.get(key)
+                changed[model, key] = None if sub is None else (
+                    [key], sub.item)
+                continue
+            item_list = RESAS if model == 'ipaddress' else POOLS
+            prefix_ids = sorted(p for p in self._item_subnets[item_list].get(
+                key, ()) if isinstance(p, int))
+            changed[model, key] = (prefix_ids, self._subnets[
+                prefix_ids[0]].items[item_list][key]) if prefix_ids else None
+        return changed
+
+    def _push_changes(self):
+        """
+        Push changes with subnet and host commands, if enabled and supported
+        by Kea. Return False if the whole config needs to be set instead.
+        """
+
+        if not self.fine_grained or self._changes is None:
+            return False
+        commands = self._change_commands()
+        if commands is None or len(commands) > _MAX_COMMANDS:
+            return False
+        if self._kea_commands is None:
+            try:
+                self._kea_commands = set(self.api.list_commands())
+            except KeaError as e:
+                logging.warning(f'unable to list Kea commands: {e}')
+                self._kea_commands = set()
+        if not {name for name, _ in commands} <= self._kea_commands:
+            logging.debug('subnet or host commands not supported by Kea')
+            return False
+
+        try:
+            for name, cmd in commands:
+                logging.debug(f'send command {name}')
+                cmd()
+        except KeaCmdError as e:
+            # Setting the whole config fixes a partially applied change set
+            logging.warning(f'command failed, set whole config instead: {e}')
+            if name.startswith('reservation-'):
+                # Kea version unable to change the config reservations
+                # (without "operation-target" support): don’t try again
+                logging.warning('reservation commands disabled')
+                self._kea_commands -= {'reservation-add', 'reservation-del'}
+            return False
+        return True
+
+    def _change_commands(self):
+        """
+        Return the list of (command name, function) tuples that apply changes
+        since last pull/push, deletions first, or None if changes can’t be
+        expressed by commands
+        """
+
+        dels, adds = [], []
+        for prefix_id, old in self._changes.items():
+            sub = self._subnets.get(prefix_id)
+            new = None if sub is None else sub.export()
+            if _same_subnet(old, new):
+                continue
+            elif not isinstance(prefix_id, int):
+                return None
+            # Subnet commands don’t take reservations, which are sent with
+            # host commands. Kea identifies them by IP address.
+            old_resas = _resas_by_ip(old)
+            new_resas = _resas_by_ip(new)
+            if old_resas is None or new_resas is None:
+                return None
+            for ip, r in old_resas.items():
+                if ip not in new_resas or (
+                        _content(new_resas[ip]) != _content(r)):
+                    dels.append(('reservation-del', partial(
+                        self.api.del_reservation, prefix_id, ip)))
+            if new is None:
+                dels.append(('subnet4-del', partial(
+                    self.api.del_subnet, prefix_id)))
+            elif old is None:
+                adds.append(('subnet4-add', partial(
+                    self.api.add_subnet, _without(new, RESAS))))
+            elif (_content(old) != _content(new) or _items_content(
+                    old, POOLS) != _items_content(new, POOLS)):
+                adds.append(('subnet4-update', partial(
+                    self.api.update_subnet, _without(new, RESAS))))
+            for ip, r in new_resas.items():
+                if ip not in old_resas or (
+                        _content(old_resas[ip]) != _content(r)):
+                    adds.append(('reservation-add', partial(
+                        self.api.add_reservation, prefix_id, r)))
+        return dels + adds
 
     def _check_commit(self, commit=None):
         """ Commit conf if required by argument or instance attribute """
@@ -112,18 +736,18 @@ class DHCP4App:
         if commit is True or (commit is None and self.auto_commit):
             self.commit()
 
-    @_autocommit
+    @_autocommit('prefix')
     def set_subnet(self, prefix_id, subnet_item):
         """ Replace subnet with prefix ID or append a new one """
 
         self._set_subnet(prefix_id, subnet_item, only_update_options=False)
 
-    @_autocommit
+    @_autocommit('prefix')
     def update_subnet(self, prefix_id, subnet_item):
         """
-        Update subnet options (preserve current reservations and pools). Raise
-        SubnetNotEqual if network address differs, or SubnetNotFound if no
-        subnet prefix ID matches.
+        Update subnet options (preserve current reservations and pools), unless
+        they are unchanged. Raise SubnetNotEqual if network address differs,
+        or SubnetNotFound if no subnet prefix ID matches.
         """
 
         self._set_subnet(prefix_id, subnet_item, only_update_options=True)
@@ -136,83 +760,111 @@ class DHCP4App:
         except KeyError as e:
             raise TypeError(f'Missing mandatory subnet key: {e}')
 
-        sfound = None
-        for s in self.conf[SUBNETS]:
-            if s[PREFIX] == prefix_id:
-                sfound = s
-                if s['subnet'] == subnet:
-                    # No network addr change, no need to inspect other subnets
-                    break
-                elif only_update_options:
-                    raise SubnetNotEqual(f'subnet {s["subnet"]} ≠ {subnet}')
-
-            # Continue in order to check duplicates
-            elif s['subnet'] == subnet:
-                raise DuplicateValue(f'duplicate subnet {subnet}')
+        sfound = self._subnets.get(prefix_id)
+        if sfound and sfound.item['subnet'] != subnet and only_update_options:
+            raise SubnetNotEqual(f'subnet {sfound.item["subnet"]} ≠ {subnet}')
+        elif self._nets.get(subnet, prefix_id) != prefix_id:
+            raise DuplicateValue(f'duplicate subnet {subnet}')
 
+        digest = _digest(subnet_item)
+        subnet_item.setdefault(USR_CTX, {})[HASH] = digest
         subnet_item[PREFIX] = prefix_id
-        if sfound:
+        if sfound and _same_digest(sfound.item, digest):
+            if only_update_options or not any(sfound.items.values()):
+                logging.debug(f'subnet {subnet}: unchanged')
+            else:
+                # Same as a replacement, without rebuilding the subnet
+                logging.info(f'subnet {subnet}: unchanged, drop its items')
+                for item_list, items in sfound.items.items():
+                    for key in list(items):
+                        self._pop_item(prefix_id, item_list, key)
+        elif sfound:
+            # Replace current subnet options (except reservations and pools)
+            # in order to drop Kea default options, as they may conflict with
+            # our new settings (like min/max-valid-lifetime against
+            # valid-lifetime).
             if only_update_options:
                 logging.info(f'subnet {subnet}: update with {subnet_item}')
-                # Preserve reservations and pools
-                subnet_item[RESAS] = sfound[RESAS]
-                subnet_item[POOLS] = sfound[POOLS]
+                self._set_subnet_options(prefix_id, subnet_item)
             else:
-                subnet_item.setdefault(RESAS, [])
-                subnet_item.setdefault(POOLS, [])
                 logging.info(f'subnet ID {prefix_id}: replace with {subnet}')
-            # Clear current subnet (except reservations and pools) in order to
-            # drop Kea default options, as they may conflict with our new
-            # settings (like min/max-valid-lifetime against valid-lifetime).
-            sfound.clear()
-            sfound.update(subnet_item)
+                self._remove_subnet(prefix_id)
+                self._add_subnet(prefix_id, self._mk_subnet(subnet_item))
         elif only_update_options:
             raise SubnetNotFound(f'subnet ID {prefix_id}')
         else:
-            subnet_item.setdefault(RESAS, [])
-            subnet_item.setdefault(POOLS, [])
             logging.info(f'subnets: add {subnet}, ID {prefix_id}')
-            self.conf[SUBNETS].append(subnet_item)
+            self._add_subnet(prefix_id, self._mk_subnet(subnet_item))
 
-    @_autocommit
+    @_autocommit('prefix')
     def del_subnet(self, prefix_id, commit=None):
         logging.info(f'subnets: remove subnet {prefix_id} if it exists')
-        self.conf[SUBNETS] = [
-            s for s in self.conf[SUBNETS] if s[PREFIX] != prefix_id]
+        if prefix_id in self._subnets:
+            self._remove_subnet(prefix_id)
 
-    @_autocommit
+    @_autocommit('prefix', id_arg=None)
     def del_all_subnets(self):
         logging.info('delete all current subnets')
-        self.conf[SUBNETS].clear()
+        for prefix_id in list(self._subnets):
+            self._remove_subnet(prefix_id)
+
+    @_autocommit('prefix', id_arg=None)
+    def del_subnets_except(self, prefix_ids):
+        """ Delete all subnets but the ones with given prefix IDs """
+
+        prefix_ids = set(prefix_ids)
+        for prefix_id in [i for i in self._subnets if i not in prefix_ids]:
+            logging.info(f'subnets: remove subnet {prefix_id}')
+            self._remove_subnet(prefix_id)
+
+    @_autocommit('prefix')
+    def prune_subnet(self, prefix_id, ipaddr_ids, iprange_ids):
+        """
+        Delete subnet reservations and pools but the ones with given IP
+        address and IP range IDs. Raise SubnetNotFound if no subnet prefix ID
+        matches.
+        """
 
-    @_autocommit
+        try:
+            sub = self._subnets[prefix_id]
+        except KeyError:
+            raise SubnetNotFound(f'subnet {prefix_id}')
+        for item_list, item_ids in ((RESAS, ipaddr_ids), (POOLS, iprange_ids)):
+            item_ids = set(item_ids)
+            for key in [k for k in sub.items[item_list] if k not in item_ids]:
+                logging.info(f'subnet {prefix_id} > {item_list}: remove ID '
+                             f'{key}')
+                self._pop_item(prefix_id, item_list, key)
+
+    @_autocommit('iprange', id_arg=1)
     def set_pool(self, prefix_id, iprange_id, pool_item):
         """ Replace pool or append a new one """
 
         try:
-            start, end = pool_item['pool'].split('-')
+            start, end = _pool_range(pool_item['pool'])
         except KeyError as e:
             raise TypeError(f'Missing mandatory pool key: {e}')
+        except ValueError as e:
+            raise InvalidValue(str(e))
 
         pool_item.setdefault(USR_CTX, {})[IP_RANGE] = iprange_id
-        ip_start, ip_end = ip_interface(start), ip_interface(end)
 
-        def raise_conflict(p):
-            pl = p.get('pool')
-            if pl:
-                s, e = _boundaries(pl)
-                if s <= ip_start <= e or s <= ip_end <= e:
-                    raise DuplicateValue(f'overlaps existing pool {pl}')
+        def raise_conflict(sub):
+            sub.raise_outside(start, end, f'pool {pool_item["pool"]}')
+            overlap = sub.pool_overlap(start, end, iprange_id)
+            if overlap is not None:
+                raise DuplicateValue(
+                    f'overlaps existing pool {overlap["pool"]}')
 
         self._set_subnet_item(
-            prefix_id, POOLS, IP_RANGE, iprange_id, pool_item, raise_conflict,
+            prefix_id, POOLS, iprange_id, pool_item, raise_conflict,
             pool_item['pool'])
 
-    @_autocommit
+    @_autocommit('iprange')
     def del_pool(self, iprange_id):
-        self._del_prefix_item(POOLS, IP_RANGE, iprange_id)
+        self._del_prefix_item(POOLS, iprange_id)
 
-    @_autocommit
+    @_autocommit('ipaddress', id_arg=1)
     def set_reservation(self, prefix_id, ipaddr_id, resa_item):
         """ Replace host reservation or append a new one """
 
@@ -221,57 +873,57 @@ class DHCP4App:
                 raise TypeError(f'Missing mandatory reservation key: {k}')
 
         resa_item.setdefault(USR_CTX, {})[IP_ADDR] = ipaddr_id
+        addr = _address(resa_item['ip-address'])
 
-        def raise_conflict(r):
-            if r.get('hw-address') == resa_item['hw-address']:
+        def raise_conflict(sub):
+            sub.raise_outside(
+                addr, addr, f'address {resa_item["ip-address"]}')
+            if sub.conflicts('hw-address', resa_item['hw-address'],
+                             ipaddr_id):
+                raise DuplicateValue(
+                    f'duplicate hw-address={resa_item["hw-address"]}')
+            elif self.ip_uniqueness and sub.conflicts(
+                    'ip-address', resa_item['ip-address'], ipaddr_id):
                 raise DuplicateValue(
-                    f'duplicate hw-address={r["hw-address"]}')
-            elif (self.ip_uniqueness and r.get('ip-address') ==
-                    resa_item['ip-address']):
-                raise DuplicateValue(f'duplicate address={r["ip-address"]}')
+                    f'duplicate address={resa_item["ip-address"]}')
 
         self._set_subnet_item(
-            prefix_id, RESAS, IP_ADDR, ipaddr_id, resa_item, raise_conflict,
+            prefix_id, RESAS, ipaddr_id, resa_item, raise_conflict,
             resa_item['hw-address'])
 
-    @_autocommit
+    @_autocommit('ipaddress')
     def del_resa(self, ipaddr_id):
-        self._del_prefix_item(RESAS, IP_ADDR, ipaddr_id)
+        self._del_prefix_item(RESAS, ipaddr_id)
 
-    def _set_subnet_item(self, prefix_id, item_list, item_key, item_id, new,
+    def _set_subnet_item(self, prefix_id, item_list, item_id, new,
                          raise_conflict, display):
-        """ Replace either a pool or a host reservation """
-
-        for s in self.conf[SUBNETS]:
-            found = None
-            if s[PREFIX] == prefix_id:
-                # Prefix found
-                for i in s[item_list]:
-                    if i[USR_CTX][item_key] == item_id:
-                        found = i
-                    # Continue in order to check duplicates
-                    else:
-                        raise_conflict(i)
-
-                if found:
-                    logging.info(
-                        f'subnet {prefix_id} > {item_list} > ID {item_id}: '
-                        f'replace with {display}')
-                    found.clear()
-                    found.update(new)
-                else:
-                    logging.info(
-                        f'subnet {prefix_id} > {item_list}: add {display}, '
-                        f'ID {item_id}')
-                    s[item_list].append(new)
-                break
-        else:
+        """ Replace either a pool or a host reservation, unless unchanged """
+
+        try:
+            sub = self._subnets[prefix_id]
+        except KeyError:
             raise SubnetNotFound(f'subnet {prefix_id}')
 
-    def _del_prefix_item(self, item_list, item_key, item_id):
+        digest = _digest(new)
+        new[USR_CTX][HASH] = digest
+        current = sub.items[item_list].get(item_id)
+        if current is not None and _same_digest(current, digest):
+            logging.debug(f'subnet {prefix_id} > {item_list} > ID {item_id}: '
+                          'unchanged')
+            return
+
+        raise_conflict(sub)
+        if current is not None:
+            logging.info(f'subnet {prefix_id} > {item_list} > ID {item_id}: '
+                         f'replace with {display}')
+        else:
+            logging.info(f'subnet {prefix_id} > {item_list}: add {display}, '
+                         f'ID {item_id}')
+        self._put_item(prefix_id, item_list, item_id, new)
+
+    def _del_prefix_item(self, item_list, item_id):
         """ Delete item from all subnets. Silently ignore non-existent item """
 
         logging.info(f'{item_list}: delete resa {item_id} if it exists')
-        for s in self.conf[SUBNETS]:
-            s[item_list] = [
-                i for i in s[item_list] if i[USR_CTX][item_key] != item_id]
+        for prefix_id in list(self._item_subnets[item_list].get(item_id, ())):
+            self._pop_item(prefix_id, item_list, item_id)
@@ -22,5 +22,18 @@ class DuplicateValue(KeaClientError):
     pass
 
 
+class InvalidValue(KeaClientError):
+    pass
+
+
 class KeaCmdError(KeaClientError):
     pass
+
+
+class ChangesRejected(KeaCmdError):
+    """ Some changes were rejected by Kea, the other ones were committed """
+
+    def __init__(self, message, rejected):
+        super().__init__(message)
+        # (netbox model, ID) of rejected changes
+        self.rejected = rejected
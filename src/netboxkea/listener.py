@@ -1,15 +1,31 @@
 import logging
 from json.decoder import JSONDecodeError
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer
 
 import bottle
 
+from .connector import EVENT_MODELS
+from .events import EventQueue
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """ WSGI reference server handling each request in a thread """
+
+    daemon_threads = True
+
 
 class WebhookListener:
     """ Listen for netbox webhook requests and change DHCP configuration """
 
     def __init__(self, connector, host='127.0.0.1', port=8001, secret=None,
-                 secret_header=None):
+                 secret_header=None, debounce=1.0, server='threading',
+                 scheduler=None):
         self.conn = connector
+        self.server = server
+        self.queue = EventQueue(connector, debounce=debounce)
+        # Periodic syncs (SyncScheduler), run along with the web server
+        self.scheduler = scheduler
         self.host = host
         self.port = port
         self.secret = secret
@@ -49,20 +65,13 @@ class WebhookListener:
             except KeyError as e:
                 self._abort(400, f'request missing key: {e}')
 
-            try:
-                sync_func = getattr(self.conn, f'sync_{model}')
-            except AttributeError:
+            if model not in EVENT_MODELS:
                 self._abort(400, f'unsupported target "{model}"')
-            else:
-                logging.info(f'process event: {model} id={id_} {event}')
-                # Reload DHCP config before applying any changes
-                self.conn.reload_dhcp_config()
-                sync_func(id_)
-
-            bottle.response.status = 201
 
-            # Push change to DHCP server
-            self.conn.push_to_dhcp()
+            # Events are applied by batch in background
+            logging.info(f'queue event: {model} id={id_} {event}')
+            self.queue.put(model, id_)
+            bottle.response.status = 202
         
         # very basic health check, basically proves bottle is already/still running
         # enough for Kubernetes probes
@@ -70,8 +79,23 @@ class WebhookListener:
         def health():
             return 'ok'
 
-        # start server
-        bottle.run(host=self.host, port=self.port)
+        # start server. Requests don’t wait for DHCP config updates, which
+        # are made by the event queue thread.
+        if self.server == 'threading':
+            server_args = {'server': 'wsgiref',
+                           'server_class': ThreadingWSGIServer}
+        else:
+            # Any server supported by bottle (waitress, cheroot…)
+            server_args = {'server': self.server}
+        self.queue.start()
+        if self.scheduler is not None:
+            self.scheduler.start()
+        try:
+            bottle.run(host=self.host, port=self.port, **server_args)
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.stop()
+            self.queue.stop()
 
     def _abort(self, code, msg):
         logging.error(msg)
@@ -1,15 +1,71 @@
 import pynetbox
-from ipaddress import ip_interface, ip_network
+from pynetbox.core.app import App
+
+from .ip import network, to_int
+from .ipindex import PrefixIndex
+
+
+# Endpoints of objects assigned to IP addresses
+_ASSIGNED_ENDPOINTS = {
+    'dcim.interface': 'dcim.interfaces',
+    'virtualization.vminterface': 'virtualization.interfaces'}
+# Parent objects of assigned interfaces: (IP address assigned object type,
+# interface attribute, endpoint)
+_PARENT_ENDPOINTS = (
+    ('dcim.interface', 'device', 'dcim.devices'),
+    ('virtualization.vminterface', 'virtual_machine',
+     'virtualization.virtual_machines'))
+# Max number of IDs per query when fetching objects by batch
+_BATCH_SIZE = 200
+# Endpoint and object type of the models synced to DHCP
+_SYNCED_MODELS = {
+    'prefix': ('prefixes', 'ipam.prefix'),
+    'iprange': ('ip_ranges', 'ipam.iprange'),
+    'ipaddress': ('ip_addresses', 'ipam.ipaddress')}
+
+
+def _all(endpoint, filters):
+    """ Filter endpoint objects. Get them all if there is no filter """
+
+    return endpoint.filter(**filters) if filters else endpoint.all()
+
+
+def _not_found(error):
+    """ Tell if error is a "404 not found" HTTP error of a netbox client """
+
+    # pynetbox errors hold the response in "req", requests and httpx ones
+    # in "response"
+    for attr in ('response', 'req'):
+        resp = getattr(error, attr, None)
+        if resp is not None:
+            return getattr(resp, 'status_code', None) == 404
+    return False
 
 
 class NetboxApp:
 
     def __init__(self, url, token, prefix_filter={}, iprange_filter={},
-                 ipaddress_filter={'status': 'dhcp'}):
-        self.nb = pynetbox.api(url, token=token)
+                 ipaddress_filter={'status': 'dhcp'}, backend='pynetbox',
+                 concurrency=8, fields=None):
+        if backend == 'async':
+            from .netbox_async import AsyncNetboxAPI
+            self.nb = AsyncNetboxAPI(url, token, concurrency=concurrency)
+        elif backend == 'stream':
+            from .netbox_stream import StreamNetboxAPI
+            self.nb = StreamNetboxAPI(url, token, fields=fields)
+        elif backend == 'pynetbox':
+            self.nb = pynetbox.api(url, token=token)
+            if not hasattr(self.nb, 'core'):
+                # Older pynetbox versions don’t know this app
+                self.nb.core = App(self.nb, 'core')
+        else:
+            raise ValueError(f'unknown netbox backend "{backend}"')
         self.prefix_filter = prefix_filter
         self.iprange_filter = iprange_filter
         self.ipaddress_filter = ipaddress_filter
+        # Endpoint of the change log, which moved from extras to core app in
+        # netbox 4.1
+        self._changelog = None
 
     def prefix(self, id_):
         return self.nb.ipam.prefixes.get(id=id_, **self.prefix_filter)
@@ -19,7 +75,27 @@ class NetboxApp:
             **self.prefix_filter, contains=contains)
 
     def all_prefixes(self):
-        return self.nb.ipam.prefixes.filter(**self.prefix_filter)
+        return _all(self.nb.ipam.prefixes, self.prefix_filter)
+
+    def all_prefixes_with_children(self):
+        """
+        Yield each prefix with the list of its IP addresses and IP ranges.
+        All objects are fetched with one query per object type, then
+        addresses and ranges are assigned to their prefixes locally.
+        """
+
+        prefixes = list(self.all_prefixes())
+        index = PrefixIndex(prefixes)
+        children = {p.id: ([], []) for p in prefixes}
+        for i in _all(self.nb.ipam.ip_addresses, self.ipaddress_filter):
+            for p in index.lookup(i.address):
+                children[p.id][0].append(i)
+        for r in _all(self.nb.ipam.ip_ranges, self.iprange_filter):
+            for p in index.lookup_range(r.start_address, r.end_address):
+                children[p.id][1].append(r)
+
+        for p in prefixes:
+            yield p, *children[p.id]
 
     def ip_range(self, id_):
         return self.nb.ipam.ip_ranges.get(id=id_, **self.iprange_filter)
@@ -27,11 +103,11 @@ class NetboxApp:
     def ip_ranges(self, parent):
         # Emulate "parent" filter as NetBox API doesn’t support it on
         # ip-ranges objects (v3.4).
-        parent_net = ip_network(parent)
+        version, _, first, last = network(parent)
         for r in self.nb.ipam.ip_ranges.filter(
                 parent=parent, **self.iprange_filter):
-            if (ip_interface(r.start_address) in parent_net
-                    and ip_interface(r.end_address) in parent_net):
+            if (to_int(r.start_address) >= (version, first)
+                    and to_int(r.end_address) <= (version, last)):
                 yield r
 
     def ip_address(self, id_):
@@ -44,3 +120,112 @@ class NetboxApp:
         for i in self.nb.ipam.ip_addresses.filter(
                 **self.ipaddress_filter, **filters):
             yield i
+
+    def updated_since(self, model, since):
+        """
+        Yield (ID, object) of the objects of model ("prefix", "iprange" or
+        "ipaddress") updated since time (ISO 8601 string). Object is None if
+        it doesn’t match the filters, as an update may put it out of them.
+        """
+
+        endpoint = getattr(self.nb.ipam, _SYNCED_MODELS[model][0])
+        filters = {'prefix': self.prefix_filter,
+                   'iprange': self.iprange_filter,
+                   'ipaddress': self.ipaddress_filter}[model]
+        objs = {o.id: o for o in endpoint.filter(last_updated__gte=since)}
+        if filters:
+            matched = {o.id for o in endpoint.filter(
+                last_updated__gte=since, **filters)}
+            objs = {id_: o if id_ in matched else None
+                    for id_, o in objs.items()}
+        yield from objs.items()
+
+    def deleted_since(self, since):
+        """
+        Yield (model, ID, time) of the prefixes, IP ranges and IP addresses
+        deleted since time (ISO 8601 string), according to netbox change log
+        """
+
+        for model, (_, obj_type) in _SYNCED_MODELS.items():
+            for change in self._object_changes(
+                    changed_object_type=obj_type, action='delete',
+                    time_after=since):
+                yield model, change.changed_object_id, change.time
+
+    def last_change_time(self):
+        """
+        Return the time (ISO 8601 string) of the latest change in netbox
+        change log, None if it is empty
+        """
+
+        # Only the first page, of one change
+        changes = self._object_changes(ordering='-time', limit=1, offset=0)
+        return changes[0].time if changes else None
+
+    def _object_changes(self, **filters):
+        if self._changelog is not None:
+            return list(self._changelog.filter(**filters))
+        try:
+            changes = list(self.nb.core.object_changes.filter(**filters))
+            self._changelog = self.nb.core.object_changes
+        except Exception as e:
+            if not _not_found(e):
+                raise
+            changes = list(self.nb.extras.object_changes.filter(**filters))
+            self._changelog = self.nb.extras.object_changes
+        return changes
+
+    def prefetch_assigned_objects(self, ipaddrs, relations, cache):
+        """
+        Replace the nested objects assigned to IP addresses by their full
+        version, fetched by batch of IDs, so that reading attributes not
+        included in nested objects doesn’t trigger one query per address.
+        Relations is a set of "assigned_object", "assigned_object.device"
+        and "assigned_object.virtual_machine". Fetched objects are kept in
+        cache dictionary. Return IP addresses as a list.
+        """
+
+        ipaddrs = list(ipaddrs)
+        assigned = [i for i in ipaddrs if i.assigned_object]
+        if 'assigned_object' in relations:
+            self._prefetch(
+                assigned, 'assigned_object',
+                lambda i: _ASSIGNED_ENDPOINTS.get(i.assigned_object_type),
+                cache)
+        for obj_type, attr, endpoint in _PARENT_ENDPOINTS:
+            if f'assigned_object.{attr}' in relations:
+                self._prefetch(
+                    [i.assigned_object for i in assigned
+                     if i.assigned_object_type == obj_type], attr,
+                    lambda o: endpoint, cache)
+        return ipaddrs
+
+    def _prefetch(self, objs, attr, endpoint_of, cache):
+        """ Replace nested object attr of each object by the full object """
+
+        ids = {}
+        for o in objs:
+            endpoint, nested = endpoint_of(o), getattr(o, attr)
+            if endpoint and nested:
+                ids.setdefault(endpoint, set()).add(nested.id)
+        for endpoint, id_set in ids.items():
+            self._fetch(endpoint, id_set, cache)
+
+        for o in objs:
+            endpoint, nested = endpoint_of(o), getattr(o, attr)
+            if endpoint and nested:
+                full = cache[endpoint].get(nested.id)
+                if full is not None:
+                    setattr(o, attr, full)
+
+    def _fetch(self, endpoint, ids, cache):
+        """ Fetch objects by batch of IDs, skipping those already cached """
+
+        objs = cache.setdefault(endpoint, {})
+        missing = sorted(i for i in ids if i not in objs)
+        app, name = endpoint.split('.')
+        ep = getattr(getattr(self.nb, app), name)
+        for n in range(0, len(missing), _BATCH_SIZE):
+            for o in ep.filter(id=missing[n:n + _BATCH_SIZE]):
+                objs[o.id] = o
+        return objs
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+try:
+    import httpx
+except ModuleNotFoundError:
+    httpx = None
+
+from .netbox_rest import App, unique_records
+
+
+class Endpoint:
+    """ Synchronous endpoint with the get/filter/all methods of pynetbox """
+
+    def __init__(self, api, path):
+        self.api = api
+        self.path = path
+
+    def get(self, **filters):
+        return self.api.run(self.api.get(self.path, **filters))
+
+    def filter(self, **filters):
+        return self.api.run(self.api.filter(self.path, **filters))
+
+    def all(self):
+        return self.filter()
+
+
+class AsyncNetboxAPI:
+    """
+    Netbox REST API client based on asyncio and httpx. Pages of a query are
+    fetched concurrently with offset/limit parameters, on a pool of at most
+    "concurrency" connections.
+
+    Coroutines run on an event loop of a dedicated thread, so that the
+    client is also usable from synchronous code, with the same endpoint
+    interface as pynetbox (nb.ipam.prefixes.filter(…)), from any thread.
+    """
+
+    def __init__(self, url, token, concurrency=8, page_size=1000,
+                 timeout=30):
+        self.url = url.rstrip('/') + '/api/'
+        self.token = token
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.timeout = timeout
+        self._client = None
+        self.ipam = App(self, 'ipam')
+        self.dcim = App(self, 'dcim')
+        self.virtualization = App(self, 'virtualization')
+        self.core = App(self, 'core')
+        self.extras = App(self, 'extras')
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name='netboxkea-netbox',
+            daemon=True)
+        self._thread.start()
+        try:
+            self.run(self._start())
+        except Exception:
+            self._stop_loop()
+            raise
+
+    async def _start(self):
+        # Semaphore and client are bound to the event loop
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._client = self._mk_client()
+
+    def _mk_client(self):
+        if httpx is None:
+            raise ModuleNotFoundError(
+                'async netbox backend requires httpx (pip install httpx)')
+        return httpx.AsyncClient(
+            base_url=self.url, timeout=self.timeout,
+            headers={'Authorization': f'Token {self.token}',
+                     'Accept': 'application/json'},
+            limits=httpx.Limits(max_connections=self.concurrency,
+                                max_keepalive_connections=self.concurrency))
+
+    def endpoint(self, name, path):
+        return Endpoint(self, path)
+
+    def run(self, coro):
+        """ Run coroutine on the client event loop and return its result """
+
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def close(self):
+        if self._client is not None:
+            self.run(self._client.aclose())
+        self._stop_loop()
+
+    def _stop_loop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _get(self, path, params):
+        async with self._semaphore:
+            return await self._request(path, params)
+
+    async def _request(self, path, params):
+        resp = await self._client.get(path, params=params)
+        resp.raise_for_status()
+        return resp.json()
+
+    async def filter(self, path, **filters):
+        """
+        Return the list of all objects matching filters, or of one page only
+        if an offset is given (as pynetbox does)
+        """
+
+        params = dict({'limit': self.page_size}, **filters)
+        if 'offset' in filters:
+            return list(unique_records([await self._get(path, params)]))
+        first = await self._get(path, dict(params, offset=0))
+        # Netbox may serve less objects per page than asked (MAX_PAGE_SIZE)
+        size = len(first['results'])
+        offsets = range(size, first['count'], size) if size else ()
+        pages = [first] + list(await asyncio.gather(*(
+            self._get(path, dict(params, offset=o)) for o in offsets)))
+        return list(unique_records(pages))
+
+    async def get(self, path, **filters):
+        """ Return the object matching filters, or None """
+
+        objs = await self.filter(path, **filters)
+        return objs[0] if objs else None
@@ -0,0 +1,29 @@
+from .record import Record
+
+
+class App:
+    """
+    Netbox application (ipam, dcim…) giving access to the endpoints of a
+    REST API client, built by its endpoint(name, path) method
+    """
+
+    def __init__(self, api, name):
+        self._api = api
+        self._name = name
+
+    def __getattr__(self, name):
+        return self._api.endpoint(
+            f'{self._name}.{name}', f'{self._name}/{name.replace("_", "-")}/')
+
+
+def unique_records(pages):
+    """ Yield records of the objects of API result pages """
+
+    seen = set()
+    for page in pages:
+        for values in page['results']:
+            # Objects created or deleted between page queries may shift
+            # offsets: drop duplicates.
+            if values['id'] not in seen:
+                seen.add(values['id'])
+                yield Record(values)
@@ -0,0 +1,79 @@
+import requests
+
+from .netbox_rest import App, unique_records
+
+
+class Endpoint:
+    """ Endpoint with the get/filter/all methods of pynetbox """
+
+    def __init__(self, api, path, fields):
+        self.api = api
+        self.path = path
+        self.fields = fields
+
+    def get(self, **filters):
+        for o in self.filter(**filters):
+            return o
+        return None
+
+    def filter(self, **filters):
+        if self.fields:
+            filters['fields'] = ','.join(sorted(self.fields))
+        return self.api.filter(self.path, **filters)
+
+    def all(self):
+        return self.filter()
+
+
+class StreamNetboxAPI:
+    """
+    Netbox REST API client yielding slim records page by page, instead of
+    building lists of pynetbox records, so that memory doesn’t grow with the
+    number of objects.
+
+    Fields is a dictionary of endpoint ("ipam.prefixes"…) → names of the
+    object fields to fetch, sent with the "fields" query parameter (netbox
+    ≥ 4.0, ignored by older versions). Other endpoints return all fields.
+    """
+
+    def __init__(self, url, token, fields=None, page_size=1000, timeout=30):
+        self.url = url.rstrip('/') + '/api/'
+        self.fields = fields or {}
+        self.page_size = page_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Token {token}', 'Accept': 'application/json'})
+        self.ipam = App(self, 'ipam')
+        self.dcim = App(self, 'dcim')
+        self.virtualization = App(self, 'virtualization')
+        self.core = App(self, 'core')
+        self.extras = App(self, 'extras')
+
+    def endpoint(self, name, path):
+        return Endpoint(self, path, self.fields.get(name))
+
+    def _request(self, path, params):
+        resp = self.session.get(
+            self.url + path, params=params, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    def filter(self, path, **filters):
+        """
+        Yield objects matching filters, fetching one page at a time. Only
+        one page is fetched if an offset is given (as pynetbox does).
+        """
+
+        return unique_records(self._pages(path, filters))
+
+    def _pages(self, path, filters):
+        params = dict({'limit': self.page_size}, **filters)
+        offset = params.get('offset', 0)
+        while True:
+            page = self._request(path, dict(params, offset=offset))
+            yield page
+            offset += len(page['results'])
+            if ('offset' in filters or not page['results']
+                    or offset >= page['count']):
+                return
@@ -0,0 +1,23 @@
+def _to_record(value):
+    """ Convert nested netbox objects (dicts with an ID) to records """
+
+    if isinstance(value, dict) and 'id' in value:
+        return Record(value)
+    elif isinstance(value, list):
+        return [_to_record(v) for v in value]
+    return value
+
+
+class Record:
+    """ Netbox object with attribute access, a slim pynetbox record """
+
+    def __init__(self, values):
+        for k, v in values.items():
+            setattr(self, k, _to_record(v))
+
+    def __str__(self):
+        return str(getattr(self, 'display', None) or getattr(
+            self, 'name', None) or '')
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self}>'
@@ -0,0 +1,81 @@
+import logging
+import random
+import threading
+from time import monotonic
+
+from .connector import SyncTimeout
+
+
+class Job:
+    """
+    Sync run every "interval" seconds, plus a random delay of up to "jitter"
+    seconds. Func is called with blocking and budget keyword arguments (see
+    Connector.sync_all).
+    """
+
+    def __init__(self, name, func, interval, jitter=0.0, budget=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.budget = budget
+        self.next_run = None
+
+    def schedule(self):
+        self.next_run = (
+            monotonic() + self.interval + random.uniform(0, self.jitter))
+
+
+class SyncScheduler:
+    """
+    Run sync jobs periodically, in a background thread or in the foreground.
+
+    A job is skipped if another sync or an event batch is in progress, and
+    aborted without pushing anything if it lasts longer than its budget: in
+    both cases, it waits for its next run.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self.run, name='netboxkea-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop running jobs, waiting for the current one to finish """
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        for job in self.jobs:
+            job.schedule()
+        while self.jobs:
+            job = min(self.jobs, key=lambda j: j.next_run)
+            with self._cond:
+                if self._cond.wait_for(
+                        lambda: self._stopping, job.next_run - monotonic()):
+                    return
+            self._run_job(job)
+            job.schedule()
+
+    def _run_job(self, job):
+        logging.info(f'start scheduled {job.name} sync')
+        try:
+            if job.func(blocking=False, budget=job.budget) is False:
+                logging.warning(f'scheduled {job.name} sync skipped: another '
+                                'sync or event batch is in progress')
+        except SyncTimeout:
+            logging.error(f'scheduled {job.name} sync aborted: it lasted '
+                          f'more than {job.budget} s')
+        except Exception:
+            logging.exception(f'scheduled {job.name} sync failed')
@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import threading
+from collections import namedtuple
+
+# State of a netbox object pushed to Kea: IDs of prefixes whose subnets hold
+# the object item, the item, its hash and the netbox last update time of the
+# object (None if unknown)
+ObjectState = namedtuple(
+    'ObjectState', ('prefixes', 'item', 'hash', 'last_updated'))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    model TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    prefixes TEXT NOT NULL,
+    item TEXT NOT NULL,
+    hash TEXT,
+    last_updated TEXT,
+    PRIMARY KEY (model, id));
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL);
+"""
+
+
+class StateStore:
+    """
+    Persistent state of the netbox objects pushed to Kea, in a SQLite
+    database, by (netbox model, ID). Metadata (like the time of the last
+    sync) are kept as JSON values by key.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM objects').fetchone()[0]
+
+    def get(self, model, id_):
+        """ Return the ObjectState of an object, or None if unknown """
+
+        with self._lock:
+            row = self._db.execute(
+                'SELECT prefixes, item, hash, last_updated FROM objects '
+                'WHERE model = ? AND id = ?', (model, id_)).fetchone()
+        if row is None:
+            return None
+        prefixes, item, hash_, last_updated = row
+        return ObjectState(
+            json.loads(prefixes), json.loads(item), hash_, last_updated)
+
+    def update(self, objects):
+        """
+        Record objects, given as a dictionary of (model, ID) → ObjectState,
+        or None to forget the object, in one transaction
+        """
+
+        puts, dels = [], []
+        for (model, id_), state in objects.items():
+            if state is None:
+                dels.append((model, id_))
+            else:
+                puts.append((
+                    model, id_, json.dumps(state.prefixes),
+                    json.dumps(state.item, separators=(',', ':')),
+                    state.hash, state.last_updated))
+        with self._lock, self._db:
+            self._db.executemany(
+                'DELETE FROM objects WHERE model = ? AND id = ?', dels)
+            self._db.executemany(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+                puts)
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_meta(self, key, value):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             (key, json.dumps(value)))
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,85 @@
+"""
+Benchmark commit and rollback cost against configuration size.
+
+Each round changes one reservation (with a new hardware address, as setting
+the same one is not a change) of a configuration holding a growing number of
+subnets, then commits it (or rolls it back). The Kea server check is
+replaced by a no-op, so that only the cost of DHCP4App bookkeeping is
+measured. Snapshotting the configuration with deepcopy, as done before the
+undo journal, is shown for comparison.
+
+Usage: python tests/benchmarks/bench_commit.py
+"""
+
+import logging
+import timeit
+from copy import deepcopy
+from itertools import count
+
+from netboxkea.kea.app import DHCP4App
+from netboxkea.kea.exceptions import KeaCmdError
+
+RESAS_PER_SUBNET = 50
+ROUNDS = 200
+
+
+def mk_app(nb_subnets):
+    kea = DHCP4App('file://')
+    kea.pull()
+    kea.auto_commit = False
+    kea.api.raise_conf_error = lambda conf: None
+    for p in range(nb_subnets):
+        kea.set_subnet(p, {'subnet': f'10.{p // 256}.{p % 256}.0/24'})
+        for r in range(RESAS_PER_SUBNET):
+            kea.set_reservation(p, p * 1000 + r, {
+                'ip-address': f'10.{p // 256}.{p % 256}.{r + 1}',
+                'hw-address': f'00:00:00:{p // 256:02x}:{p % 256:02x}:{r:02x}'
+                })
+    kea.commit()
+    return kea
+
+
+def change(kea, nb_subnets, n):
+    p = nb_subnets // 2
+    kea.set_reservation(p, p * 1000, {
+        'ip-address': f'10.{p // 256}.{p % 256}.1',
+        'hw-address': f'ff:ff:ff:{n >> 16 & 0xff:02x}:{n >> 8 & 0xff:02x}:'
+                      f'{n & 0xff:02x}'})
+    assert kea._journal, 'no change to commit'
+
+
+def reject(conf):
+    raise KeaCmdError('rejected')
+
+
+def main():
+    logging.disable()
+    print(f'{"subnets":>8} {"commit (µs)":>12} {"rollback (µs)":>14} '
+          f'{"deepcopy (µs)":>14}')
+    for nb_subnets in (250, 500, 1000, 2000, 4000):
+        kea = mk_app(nb_subnets)
+        rounds = count()
+
+        def commit():
+            change(kea, nb_subnets, next(rounds))
+            kea.commit()
+
+        t_commit = timeit.timeit(commit, number=ROUNDS) / ROUNDS
+
+        kea.api.raise_conf_error = reject
+
+        def rollback():
+            change(kea, nb_subnets, next(rounds))
+            try:
+                kea.commit()
+            except KeaCmdError:
+                pass
+
+        t_rollback = timeit.timeit(rollback, number=ROUNDS) / ROUNDS
+        t_copy = timeit.timeit(lambda: deepcopy(kea.conf), number=1)
+        print(f'{nb_subnets:>8} {t_commit * 1e6:>12.1f} '
+              f'{t_rollback * 1e6:>14.1f} {t_copy * 1e6:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark the integer IP helpers of netboxkea.ip against ipaddress objects.
+
+200k netbox-like IP addresses and ranges are converted to reservation and
+pool addresses, checked against a list of prefixes and filtered by parent
+prefix, first with ipaddress objects (as done before the integer helpers),
+then with the netboxkea.ip integer helpers. Both sides use the same
+algorithms (linear scans), so that only the address handling is measured.
+
+Usage: python tests/benchmarks/bench_ip.py (from repository root)
+"""
+
+import timeit
+from ipaddress import ip_interface, ip_network
+
+from netboxkea.ip import host, network, to_int
+
+NB_ADDRESSES = 200_000
+
+
+def old_paths(addresses, ranges, prefixes, parent):
+    """ Former conversions and checks, with ipaddress objects """
+
+    # Reservation and pool addresses
+    resas = [str(ip_interface(a).ip) for a in addresses]
+    pools = [f'{ip_interface(s).ip}-{ip_interface(e).ip}' for s, e in ranges]
+    # Prefixes containing each address
+    nets = [ip_network(p) for p in prefixes]
+    parents = [[n.prefixlen for n in nets if ip_interface(a).ip in n]
+               for a in addresses]
+    # Ranges of parent prefix
+    parent_net = ip_network(parent)
+    children = [r for r in ranges if ip_interface(r[0]) in parent_net
+                and ip_interface(r[1]) in parent_net]
+    return resas, pools, parents, children
+
+
+def new_paths(addresses, ranges, prefixes, parent):
+    """ Same conversions and checks, with integer helpers """
+
+    resas = [host(a) for a in addresses]
+    pools = [f'{host(s)}-{host(e)}' for s, e in ranges]
+    nets = [network(p) for p in prefixes]
+    parents = []
+    for a in addresses:
+        version, addr = to_int(a)
+        parents.append([plen for v, plen, first, last in nets
+                        if v == version and first <= addr <= last])
+    version, _, first, last = network(parent)
+    children = [r for r in ranges if to_int(r[0]) >= (version, first)
+                and to_int(r[1]) <= (version, last)]
+    return resas, pools, parents, children
+
+
+def main():
+    # 200k addresses in 10.0.0.0/14, with one /16 prefix every 65536
+    # addresses and ranges of 4 addresses every 16 addresses
+    addresses = [f'10.{n >> 16}.{(n >> 8) & 0xff}.{n & 0xff}/16'
+                 for n in range(NB_ADDRESSES)]
+    ranges = [(addresses[n], addresses[n + 3])
+              for n in range(0, NB_ADDRESSES - 3, 16)]
+    prefixes = ['10.0.0.0/8'] + [
+        f'10.{n}.0.0/16' for n in range(NB_ADDRESSES >> 16 | 1)]
+    args = addresses, ranges, prefixes, '10.1.0.0/16'
+
+    assert old_paths(*args) == new_paths(*args)
+    t_old = timeit.timeit(lambda: old_paths(*args), number=1)
+    t_new = timeit.timeit(lambda: new_paths(*args), number=1)
+    print(f'{NB_ADDRESSES} addresses, ipaddress objects: {t_old:.3f} s')
+    print(f'{NB_ADDRESSES} addresses, integers: {t_new:.3f} s '
+          f'({t_old / t_new:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark conversion of netbox IP addresses to DHCP reservations.
+
+The default reservation map is applied to 100k pynetbox records built from
+the test fixtures, first by parsing the map for each object (as done before
+maps were compiled), then with the compiled map.
+
+Usage: python tests/benchmarks/bench_mapping.py (from repository root)
+"""
+
+import sys
+import timeit
+from os.path import abspath, dirname, join
+
+from netboxkea.config import Config
+from netboxkea.connector import _compile_map, _mk_dhcp_item
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..', '..')))
+from tests.fixtures.pynetbox import ip_addresses as fixtip  # noqa: E402
+
+NB_OBJECTS = 100_000
+
+
+def get_nested(obj, attrs, sep='.'):
+    """ Former netbox attribute getter, splitting attrs on each call """
+
+    value = obj
+    for a in attrs.split(sep):
+        try:
+            value = getattr(value, a)
+        except AttributeError:
+            value = value[a]
+    return value
+
+
+def set_dhcp_attr(dhcp_item, key, value):
+    """ Former DHCP attribute setter, parsing key on each call """
+
+    k1, _, k2 = key.partition('.')
+    if not k2:
+        dhcp_item[key] = value
+    elif k1 in ['option-data']:
+        dhcp_item.setdefault(k1, []).append({'name': k2, 'data': value})
+    else:
+        dhcp_item.setdefault(k1, {})[k2] = value
+
+
+def parse_and_map(nb_obj, mapping):
+    """ Former _mk_dhcp_item, parsing the map for each object """
+
+    dhcp_item = {}
+    for dhcp_attr, nb_attr in mapping.items():
+        attrs = [nb_attr] if isinstance(nb_attr, str) else nb_attr
+        value = None
+        for a in attrs:
+            try:
+                value = get_nested(nb_obj, a)
+            except (TypeError, KeyError):
+                continue
+            if value:
+                break
+        if value is not None:
+            set_dhcp_attr(dhcp_item, dhcp_attr, value)
+    return dhcp_item
+
+
+def main():
+    mapping = Config().reservation_ipaddr_map
+    mapping['option-data.host-name'] = 'dns_name'
+    fixtures = fixtip.ALL_IP
+    ipaddrs = [type(f)(dict(f), fixtip.api, None) for f in (
+        fixtures[n % len(fixtures)] for n in range(NB_OBJECTS))]
+
+    t_parse = timeit.timeit(
+        lambda: [parse_and_map(i, mapping) for i in ipaddrs], number=1)
+    plan = _compile_map(mapping)
+    t_plan = timeit.timeit(
+        lambda: [_mk_dhcp_item(i, plan) for i in ipaddrs], number=1)
+    print(f'{NB_OBJECTS} objects, map parsed for each object: '
+          f'{t_parse:.3f} s')
+    print(f'{NB_OBJECTS} objects, compiled map: {t_plan:.3f} s '
+          f'({t_parse / t_plan:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
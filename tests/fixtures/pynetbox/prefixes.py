@@ -44,3 +44,10 @@ _pref_101.update({
     'id': 101,
     'prefix': '10.0.0.0/8'})
 prefix_101 = Prefixes(_pref_101, api, None)
+
+_pref_102 = _common.copy()
+_pref_102.update({
+    'display': '10.0.0.0/24',
+    'id': 102,
+    'prefix': '10.0.0.0/24'})
+prefix_102 = Prefixes(_pref_102, api, None)
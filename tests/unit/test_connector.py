@@ -1,8 +1,17 @@
 import unittest
+from copy import copy, deepcopy
+from types import SimpleNamespace as NS
 from unittest.mock import Mock, call
 
-from netboxkea.connector import _get_nested, _set_dhcp_attr, Connector
-from netboxkea.kea.exceptions import SubnetNotFound
+from netboxkea.connector import (
+    _compile_map, _mk_dhcp_item, _mk_getter, _mk_setter, _related_objects,
+    Connector, netbox_fields, SyncTimeout)
+from netboxkea.kea.app import DHCP4App
+from netboxkea.kea.exceptions import (
+    ChangesRejected, KeaCmdError, KeaServerError, SubnetNotFound)
+from netboxkea.netbox import NetboxApp
+from netboxkea.record import Record
+from netboxkea.state import StateStore
 from ..fixtures.pynetbox import ip_addresses as fixtip
 from ..fixtures.pynetbox import ip_ranges as fixtr
 from ..fixtures.pynetbox import prefixes as fixtp
@@ -10,18 +19,18 @@ from ..fixtures.pynetbox import prefixes as fixtp
 
 class TestConnectorFunctions(unittest.TestCase):
 
-    def test_01_get_nested_attr(self):
+    def test_01_nested_getter(self):
         obj = {'assigned': {'device': {'name': 'pc.lan'}}}
-        hostname = _get_nested(obj, 'assigned.device.name')
+        hostname = _mk_getter('assigned.device.name')(obj)
         self.assertEqual(hostname, 'pc.lan')
 
-    def test_02_set_dhcp_attr(self):
+    def test_02_setter(self):
         dhcp_item = {}
-        _set_dhcp_attr(dhcp_item, 'next-server', '10.0.0.1')
-        _set_dhcp_attr(dhcp_item, 'option-data.routers', '192.168.0.254')
-        _set_dhcp_attr(dhcp_item, 'option-data.domain-search', 'lan')
-        _set_dhcp_attr(dhcp_item, 'user-context.desc', 'Test')
-        _set_dhcp_attr(dhcp_item, 'user-context.note', 'Hello')
+        _mk_setter('next-server')(dhcp_item, '10.0.0.1')
+        _mk_setter('option-data.routers')(dhcp_item, '192.168.0.254')
+        _mk_setter('option-data.domain-search')(dhcp_item, 'lan')
+        _mk_setter('user-context.desc')(dhcp_item, 'Test')
+        _mk_setter('user-context.note')(dhcp_item, 'Hello')
         self.assertEqual(dhcp_item, {
             'next-server': '10.0.0.1',
             'option-data': [
@@ -29,6 +38,65 @@ class TestConnectorFunctions(unittest.TestCase):
                 {'name': 'domain-search', 'data': 'lan'}],
             'user-context': {'desc': 'Test', 'note': 'Hello'}})
 
+    def test_03_getter(self):
+        get = _mk_getter('assigned.device.name')
+        self.assertEqual(get(NS(assigned={'device': NS(name='pc')})), 'pc')
+        # Learnt accessors are reused, then learnt again if they fail
+        self.assertEqual(get(NS(assigned={'device': NS(name='pc2')})), 'pc2')
+        self.assertEqual(get(NS(assigned=NS(device={'name': 'pc3'}))), 'pc3')
+        with self.assertRaises(TypeError):
+            get(NS(assigned=None))
+
+    def test_04_mk_dhcp_item(self):
+        plan = _compile_map({
+            'hw-address': ['custom_fields.hw', 'assigned.mac_address'],
+            'option-data.routers': 'custom_fields.routers',
+            'hostname': 'dns_name'})
+        item = _mk_dhcp_item(NS(
+            custom_fields={'hw': None, 'routers': '10.0.0.1'},
+            assigned=None, dns_name='pc.lan'), plan)
+        self.assertEqual(item, {
+            'option-data': [{'name': 'routers', 'data': '10.0.0.1'}],
+            'hostname': 'pc.lan'})
+        item = _mk_dhcp_item(NS(
+            custom_fields={'hw': None, 'routers': None},
+            assigned=NS(mac_address='11:11:11:11:11:11'), dns_name=''), plan)
+        self.assertEqual(
+            item, {'hw-address': '11:11:11:11:11:11', 'hostname': ''})
+
+    def test_05_related_objects(self):
+        related = _related_objects({
+            'hw-address': ['custom_fields.hw', 'assigned_object.mac_address'],
+            'hostname': ['dns_name', 'assigned_object.device.name',
+                         'assigned_object.virtual_machine.name']})
+        self.assertEqual(related, {'assigned_object'})
+        related = _related_objects({
+            'hostname': 'assigned_object.name',
+            'user-context.serial': 'assigned_object.device.serial'})
+        self.assertEqual(related, {'assigned_object.device'})
+
+    def test_06_netbox_fields(self):
+        fields = netbox_fields(
+            {'option-data.routers': 'custom_fields.dhcp_routers'}, {}, {
+                'hw-address': ['custom_fields.hw',
+                               'assigned_object.mac_address'],
+                'hostname': ['dns_name', 'assigned_object.device.name'],
+                'user-context.serial': 'assigned_object.device.serial'})
+        self.assertEqual(fields['ipam.prefixes'],
+                         {'id', 'display', 'last_updated', 'prefix',
+                          'custom_fields'})
+        self.assertEqual(fields['ipam.ip_ranges'],
+                         {'id', 'display', 'last_updated', 'start_address',
+                          'end_address'})
+        self.assertLessEqual({'custom_fields', 'dns_name', 'assigned_object'},
+                             fields['ipam.ip_addresses'])
+        self.assertLessEqual({'mac_address', 'device'},
+                             fields['dcim.interfaces'])
+        self.assertEqual(fields['dcim.devices'],
+                         {'id', 'display', 'name', 'serial'})
+        self.assertEqual(fields['virtualization.virtual_machines'],
+                         {'id', 'display', 'name'})
+
 
 class TestConnector(unittest.TestCase):
 
@@ -52,6 +120,9 @@ class TestConnector(unittest.TestCase):
         self.nb.ip_ranges.return_value = iter([fixtr.ip_range_250])
         self.nb.ip_address.side_effect = fixtip.get
         self.nb.ip_addresses.side_effect = fixtip.filter_
+        self.nb.prefetch_assigned_objects.side_effect = (
+            lambda ipaddrs, *args: list(ipaddrs))
+        self.nb.last_change_time.return_value = '2023-01-02T08:00:00.000000Z'
 
         # Define kea calls
         self.call_subnet100 = call(100, {'subnet': '192.168.0.0/24'})
@@ -68,32 +139,60 @@ class TestConnector(unittest.TestCase):
         self.call_resa250 = call(100, 250, {
             'ip-address': '10.0.0.50', 'hw-address': '55:55:55:55:55:55',
             'hostname': 'vm.lan10'})
+        self.call_resa250_in_101 = call(101, 250, {
+            'ip-address': '10.0.0.50', 'hw-address': '55:55:55:55:55:55',
+            'hostname': 'vm.lan10'})
         self.call_pool250 = call(100, 250, {
             'pool': '192.168.0.100-192.168.0.199'})
 
     def test_01_sync_ip_address_with_assigned_interface(self):
         self.conn.sync_ipaddress(200)
         self.nb.ip_address.assert_called_once_with(200)
-        self.nb.prefixes.assert_called_once_with(contains='192.168.0.1/24')
+        self.nb.all_prefixes.assert_called_once()
         self.kea.set_reservation.assert_has_calls([self.call_resa200])
 
     def test_02_sync_ip_address_with_custom_field(self):
         self.conn.sync_ipaddress(201)
         self.nb.ip_address.assert_called_once_with(201)
-        self.nb.prefixes.assert_called_once_with(contains='192.168.0.2/24')
+        self.nb.all_prefixes.assert_called_once()
         self.kea.set_reservation.assert_has_calls([self.call_resa201])
 
     def test_03_sync_ip_address_with_assigned_and_custom_field(self):
         self.conn.sync_ipaddress(202)
         self.nb.ip_address.assert_called_once_with(202)
-        self.nb.prefixes.assert_called_once_with(contains='192.168.0.3/24')
+        self.nb.all_prefixes.assert_called_once()
         self.kea.set_reservation.assert_has_calls([self.call_resa202])
 
     def test_05_sync_ip_address_vm(self):
+        self.nb.all_prefixes.return_value = iter(
+            [fixtp.prefix_100, fixtp.prefix_101])
         self.conn.sync_ipaddress(250)
         self.nb.ip_address.assert_called_once_with(250)
-        self.nb.prefixes.assert_called_once_with(contains='10.0.0.50/8')
-        self.kea.set_reservation.assert_has_calls([self.call_resa250])
+        self.nb.all_prefixes.assert_called_once()
+        self.kea.set_reservation.assert_has_calls([self.call_resa250_in_101])
+
+    def test_06_sync_ip_address_slim_record(self):
+        # Slim records don’t fetch related objects on attribute access
+        nbapp = NetboxApp('http://netbox', 'token')
+        nbapp.nb = Mock()
+        ipam, dcim = nbapp.nb.ipam, nbapp.nb.dcim
+        ipam.ip_addresses.get.return_value = Record({
+            'id': 5, 'address': '192.168.0.5/24', 'dns_name': 'pc5.lan',
+            'assigned_object_type': 'dcim.interface', 'assigned_object_id': 3,
+            'assigned_object': {'id': 3, 'name': 'eth0'}})
+        ipam.prefixes.all.return_value = iter([Record({
+            'id': 100, 'prefix': '192.168.0.0/24'})])
+        dcim.interfaces.filter.return_value = iter([Record({
+            'id': 3, 'name': 'eth0', 'mac_address': '55:55:55:55:55:55'})])
+        conn = Connector(nbapp, self.kea, {}, {}, {
+            'hw-address': 'assigned_object.mac_address',
+            'hostname': 'dns_name'})
+        conn.sync_ipaddress(5)
+        dcim.interfaces.filter.assert_called_once_with(id=[3])
+        self.kea.set_reservation.assert_called_once_with(100, 5, {
+            'ip-address': '192.168.0.5', 'hw-address': '55:55:55:55:55:55',
+            'hostname': 'pc5.lan'})
+        self.kea.del_resa.assert_not_called()
 
     def test_09_sync_ip_address_del(self):
         self.conn.sync_ipaddress(249)
@@ -110,15 +209,49 @@ class TestConnector(unittest.TestCase):
         self.nb.ip_addresses.assert_called_once_with(device_id=400)
         self.kea.set_reservation.assert_has_calls([self.call_resa200])
 
+    def test_12_sync_device_batch(self):
+        self.nb.ip_addresses.side_effect = lambda **kw: iter(
+            [fixtip.ip_address_200, fixtip.ip_address_201])
+        self.conn.sync_device(400)
+        # IP addresses are neither fetched again nor looked up one by one
+        self.nb.ip_address.assert_not_called()
+        self.nb.prefixes.assert_not_called()
+        self.nb.all_prefixes.assert_called_once()
+        self.nb.prefetch_assigned_objects.assert_called_once()
+        self.kea.set_reservation.assert_has_calls(
+            [self.call_resa200, self.call_resa201])
+        self.kea.commit.assert_called_once()
+        self.assertIs(self.kea.auto_commit, True)
+
     def test_15_sync_vminterface(self):
+        self.nb.all_prefixes.return_value = iter([fixtp.prefix_101])
         self.conn.sync_vminterface(350)
         self.nb.ip_addresses.assert_called_once_with(vminterface_id=350)
-        self.kea.set_reservation.assert_has_calls([self.call_resa250])
+        self.kea.set_reservation.assert_has_calls([self.call_resa250_in_101])
 
     def test_16_sync_virtualmachine(self):
+        self.nb.all_prefixes.return_value = iter([fixtp.prefix_101])
         self.conn.sync_virtualmachine(450)
         self.nb.ip_addresses.assert_called_once_with(virtual_machine_id=450)
-        self.kea.set_reservation.assert_has_calls([self.call_resa250])
+        self.kea.set_reservation.assert_has_calls([self.call_resa250_in_101])
+
+    def test_17_prefix_index_follows_prefix_events(self):
+        self.conn.sync_ipaddress(200)
+        self.kea.set_reservation.assert_called_once()
+        # Prefix has left DHCP-enabled prefixes
+        self.nb.prefix.return_value = None
+        self.conn.sync_prefix(100)
+        self.kea.reset_mock()
+        self.conn.sync_ipaddress(200)
+        self.kea.set_reservation.assert_not_called()
+        # Prefix is back
+        self.nb.prefix.return_value = fixtp.prefix_100
+        self.conn.sync_prefix(100)
+        self.kea.reset_mock()
+        self.conn.sync_ipaddress(200)
+        self.kea.set_reservation.assert_has_calls([self.call_resa200])
+        self.nb.all_prefixes.assert_called_once()
+        self.nb.prefixes.assert_not_called()
 
     def test_20_sync_ip_range(self):
         self.conn.sync_iprange(250)
@@ -143,12 +276,177 @@ class TestConnector(unittest.TestCase):
         self.kea.set_reservation.assert_has_calls(
             [self.call_resa200, self.call_resa201, self.call_resa202])
         self.kea.set_pool.assert_has_calls([self.call_pool250])
+        self.nb.prefetch_assigned_objects.assert_called_once()
 
     def test_39_sync_prefix_del(self):
         self.nb.prefix.return_value = None
         self.conn.sync_prefix(199)
         self.kea.del_subnet.assert_called_once_with(199)
 
+    def test_40_sync_events(self):
+        self.nb.prefixes.side_effect = lambda **kw: iter([fixtp.prefix_100])
+        self.conn.sync_events([('ipaddress', 200), ('iprange', 250)])
+        self.kea.refresh.assert_called_once()
+        self.kea.set_reservation.assert_has_calls([self.call_resa200])
+        self.kea.set_pool.assert_has_calls([self.call_pool250])
+        self.kea.commit.assert_called_once()
+        self.kea.push.assert_called_once()
+        self.assertIs(self.kea.auto_commit, True)
+
+    def test_41_sync_events_rejected(self):
+        self.nb.prefixes.side_effect = lambda **kw: iter([fixtp.prefix_100])
+        self.kea.commit.side_effect = ChangesRejected(
+            'rejected', [('ipaddress', 200)])
+        with self.assertLogs(level='ERROR') as logs:
+            self.conn.sync_events([('ipaddress', 200), ('iprange', 250)])
+        self.assertIn('ipaddress id=200: rejected', logs.output[0])
+        self.kea.commit.assert_called_once_with(isolate=True)
+        self.assertEqual(self.kea.set_reservation.call_count, 1)
+        self.kea.push.assert_called_once()
+
+    def test_41_sync_events_unsupported(self):
+        self.nb.prefixes.side_effect = lambda **kw: iter([fixtp.prefix_100])
+        with self.assertLogs(level='ERROR') as logs:
+            self.conn.sync_events([('all', 1), ('ipaddress', 200)])
+        self.assertIn('all id=1: unsupported event model', logs.output[0])
+        self.kea.pull.assert_not_called()
+        self.kea.set_reservation.assert_has_calls([self.call_resa200])
+        self.assertFalse(self.conn._lock.locked())
+
+    def test_42_sync_serialized(self):
+        locked = []
+        self.kea.refresh.side_effect = lambda: locked.append(
+            self.conn._lock.locked())
+        self.kea.pull.side_effect = self.kea.refresh.side_effect
+        self.conn.sync_events([('prefix', 100)])
+        self.conn.sync_all()
+        self.assertEqual(locked, [True, True])
+        self.assertFalse(self.conn._lock.locked())
+
+    def test_43_sync_changes(self):
+        # Latest change time of netbox change log, moving on at each sync
+        times = iter(['2023-01-01T11:00:00.000000Z',
+                      '2023-01-02T09:00:00.000000Z',
+                      '2023-01-02T10:00:00.000000Z'])
+        self.nb.last_change_time.side_effect = lambda: next(times)
+        # Without previous sync, a full sync is done. Changes made while it
+        # runs (prefix 100 here) are looked for by the next sync.
+        self.conn.sync_changes()
+        self.kea.pull.assert_called_once()
+        self.nb.updated_since.assert_not_called()
+        since = '2023-01-01T11:00:00.000000Z'
+        self.assertEqual(self.conn._watermark, since)
+
+        # Then only changed objects are synced, without fetching them again.
+        # Those out of the filters (IP address 7, prefix 101) are deleted.
+        updated = {'prefix': [(101, None)],
+                   'iprange': [(250, fixtr.ip_range_250)],
+                   'ipaddress': [(7, None)]}
+        self.nb.updated_since.side_effect = lambda model, since: iter(
+            updated[model])
+        deleted = [('ipaddress', 201, '2023-01-02T08:40:00.000000Z')]
+        self.nb.deleted_since.side_effect = lambda since: iter(deleted)
+        self.nb.ip_range.reset_mock()
+        self.nb.ip_address.reset_mock()
+        self.conn.sync_changes()
+        self.nb.updated_since.assert_any_call('prefix', since)
+        self.nb.deleted_since.assert_called_once_with(since)
+        self.nb.ip_range.assert_not_called()
+        self.nb.ip_address.assert_not_called()
+        self.kea.pull.assert_called_once()
+        self.kea.set_pool.assert_called_with(*self.call_pool250.args)
+        self.kea.del_resa.assert_has_calls([call(7), call(201)])
+        self.kea.del_subnet.assert_called_once_with(101)
+        self.assertEqual(self.conn._watermark, '2023-01-02T09:00:00.000000Z')
+
+        # Changes not pushed are looked for again
+        self.kea.push.return_value = False
+        self.conn.sync_changes()
+        self.assertEqual(self.conn._watermark, '2023-01-02T09:00:00.000000Z')
+
+    def test_43_sync_all_watermark(self):
+        # Not read without incremental sync nor state store
+        self.conn.sync_all()
+        self.nb.last_change_time.assert_not_called()
+        self.assertIsNone(self.conn._watermark)
+        self.conn.incremental = True
+        self.conn.sync_all()
+        self.assertEqual(self.conn._watermark, '2023-01-02T08:00:00.000000Z')
+        # A change log that can’t be read doesn’t prevent full syncs
+        self.conn._watermark = None
+        self.nb.last_change_time.side_effect = Exception('403 Forbidden')
+        self.kea.push.reset_mock()
+        with self.assertLogs(level='WARNING') as logs:
+            self.conn.sync_all()
+        self.assertIn('unable to read netbox change log', logs.output[0])
+        self.kea.push.assert_called_once()
+        self.assertIsNone(self.conn._watermark)
+
+    def test_44_sync_skipped_if_busy(self):
+        with self.conn._lock:
+            self.assertIs(self.conn.sync_all(blocking=False), False)
+            self.assertIs(self.conn.sync_changes(blocking=False), False)
+        self.kea.pull.assert_not_called()
+        self.assertIs(self.conn.sync_all(blocking=False), True)
+
+    def test_45_sync_budget(self):
+        with self.assertRaises(SyncTimeout):
+            self.conn.sync_all(budget=-1)
+        self.kea.push.assert_not_called()
+        self.assertFalse(self.conn._lock.locked())
+        # Budget only applies to one sync
+        self.conn.sync_all()
+        self.kea.push.assert_called_once()
+
+    def test_95_sync_all_bulk_fetch(self):
+        self.conn.bulk_fetch = True
+        self.nb.all_prefixes_with_children.return_value = iter([(
+            fixtp.prefix_100, [fixtip.ip_address_200], [fixtr.ip_range_250])])
+        self.conn.sync_all()
+        self.nb.ip_addresses.assert_not_called()
+        self.nb.ip_ranges.assert_not_called()
+        self.kea.set_subnet.assert_has_calls([self.call_subnet100])
+        self.kea.set_reservation.assert_has_calls([self.call_resa200])
+        self.kea.set_pool.assert_has_calls([self.call_pool250])
+        self.kea.push.assert_called()
+
+    def test_96_sync_all_reconcile(self):
+        self.conn.reconcile = True
+        self.conn.sync_all()
+        self.kea.del_all_subnets.assert_not_called()
+        self.kea.del_subnets_except.assert_called_once()
+        self.assertEqual(
+            list(self.kea.del_subnets_except.call_args.args[0]), [100])
+        self.kea.update_subnet.assert_has_calls([self.call_subnet100])
+        self.kea.set_reservation.assert_has_calls(
+            [self.call_resa200, self.call_resa201, self.call_resa202,
+             self.call_resa250])
+        self.kea.prune_subnet.assert_called_once_with(
+            100, [200, 201, 202, 250], [250])
+
+    def test_97_sync_all_workers(self):
+        prefixes = [fixtp.prefix_100, fixtp.prefix_101, fixtp.prefix_102]
+        self.nb.all_prefixes.side_effect = lambda: iter(prefixes)
+        self.nb.ip_ranges.return_value = None
+        self.nb.ip_ranges.side_effect = lambda **kw: iter(
+            [fixtr.ip_range_250])
+        self.conn.sync_all()
+        sequential_calls = self.kea.mock_calls
+        self.kea.reset_mock()
+        self.conn.workers = 3
+        self.conn.sync_all()
+        # Items are applied in the same order as a sequential sync
+        self.assertEqual(self.kea.mock_calls, sequential_calls)
+        self.kea.set_subnet.assert_has_calls([self.call_subnet100])
+
+    def test_98_sync_all_commit_strategy(self):
+        self.conn.commit_strategy = 'final'
+        self.conn.sync_all()
+        self.kea.commit.assert_has_calls(
+            [call(check=False), call(isolate=True)])
+        with self.assertRaises(ValueError):
+            Connector(self.nb, self.kea, {}, {}, {}, commit_strategy='none')
+
     def test_99_sync_all(self):
         self.conn.sync_all()
         self.kea.set_subnet.assert_has_calls([self.call_subnet100])
@@ -158,3 +456,184 @@ class TestConnector(unittest.TestCase):
         self.kea.set_pool.assert_has_calls([self.call_pool250])
         self.kea.commit.assert_called()
         self.kea.push.assert_called()
+
+
+class KeaServerTestCase(unittest.TestCase):
+    """ Connector with a DHCP4App of a fake Kea server """
+
+    def setUp(self):
+        self.nb = Mock()
+        self.nb.all_prefixes.side_effect = lambda: iter([fixtp.prefix_100])
+        self.nb.ip_addresses.side_effect = fixtip.filter_
+        self.nb.ip_ranges.side_effect = lambda **kw: iter(
+            [fixtr.ip_range_250])
+        self.nb.last_change_time.return_value = '2023-01-02T08:00:00.000000Z'
+        self.kea = DHCP4App('http://keasrv/api')
+        self.srv_conf = {'Dhcp4': {'subnet4': [
+            {'id': 199, 'subnet': '192.168.9.0/24'}]}}
+        self.kea.api._request_kea = Mock(side_effect=self.req_result)
+        self.conn = Connector(
+            self.nb, self.kea, {}, {}, {
+                'hw-address': 'custom_fields.dhcp_resa_hw_address',
+                'hostname': 'dns_name'}, reconcile=True)
+
+    def req_result(self, cmd, params=None):
+        if cmd == 'config-get':
+            return deepcopy(self.srv_conf)
+        elif cmd == 'config-set':
+            self.srv_conf = deepcopy(params)
+
+
+class TestConnectorReconcile(KeaServerTestCase):
+
+    def test_01_resync_without_change(self):
+        self.conn.sync_all()
+        subnets = self.srv_conf['Dhcp4']['subnet4']
+        self.assertEqual([s['subnet'] for s in subnets], ['192.168.0.0/24'])
+        self.assertEqual(len(subnets[0]['reservations']), 2)
+        self.assertEqual(len(subnets[0]['pools']), 1)
+        self.kea.api._request_kea.reset_mock()
+        self.conn.sync_all()
+        cmds = [c.args[0] for c in self.kea.api._request_kea.call_args_list]
+        self.assertNotIn('config-set', cmds)
+        self.assertNotIn('config-write', cmds)
+
+    def test_02_full_resync_without_change(self):
+        self.conn.reconcile = False
+        self.conn.sync_all()
+        self.kea.api._request_kea.reset_mock()
+        self.conn.sync_all()
+        cmds = [c.args[0] for c in self.kea.api._request_kea.call_args_list]
+        self.assertNotIn('config-set', cmds)
+        self.assertNotIn('config-write', cmds)
+
+    def test_03_unchanged_events(self):
+        self.conn.sync_all()
+        self.nb.prefix.return_value = fixtp.prefix_100
+        self.nb.ip_address.side_effect = fixtip.get
+        self.nb.ip_range.return_value = fixtr.ip_range_250
+        self.kea.api._request_kea.reset_mock()
+        for _ in range(3):
+            self.conn.sync_events([('prefix', 100), ('ipaddress', 201),
+                                   ('ipaddress', 202), ('iprange', 250)])
+        cmds = [c.args[0] for c in self.kea.api._request_kea.call_args_list]
+        self.assertEqual(set(cmds), {'config-get'})
+
+    def test_04_rejected_new_subnet(self):
+        # Subnet of new prefix 102 is rejected by the server
+        def req_result(cmd, params=None):
+            if cmd == 'config-test' and '10.0.0.0/24' in [
+                    s['subnet'] for s in params['Dhcp4']['subnet4']]:
+                raise KeaCmdError('rejected')
+            return self.req_result(cmd, params)
+        self.kea.api._request_kea.side_effect = req_result
+        self.nb.all_prefixes.side_effect = lambda: iter(
+            [fixtp.prefix_100, fixtp.prefix_102])
+        with self.assertLogs(level='ERROR') as logs:
+            self.conn.sync_all()
+        self.assertIn('ERROR:root:prefix id=102: rejected by DHCP server',
+                      logs.output)
+        subnets = self.srv_conf['Dhcp4']['subnet4']
+        self.assertEqual([s['id'] for s in subnets], [100])
+
+
+class TestConnectorCommitStrategy(KeaServerTestCase):
+
+    def test_01_final_check(self):
+        # Subnet of prefix 102 is rejected by the server
+        def req_result(cmd, params=None):
+            if cmd == 'config-test' and '10.0.0.0/24' in [
+                    s['subnet'] for s in params['Dhcp4']['subnet4']]:
+                raise KeaCmdError('rejected')
+            return self.req_result(cmd, params)
+        self.kea.api._request_kea.side_effect = req_result
+        self.nb.all_prefixes.side_effect = lambda: iter(
+            [fixtp.prefix_100, fixtp.prefix_101, fixtp.prefix_102])
+        self.conn.reconcile = False
+        self.conn.commit_strategy = 'final'
+        with self.assertLogs(level='ERROR') as logs:
+            self.conn.sync_all()
+        self.assertIn('ERROR:root:prefix id=102: rejected by DHCP server',
+                      logs.output)
+        subnets = self.srv_conf['Dhcp4']['subnet4']
+        self.assertEqual([s['id'] for s in subnets], [100, 101])
+        # Final check, then checks of the 12 changes by halves: all, changes
+        # of 100, of 101-102, of 101, of 102, and 102 subnet alone (the other
+        # changes of 102 don’t change anything)
+        cmds = [c.args[0] for c in self.kea.api._request_kea.call_args_list]
+        self.assertEqual(cmds.count('config-test'), 7)
+
+    def test_02_final_check_server_error(self):
+        def req_result(cmd, params=None):
+            if cmd == 'config-test':
+                raise KeaServerError('HTTP 503')
+            return self.req_result(cmd, params)
+        self.kea.api._request_kea.side_effect = req_result
+        self.conn.commit_strategy = 'final'
+        with self.assertLogs(level='ERROR') as logs:
+            self.conn.sync_all()
+        self.assertIn('config check failed', logs.output[0])
+        cmds = [c.args[0] for c in self.kea.api._request_kea.call_args_list]
+        self.assertNotIn('config-set', cmds)
+
+
+class TestConnectorState(KeaServerTestCase):
+
+    def test_01_state(self):
+        self.conn.state = StateStore(':memory:')
+        self.conn.sync_all()
+        state = self.conn.state.get('ipaddress', 201)
+        self.assertEqual(state.prefixes, [100])
+        self.assertEqual(state.item['ip-address'], '192.168.0.2')
+        self.assertEqual(
+            state.last_updated, fixtip.ip_address_201.last_updated)
+        self.assertIsNotNone(state.hash)
+        self.assertIsNotNone(self.conn.state.get('prefix', 100))
+        self.assertIsNotNone(self.conn.state.get('iprange', 250))
+        # Events of objects unchanged since last push are dropped
+        self.nb.prefix.return_value = fixtp.prefix_100
+        self.nb.ip_address.side_effect = fixtip.get
+        self.kea.api._request_kea.reset_mock()
+        self.conn.sync_events([('prefix', 100), ('ipaddress', 201)])
+        self.kea.api._request_kea.assert_not_called()
+        # Other ones are synced
+        self.nb.ip_address.side_effect = lambda id_: None
+        self.nb.prefixes.side_effect = lambda **kw: iter([fixtp.prefix_100])
+        self.conn.sync_events([('ipaddress', 201)])
+        self.assertIsNone(self.conn.state.get('ipaddress', 201))
+        self.assertEqual(
+            len(self.srv_conf['Dhcp4']['subnet4'][0]['reservations']), 1)
+
+    def test_02_watermark_in_state(self):
+        self.conn.state = StateStore(':memory:')
+        self.conn.sync_changes()
+        since = '2023-01-02T08:00:00.000000Z'
+        self.assertEqual(self.conn.state.get_meta('watermark'), since)
+        # Restarted program resumes from the stored watermark
+        self.nb.updated_since.side_effect = lambda model, since: iter([])
+        self.nb.deleted_since.side_effect = lambda since: iter([])
+        self.kea.api._request_kea.reset_mock()
+        conn = Connector(self.nb, self.kea, {}, {}, {}, state=self.conn.state)
+        conn.sync_changes()
+        self.nb.updated_since.assert_any_call('ipaddress', since)
+        self.kea.api._request_kea.assert_not_called()
+
+    def test_03_last_update_of_unchanged_items(self):
+        self.conn.state = StateStore(':memory:')
+        self.conn.sync_all()
+        # IP address updated in netbox without change of its reservation
+        ip = copy(fixtip.ip_address_201)
+        ip.last_updated = '2023-01-03T08:00:00.000000Z'
+        self.nb.ip_address.side_effect = lambda id_: ip
+        self.kea.api._request_kea.reset_mock()
+        self.conn.sync_events([('ipaddress', 201)])
+        # It is fetched once, to tell it has changed and to sync it
+        self.nb.ip_address.assert_called_once_with(201)
+        cmds = [c.args[0] for c in self.kea.api._request_kea.call_args_list]
+        self.assertNotIn('config-set', cmds)
+        self.assertEqual(self.conn.state.get('ipaddress', 201).last_updated,
+                         '2023-01-03T08:00:00.000000Z')
+        # Its next events are dropped
+        self.kea.api._request_kea.reset_mock()
+        self.conn.sync_events([('ipaddress', 201)])
+        self.kea.api._request_kea.assert_not_called()
@@ -0,0 +1,50 @@
+import threading
+import unittest
+from unittest.mock import Mock
+
+from netboxkea.events import EventQueue
+
+
+class TestEventQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = Mock()
+        self.queue = EventQueue(self.conn, debounce=60)
+        self.queue.start()
+
+    def tearDown(self):
+        self.queue.stop()
+
+    def test_01_coalesce(self):
+        for model, id_ in (('ipaddress', 200), ('prefix', 100),
+                           ('ipaddress', 200), ('ipaddress', 201)):
+            self.queue.put(model, id_)
+        # Stopping the queue flushes pending events without waiting
+        self.queue.stop()
+        self.conn.sync_events.assert_called_once_with(
+            [('ipaddress', 200), ('prefix', 100), ('ipaddress', 201)])
+
+    def test_02_batches(self):
+        self.queue.stop()
+        self.queue = EventQueue(self.conn, debounce=0)
+        applied = threading.Event()
+        self.conn.sync_events.side_effect = lambda e: applied.set()
+        self.queue.start()
+        self.queue.put('prefix', 100)
+        self.assertTrue(applied.wait(5))
+        self.queue.put('prefix', 100)
+        self.queue.stop()
+        self.assertEqual(self.conn.sync_events.call_count, 2)
+
+    def test_03_failure_keeps_thread_alive(self):
+        self.queue.stop()
+        self.queue = EventQueue(self.conn, debounce=0)
+        self.conn.sync_events.side_effect = [Exception('netbox down'), None]
+        self.queue.start()
+        with self.assertLogs(level='ERROR'):
+            self.queue.put('prefix', 100)
+            while self.conn.sync_events.call_count < 1:
+                threading.Event().wait(0.01)
+        self.queue.put('prefix', 101)
+        self.queue.stop()
+        self.assertEqual(self.conn.sync_events.call_count, 2)
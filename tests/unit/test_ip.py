@@ -0,0 +1,45 @@
+import unittest
+
+from netboxkea import ip
+
+
+class TestIP(unittest.TestCase):
+
+    def test_01_to_int(self):
+        self.assertEqual(ip.to_int('192.168.0.1/24'), (4, 0xc0a80001))
+        self.assertEqual(ip.to_int('10.0.0.1'), (4, 0x0a000001))
+        self.assertEqual(ip.to_int('2001:db8::1/64'),
+                         (6, 0x20010db8 << 96 | 1))
+        for bad in ('192.168.0', '192.168.0.256', '01.2.3.4', 'host', ''):
+            with self.assertRaises(ValueError):
+                ip.to_int(bad)
+
+    def test_02_to_str(self):
+        self.assertEqual(ip.to_str(4, 0xc0a80001), '192.168.0.1')
+        self.assertEqual(ip.to_str(6, 0x20010db8 << 96 | 1), '2001:db8::1')
+
+    def test_03_host(self):
+        self.assertEqual(ip.host('192.168.0.1/24'), '192.168.0.1')
+        self.assertEqual(ip.host('2001:DB8:0::1/64'), '2001:db8::1')
+        with self.assertRaises(ValueError):
+            ip.host('192.168.0.1.1/24')
+
+    def test_04_network(self):
+        self.assertEqual(ip.network('192.168.0.0/24'),
+                         (4, 24, 0xc0a80000, 0xc0a800ff))
+        self.assertEqual(ip.network('10.1.2.3/8'),
+                         (4, 8, 0x0a000000, 0x0affffff))
+        self.assertEqual(ip.network('10.1.2.3'),
+                         (4, 32, 0x0a010203, 0x0a010203))
+        for bad in ('10.0.0.0/33', '10.0.0.0/x', '10.0.0/8'):
+            with self.assertRaises(ValueError):
+                ip.network(bad)
+
+    def test_05_ip_range(self):
+        self.assertEqual(ip.ip_range('10.0.0.1 - 10.0.0.9'),
+                         (4, 0x0a000001, 0x0a000009))
+        self.assertEqual(ip.ip_range('10.0.0.0/30'),
+                         (4, 0x0a000000, 0x0a000003))
+        for bad in ('10.0.0.1-10.0.0.2-10.0.0.3', '10.0.0.1-::1'):
+            with self.assertRaises(ValueError):
+                ip.ip_range(bad)
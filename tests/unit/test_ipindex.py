@@ -0,0 +1,38 @@
+import unittest
+
+from netboxkea.ipindex import PrefixIndex
+from ..fixtures.pynetbox import prefixes as fixtp
+
+
+class TestPrefixIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PrefixIndex([fixtp.prefix_100, fixtp.prefix_101])
+
+    def test_01_lookup(self):
+        self.assertEqual(
+            self.index.lookup('192.168.0.1/24'), [fixtp.prefix_100])
+        self.assertEqual(self.index.lookup('10.1.2.3'), [fixtp.prefix_101])
+        self.assertEqual(self.index.lookup('172.16.0.1/12'), [])
+
+    def test_02_lookup_nested_longest_first(self):
+        self.index.add(fixtp.prefix_102)
+        self.assertEqual(self.index.lookup('10.0.0.50/8'),
+                         [fixtp.prefix_102, fixtp.prefix_101])
+
+    def test_03_lookup_range(self):
+        self.index.add(fixtp.prefix_102)
+        self.assertEqual(self.index.lookup_range('10.0.0.1', '10.0.0.9'),
+                         [fixtp.prefix_102, fixtp.prefix_101])
+        self.assertEqual(self.index.lookup_range('10.0.0.1', '10.0.1.9'),
+                         [fixtp.prefix_101])
+
+    def test_04_remove(self):
+        self.index.remove(100)
+        self.index.remove(999)
+        self.assertEqual(self.index.lookup('192.168.0.1/24'), [])
+        self.assertEqual(len(self.index), 1)
+        # Prefix lengths of removed tables are not looked up anymore
+        self.assertEqual(self.index._lengths, {4: [8]})
+        self.index.add(fixtp.prefix_100)
+        self.assertEqual(self.index._lengths, {4: [8, 24]})
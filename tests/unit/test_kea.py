@@ -1,9 +1,12 @@
+import json
 import unittest
 from copy import deepcopy
-from unittest.mock import MagicMock, call
+from hashlib import sha256
+from unittest.mock import ANY, MagicMock, call
 
 from netboxkea.kea.app import DHCP4App
-from netboxkea.kea.exceptions import KeaClientError, SubnetNotFound
+from netboxkea.kea.exceptions import (
+    ChangesRejected, KeaClientError, KeaCmdError, SubnetNotFound)
 
 
 class TestKea(unittest.TestCase):
@@ -19,23 +22,39 @@ class TestKea(unittest.TestCase):
     def _set_std_pool(self):
         self.kea.set_pool(100, 250, {'pool': '192.168.0.100-192.168.0.199'})
 
+    def _srv_conf_hash(self):
+        return sha256(json.dumps(
+            self.srv_conf, sort_keys=True).encode()).hexdigest()
+
     def setUp(self):
         self.kea = DHCP4App('http://keasrv/api')
         self.req = MagicMock()
         self.kea.api._request_kea = self.req
         self.srv_conf = {'Dhcp4': {}}
         self.srv_check_res = True
+        self.srv_hash = False
+        self.srv_commands = ['config-get', 'config-set', 'config-test',
+                             'config-write', 'list-commands']
 
         def req_result(cmd, params=None):
             match cmd:
                 case 'config-get':
+                    if self.srv_hash:
+                        return dict(deepcopy(self.srv_conf),
+                                    hash=self._srv_conf_hash())
                     return deepcopy(self.srv_conf)
+                case 'config-hash-get' if self.srv_hash:
+                    return {'hash': self._srv_conf_hash()}
                 case 'config-set':
                     self.srv_conf = deepcopy(params)
                 case 'config-test':
                     return self.srv_check_res
                 case 'config-write':
                     pass
+                case 'list-commands':
+                    return self.srv_commands
+                case cmd if cmd in self.srv_commands:
+                    pass
                 case _:
                     raise ValueError(cmd)
 
@@ -45,21 +64,82 @@ class TestKea(unittest.TestCase):
 
     def test_01_pull(self):
         self.assertEqual(self.kea.conf, {'subnet4': []})
-        self.assertEqual(self.kea.commit_conf, self.kea.conf)
+        self.assertEqual(self.kea._journal, [])
 
     def test_02_commit(self):
-        newconf = {'subnet4': [{'garbage': True}]}
+        newconf = {'subnet4': [
+            {'garbage': True, 'pools': [], 'reservations': []}]}
         self.kea.conf = deepcopy(newconf)
         self.kea.commit()
         self.req.assert_called_once_with('config-test', {'Dhcp4': newconf})
-        self.assertEqual(self.kea.conf, self.kea.commit_conf)
+        self.assertEqual(self.kea._journal, [])
+
+    def test_02_commit_without_change(self):
+        self._set_std_subnet()
+        self.req.reset_mock()
+        self.kea.auto_commit = False
+        self._set_std_subnet()
+        self.kea.del_resa(200)
+        self.assertIs(self.kea.commit(isolate=True), True)
+        self.req.assert_not_called()
+
+    def test_02_commit_without_check(self):
+        self.kea.auto_commit = False
+        self._set_std_subnet()
+        self.kea.commit(check=False)
+        self.req.assert_not_called()
+        self.kea.push()
+        self.assertEqual(len(self.srv_conf['Dhcp4']['subnet4']), 1)
+
+    def test_05_commit_isolate(self):
+        self.kea.auto_commit = False
+        self.kea.set_subnet(100, {'subnet': '192.168.0.0/24'})
+        for n in range(1, 65):
+            self.kea.set_reservation(100, n, {
+                'ip-address': f'192.168.0.{n}',
+                'hw-address': f'11:22:33:44:55:{n:02x}'})
+        # Reservations 7 and 42 are rejected by the server
+        req_result = self.req.side_effect
+
+        def reject(cmd, params=None):
+            if cmd == 'config-test' and {7, 42} & {
+                    r['user-context']['netbox_ip_address_id']
+                    for s in params['Dhcp4']['subnet4']
+                    for r in s['reservations']}:
+                raise KeaCmdError('rejected')
+            return req_result(cmd, params)
+
+        self.req.side_effect = reject
+        with self.assertRaises(ChangesRejected) as cm:
+            self.kea.commit(isolate=True)
+        self.assertEqual(cm.exception.rejected,
+                         [('ipaddress', 7), ('ipaddress', 42)])
+        resas = self.kea.conf['subnet4'][0]['reservations']
+        self.assertEqual(len(resas), 62)
+        tests = [c for c in self.req.call_args_list
+                 if c.args[0] == 'config-test']
+        self.assertLess(len(tests), 30)
+        # Nothing left to commit, and the whole config is not checked again
+        self.kea.push()
+        self.assertEqual(len(self.srv_conf['Dhcp4']['subnet4']), 1)
+
+    def test_06_commit_without_isolate(self):
+        self.kea.auto_commit = False
+        self._set_std_subnet()
+        self._set_std_resa()
+        self.req.side_effect = KeaCmdError('rejected')
+        with self.assertRaises(KeaCmdError) as cm:
+            self.kea.commit()
+        self.assertNotIsInstance(cm.exception, ChangesRejected)
+        self.assertEqual(self.kea.conf['subnet4'], [])
 
     def test_03_push_wo_commit(self):
         self.kea.push()
         self.req.assert_not_called()
 
     def test_04_push_w_commit(self):
-        newconf = {'subnet4': [{'garbage': True}]}
+        newconf = {'subnet4': [
+            {'garbage': True, 'pools': [], 'reservations': []}]}
         self.kea.conf = deepcopy(newconf)
         self.kea.commit()
         self.kea.push()
@@ -68,12 +148,12 @@ class TestKea(unittest.TestCase):
                  call('config-write', {'Dhcp4': newconf})]
         self.req.has_calls(calls)
         self.assertEqual(self.srv_conf['Dhcp4'], newconf)
-        self.assertEqual(self.kea.conf, self.kea.commit_conf)
+        self.assertEqual(self.kea._journal, [])
 
     def test_10_set_subnet(self):
         expected = {'subnet4': [
             {'id': 100, 'subnet': '192.168.0.0/24', 'pools': [],
-             'reservations': []}]}
+             'reservations': [], 'user-context': {'netbox_hash': ANY}}]}
         self._set_std_subnet()
         self.kea.push()
         self.assertEqual(self.srv_conf['Dhcp4'], expected)
@@ -86,6 +166,21 @@ class TestKea(unittest.TestCase):
             self.srv_conf['Dhcp4']['subnet4'][0]['subnet'], '192.168.0.0/24')
         self.assertEqual(len(self.srv_conf['Dhcp4']['subnet4']), 1)
 
+    def test_11_set_subnet_unchanged(self):
+        self._set_std_subnet()
+        self.kea.push()
+        self.req.reset_mock()
+        self._set_std_subnet()
+        self.assertIsNone(self.kea.push())
+        self.req.assert_not_called()
+        # Replacing an unchanged subnet drops its items only
+        self._set_std_resa()
+        self._set_std_subnet()
+        self.assertEqual(self.kea.conf['subnet4'][0]['reservations'], [])
+        self.kea.push()
+        self.assertEqual(
+            self.srv_conf['Dhcp4']['subnet4'][0]['reservations'], [])
+
     def test_12_set_subnet_conflict(self):
         self._set_std_subnet()
         with self.assertRaises(KeaClientError):
@@ -103,12 +198,14 @@ class TestKea(unittest.TestCase):
 
     def test_15_del_subnet(self):
         self._set_std_subnet()
+        self.kea.push()
         self.kea.del_subnet(100)
         self.kea.push()
         self.assertEqual(len(self.srv_conf['Dhcp4']['subnet4']), 0)
 
     def test_16_del_all_subnets(self):
         self._set_std_subnet()
+        self.kea.push()
         self.kea.del_all_subnets()
         self.kea.push()
         self.assertEqual(len(self.srv_conf['Dhcp4']['subnet4']), 0)
@@ -119,8 +216,8 @@ class TestKea(unittest.TestCase):
              'reservations': [{
                 'ip-address': '192.168.0.1', 'hw-address': '11:22:33:44:55:66',
                 'hostname': 'pc.lan', 'user-context': {
-                    'netbox_ip_address_id': 200}}]
-             }]}
+                    'netbox_ip_address_id': 200, 'netbox_hash': ANY}}],
+             'user-context': {'netbox_hash': ANY}}]}
         self._set_std_subnet()
         self._set_std_resa()
         self.kea.push()
@@ -179,8 +276,8 @@ class TestKea(unittest.TestCase):
         expected = {'subnet4': [
             {'id': 100, 'subnet': '192.168.0.0/24', 'pools': [{
                 'pool': '192.168.0.100-192.168.0.199',
-                'user-context': {'netbox_ip_range_id': 250}
-                }], 'reservations': []}]}
+                'user-context': {'netbox_ip_range_id': 250, 'netbox_hash': ANY}
+                }], 'reservations': [], 'user-context': {'netbox_hash': ANY}}]}
         self._set_std_subnet()
         self._set_std_pool()
         self.kea.push()
@@ -195,8 +292,418 @@ class TestKea(unittest.TestCase):
             self.kea.set_pool(100, 251, {
                 'pool': '192.168.0.199-192.168.0.250'})
 
+    def test_34_set_pool_conflict_containment(self):
+        self._set_std_subnet()
+        self._set_std_pool()
+        for pool in ('192.168.0.10-192.168.0.250',
+                     '192.168.0.120-192.168.0.130', '192.168.0.96/28'):
+            with self.assertRaises(KeaClientError):
+                self.kea.set_pool(100, 251, {'pool': pool})
+        # Resizing a pool doesn’t conflict with itself
+        self.kea.set_pool(100, 250, {'pool': '192.168.0.90-192.168.0.209'})
+        self.kea.set_pool(100, 251, {'pool': '192.168.0.210-192.168.0.220'})
+        with self.assertRaises(KeaClientError):
+            self.kea.set_pool(100, 252, {'pool': '192.168.0.209'
+                                                 '-192.168.0.210'})
+        # Range of a deleted pool is free again
+        self.kea.del_pool(250)
+        self.kea.set_pool(100, 252, {'pool': '192.168.0.0/25'})
+
+    def test_36_many_pools(self):
+        self.kea.auto_commit = False
+        self.kea.set_subnet(100, {'subnet': '10.0.0.0/8'})
+        # 10k pools of 4 addresses, every 16 addresses, in random order
+        ids = list(range(10000))
+        ids.sort(key=lambda n: (n * 7919) % 10000)
+        for n in ids:
+            self.kea.set_pool(100, n, {
+                'pool': f'10.{n >> 12}.{(n >> 4) & 0xff}.{(n & 0xf) << 4}'
+                f'-10.{n >> 12}.{(n >> 4) & 0xff}.{((n & 0xf) << 4) + 3}'})
+        self.kea.commit()
+        self.assertEqual(len(self.kea.conf['subnet4'][0]['pools']), 10000)
+        for pool in ('10.0.0.3-10.0.0.4', '10.1.2.0/24', '10.0.0.8-10.2.0.0'):
+            with self.assertRaises(KeaClientError):
+                self.kea.set_pool(100, 10000, {'pool': pool})
+        self.kea.set_pool(100, 10000, {'pool': '10.0.0.4-10.0.0.15'})
+        self.kea.del_pool(1)
+        self.kea.set_pool(100, 10001, {'pool': '10.0.0.16-10.0.0.31'})
+
+    def test_37_outside_subnet(self):
+        self._set_std_subnet()
+        self.req.reset_mock()
+        for pool in ('192.168.0.200-192.168.1.10', '10.0.0.0/24', 'x-y'):
+            with self.assertRaises(KeaClientError):
+                self.kea.set_pool(100, 251, {'pool': pool})
+        for addr in ('192.168.1.1', '192.168.0.300'):
+            with self.assertRaises(KeaClientError):
+                self.kea.set_reservation(100, 201, {
+                    'ip-address': addr, 'hw-address': '11:22:33:44:55:66'})
+        self.req.assert_not_called()
+
     def test_35_del_pool(self):
         self._set_std_subnet()
         self._set_std_pool()
         self.kea.del_pool(250)
         self.assertEqual(len(self.kea.conf['subnet4'][0]['pools']), 0)
+
+    def test_40_pulled_items_indexed(self):
+        self.srv_conf['Dhcp4']['subnet4'] = [{
+            'id': 100, 'subnet': '192.168.0.0/24', 'reservations': [{
+                'ip-address': '192.168.0.1', 'hw-address': '11:22:33:44:55:66',
+                'user-context': {'netbox_ip_address_id': 200}}]}]
+        self.kea.pull()
+        with self.assertRaises(KeaClientError):
+            self.kea.set_reservation(100, 201, {
+                'ip-address': '192.168.0.2',
+                'hw-address': '11:22:33:44:55:66'})
+        self.kea.del_resa(200)
+        self.kea.set_reservation(100, 201, {
+            'ip-address': '192.168.0.2', 'hw-address': '11:22:33:44:55:66'})
+        self.assertEqual(len(self.kea.conf['subnet4'][0]['reservations']), 1)
+
+    def test_41_del_item_from_nested_subnets(self):
+        self._set_std_subnet()
+        self.kea.set_subnet(101, {'subnet': '192.168.0.0/16'})
+        self._set_std_resa()
+        self.kea.set_reservation(101, 200, {
+            'ip-address': '192.168.0.1', 'hw-address': '11:22:33:44:55:66'})
+        self.kea.del_resa(200)
+        for s in self.kea.conf['subnet4']:
+            self.assertEqual(len(s['reservations']), 0)
+
+    def test_42_indexes_after_rollback(self):
+        self._set_std_subnet()
+        self.req.side_effect = KeaCmdError('rejected')
+        with self.assertRaises(KeaCmdError):
+            self._set_std_resa()
+        self.req.side_effect = None
+        # Reservation has been dropped with its index
+        self.kea.set_reservation(100, 201, {
+            'ip-address': '192.168.0.2', 'hw-address': '11:22:33:44:55:66'})
+        self.assertEqual(len(self.kea.conf['subnet4'][0]['reservations']), 1)
+
+    def test_43_del_subnet_drop_item_indexes(self):
+        self._set_std_subnet()
+        self._set_std_resa()
+        self.kea.del_subnet(100)
+        self._set_std_subnet()
+        self.kea.set_reservation(100, 201, {
+            'ip-address': '192.168.0.1', 'hw-address': '11:22:33:44:55:66'})
+        self.assertEqual(len(self.kea.conf['subnet4'][0]['reservations']), 1)
+
+    def test_44_rollback_restores_config(self):
+        self._set_std_subnet()
+        self._set_std_resa()
+        self._set_std_pool()
+        before = deepcopy(self.kea.conf)
+        self.kea.auto_commit = False
+        self.kea.set_reservation(100, 201, {
+            'ip-address': '192.168.0.2', 'hw-address': '11:22:33:44:55:77'})
+        self.kea.del_pool(250)
+        self.kea.update_subnet(100, {'subnet': '192.168.0.0/24', 'opt': 1})
+        self.kea.set_subnet(100, {'subnet': '192.168.0.0/24'})
+        self.req.side_effect = KeaCmdError('rejected')
+        with self.assertRaises(KeaCmdError):
+            self.kea.commit()
+        self.assertEqual(self.kea.conf, before)
+        self.assertEqual(self.kea._journal, [])
+
+    def test_45_journal_only_holds_changes(self):
+        self._set_std_subnet()
+        self._set_std_resa()
+        self.kea.auto_commit = False
+        self.kea.del_resa(200)
+        self.assertEqual(len(self.kea._journal), 1)
+        self.kea.commit()
+        self.assertEqual(self.kea._journal, [])
+
+    def test_46_del_subnet_keeps_list_consistent(self):
+        for i in range(3):
+            self.kea.set_subnet(100 + i, {'subnet': f'192.168.{i}.0/24'})
+        self.kea.auto_commit = False
+        self.kea.del_subnet(100)
+        self.assertEqual(
+            sorted(s['id'] for s in self.kea.conf['subnet4']), [101, 102])
+        self.kea.del_subnet(102)
+        self.req.side_effect = KeaCmdError('rejected')
+        with self.assertRaises(KeaCmdError):
+            self.kea.commit()
+        self.assertEqual(
+            sorted(s['id'] for s in self.kea.conf['subnet4']),
+            [100, 101, 102])
+
+    def test_47_unchanged_items_are_not_pushed(self):
+        self._set_std_subnet()
+        self._set_std_resa()
+        self._set_std_pool()
+        self.kea.push()
+        self.kea.pull()
+        self.req.reset_mock()
+        self.kea.update_subnet(100, {'subnet': '192.168.0.0/24'})
+        self._set_std_resa()
+        self._set_std_pool()
+        self.kea.push()
+        self.assertNotIn(call('config-set', ANY), self.req.mock_calls)
+        # A changed item is pushed
+        self.kea.set_reservation(100, 200, {
+            'ip-address': '192.168.0.1', 'hw-address': '11:22:33:44:55:66',
+            'hostname': 'pc2.lan'})
+        self.kea.push()
+        self.assertEqual(self.srv_conf['Dhcp4']['subnet4'][0]['reservations'][
+            0]['hostname'], 'pc2.lan')
+
+    def test_47_server_defaults_are_not_changes(self):
+        self._set_std_subnet()
+        self._set_std_resa()
+        self._set_std_pool()
+        self.kea.push()
+        # Kea fills in default values of subnets and items
+        subnet = self.srv_conf['Dhcp4']['subnet4'][0]
+        subnet.update({'valid-lifetime': 4000, 'option-data': [],
+                       'relay': {'ip-addresses': []}})
+        subnet['reservations'][0].update(
+            {'option-data': [], 'client-classes': []})
+        subnet['pools'][0]['option-data'] = []
+        self.kea.pull()
+        self.req.reset_mock()
+        self.kea.auto_commit = False
+        self.kea.del_all_subnets()
+        self._set_std_subnet()
+        self._set_std_resa()
+        self._set_std_pool()
+        self.kea.commit()
+        self.assertIsNone(self.kea.push())
+        cmds = [c.args[0] for c in self.req.call_args_list]
+        self.assertNotIn('config-set', cmds)
+        self.assertNotIn('config-write', cmds)
+        # A real change is still pushed
+        self.kea.del_resa(200)
+        self.kea.commit()
+        self.assertIs(self.kea.push(), True)
+        self.assertEqual(
+            self.srv_conf['Dhcp4']['subnet4'][0]['reservations'], [])
+
+    def test_49_changed_objects(self):
+        self._set_std_subnet()
+        self._set_std_resa()
+        self._set_std_pool()
+        changed = self.kea.changed_objects()
+        self.assertEqual(sorted(changed), [
+            ('ipaddress', 200), ('iprange', 250), ('prefix', 100)])
+        prefix_ids, resa = changed['ipaddress', 200]
+        self.assertEqual(prefix_ids, [100])
+        self.assertEqual(resa['hostname'], 'pc.lan')
+        self.assertIs(self.kea.push(), True)
+        self.assertEqual(self.kea.changed_objects(), {})
+        self.assertIsNone(self.kea.push())
+        self.kea.del_resa(200)
+        self.assertIsNone(self.kea.changed_objects()['ipaddress', 200])
+        self.srv_conf = {'Dhcp4': {}}
+        self.req.side_effect = KeaCmdError('rejected')
+        self.kea.commit(check=False)
+        self.assertIs(self.kea.push(), False)
+
+    def test_49_reverted_changes_are_not_pushed(self):
+        self._set_std_subnet()
+        self._set_std_resa()
+        self._set_std_pool()
+        self.kea.push()
+        self.req.reset_mock()
+        self.kea.set_reservation(100, 200, {
+            'ip-address': '192.168.0.1', 'hw-address': '11:22:33:44:55:66',
+            'hostname': 'pc2.lan'})
+        self._set_std_resa()
+        self.assertIsNone(self.kea.push())
+        # Same with a whole replacement of subnets
+        self.kea.auto_commit = False
+        self.kea.del_all_subnets()
+        self._set_std_subnet()
+        self._set_std_pool()
+        self._set_std_resa()
+        self.kea.commit()
+        self.assertIsNone(self.kea.push())
+        cmds = [c.args[0] for c in self.req.call_args_list]
+        self.assertNotIn('config-set', cmds)
+        self.assertNotIn('config-write', cmds)
+        # A real change is still pushed
+        self.kea.del_pool(250)
+        self.kea.commit()
+        self.assertIs(self.kea.push(), True)
+        self.assertEqual(self.srv_conf['Dhcp4']['subnet4'][0]['pools'], [])
+
+    def test_48_prune(self):
+        self.srv_conf['Dhcp4']['subnet4'] = [
+            {'subnet': '10.0.0.0/8'},
+            {'id': 100, 'subnet': '192.168.0.0/24', 'reservations': [{
+                'ip-address': '192.168.0.9',
+                'hw-address': '11:11:11:11:11:11'}]}]
+        self.kea.pull()
+        self.kea.del_subnets_except([100])
+        self._set_std_resa()
+        self._set_std_pool()
+        self.kea.prune_subnet(100, [200], [])
+        subnets = self.kea.conf['subnet4']
+        self.assertEqual([s['subnet'] for s in subnets], ['192.168.0.0/24'])
+        self.assertEqual([r['user-context']['netbox_ip_address_id']
+                          for r in subnets[0]['reservations']], [200])
+        self.assertEqual(subnets[0]['pools'], [])
+        with self.assertRaises(SubnetNotFound):
+            self.kea.prune_subnet(101, [], [])
+
+    def _sent_commands(self):
+        return [c.args[0] for c in self.req.call_args_list
+                if c.args[0] not in ('config-test', 'list-commands')]
+
+    def test_50_fine_grained_push(self):
+        self.kea.fine_grained = True
+        self.srv_commands += ['subnet4-add', 'subnet4-update', 'subnet4-del',
+                              'reservation-add', 'reservation-del']
+        self._set_std_subnet()
+        self._set_std_resa()
+        self.kea.push()
+        # Reservations are sent with host commands, after their subnet
+        self.assertEqual(self._sent_commands(),
+                         ['subnet4-add', 'reservation-add', 'config-write'])
+        subnet = self.kea.conf['subnet4'][0]
+        self.req.assert_any_call('subnet4-add', {'subnet4': [
+            {k: v for k, v in subnet.items() if k != 'reservations'}]})
+        self.req.assert_any_call('reservation-add', {
+            'reservation': dict(subnet['reservations'][0], **{
+                'subnet-id': 100}), 'operation-target': 'memory'})
+
+        self.req.reset_mock()
+        self.kea.set_reservation(100, 200, {
+            'ip-address': '192.168.0.2', 'hw-address': '11:22:33:44:55:66'})
+        self.kea.push()
+        self.assertEqual(self._sent_commands(), [
+            'reservation-del', 'reservation-add', 'config-write'])
+        self.req.assert_any_call('reservation-del', {
+            'subnet-id': 100, 'ip-address': '192.168.0.1',
+            'operation-target': 'memory'})
+
+        # Subnet update keeps reservations, which are not sent
+        self.req.reset_mock()
+        self.kea.update_subnet(100, {'subnet': '192.168.0.0/24', 'opt': 1})
+        self.kea.push()
+        self.assertEqual(
+            self._sent_commands(), ['subnet4-update', 'config-write'])
+        update, = [c.args[1] for c in self.req.call_args_list
+                   if c.args[0] == 'subnet4-update']
+        self.assertNotIn('reservations', update['subnet4'][0])
+
+        self.req.reset_mock()
+        self._set_std_pool()
+        self.kea.del_subnet(100)
+        self.kea.set_subnet(101, {'subnet': '10.0.0.0/8'})
+        self.kea.update_subnet(101, {'subnet': '10.0.0.0/8', 'opt': 1})
+        self.kea.push()
+        self.assertEqual(self._sent_commands(), [
+            'reservation-del', 'subnet4-del', 'subnet4-add', 'config-write'])
+
+    def test_51_fine_grained_unsupported(self):
+        self.kea.fine_grained = True
+        self._set_std_subnet()
+        self.kea.push()
+        self.assertEqual(self._sent_commands(), ['config-set', 'config-write'])
+
+    def test_52_fine_grained_fallback(self):
+        self.kea.fine_grained = True
+        self.srv_commands += ['subnet4-add']
+        req_result = self.req.side_effect
+
+        def reject_subnet_add(cmd, params=None):
+            if cmd == 'subnet4-add':
+                raise KeaCmdError('rejected')
+            return req_result(cmd, params)
+
+        self.req.side_effect = reject_subnet_add
+        self._set_std_subnet()
+        self.kea.push()
+        self.assertEqual(self._sent_commands(), [
+            'subnet4-add', 'config-set', 'config-write'])
+        self.assertEqual(len(self.srv_conf['Dhcp4']['subnet4']), 1)
+
+    def test_53_fine_grained_reservations_unsupported(self):
+        self.kea.fine_grained = True
+        self.srv_commands += ['subnet4-add', 'reservation-add',
+                              'reservation-del']
+        req_result = self.req.side_effect
+
+        def reject_resa_add(cmd, params=None):
+            if cmd == 'reservation-add':
+                raise KeaCmdError('unknown argument operation-target')
+            return req_result(cmd, params)
+
+        self._set_std_subnet()
+        self.kea.push()
+        self.req.side_effect = reject_resa_add
+        self._set_std_resa()
+        self.kea.push()
+        # Reservation commands are not tried again
+        self.req.reset_mock()
+        self._set_std_pool()
+        self.kea.set_reservation(100, 200, {
+            'ip-address': '192.168.0.2', 'hw-address': '11:22:33:44:55:66'})
+        self.kea.push()
+        self.assertEqual(self._sent_commands(), ['config-set', 'config-write'])
+
+    def _pulls(self):
+        return [c for c in self.req.call_args_list
+                if c.args[0] == 'config-get']
+
+    def test_54_fine_grained_server_defaults(self):
+        self.kea.fine_grained = True
+        self.srv_commands += ['subnet4-add', 'subnet4-update', 'subnet4-del',
+                              'reservation-add', 'reservation-del']
+        self._set_std_subnet()
+        self._set_std_resa()
+        self.kea.push()
+        # Kea fills in default values of subnets and items
+        self.srv_conf = {'Dhcp4': deepcopy(self.kea.conf)}
+        subnet = self.srv_conf['Dhcp4']['subnet4'][0]
+        subnet['valid-lifetime'] = 4000
+        subnet['reservations'][0]['option-data'] = []
+        self.kea.pull()
+        self.req.reset_mock()
+        # Only the changed reservation is sent
+        self.kea.del_all_subnets()
+        self._set_std_subnet()
+        self.kea.set_reservation(100, 200, {
+            'ip-address': '192.168.0.1', 'hw-address': '11:22:33:44:55:66',
+            'hostname': 'pc2.lan'})
+        self.kea.push()
+        self.assertEqual(self._sent_commands(), [
+            'reservation-del', 'reservation-add', 'config-write'])
+
+    def test_55_refresh_skips_unchanged_config(self):
+        self.srv_hash = True
+        self.kea.pull()
+        self.req.reset_mock()
+        self.kea.refresh()
+        self.assertEqual(self._pulls(), [])
+        # Out of band change
+        self.srv_conf['Dhcp4']['subnet4'] = [{'subnet': '10.0.0.0/8'}]
+        self.kea.refresh()
+        self.assertEqual(len(self._pulls()), 1)
+        self.assertEqual(len(self.kea.conf['subnet4']), 1)
+
+    def test_56_refresh_after_push(self):
+        self.srv_hash = True
+        self.kea.pull()
+        self._set_std_subnet()
+        self.kea.auto_commit = False
+        self._set_std_resa()
+        # Uncommitted changes are dropped
+        self.kea.refresh()
+        self.assertEqual(len(self.kea.conf['subnet4']), 0)
+        self._set_std_subnet()
+        self.kea.commit()
+        self.kea.push()
+        self.req.reset_mock()
+        self.kea.refresh()
+        self.assertEqual(self._pulls(), [])
+        self.assertEqual(len(self.kea.conf['subnet4']), 1)
+
+    def test_57_refresh_without_hash(self):
+        self.kea.refresh()
+        self.assertEqual(len(self._pulls()), 1)
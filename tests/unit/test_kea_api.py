@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from netboxkea.kea import api
+from netboxkea.kea.exceptions import KeaCmdError, KeaServerError
+
+CONF = {'Dhcp4': {'subnet4': [{'id': 100, 'subnet': '192.168.0.0/24',
+                               'option-data': [{'data': 'é'}]}]}}
+
+
+class TestDHCP4API(unittest.TestCase):
+
+    def setUp(self):
+        self.api = api.DHCP4API('http://keasrv/api')
+        self.api.session = MagicMock()
+        self.resp = self.api.session.post.return_value
+        self.resp.content = b'[{"result": 0, "arguments": {"a": 1}}]'
+
+    def _check_request(self):
+        self.assertEqual(self.api.raise_conf_error(CONF['Dhcp4']), None)
+        _, kwargs = self.api.session.post.call_args
+        self.assertEqual(kwargs['headers'],
+                         {'Content-Type': 'application/json'})
+        self.assertNotIn(b' ', kwargs['data'])
+        self.assertEqual(json.loads(kwargs['data']), {
+            'command': 'config-test', 'service': ['dhcp4'],
+            'arguments': CONF})
+        self.assertEqual(self.api.list_commands(), {'a': 1})
+
+    def test_01_request(self):
+        self._check_request()
+
+    def test_02_request_without_orjson(self):
+        with patch.object(api, 'orjson', None):
+            self._check_request()
+
+    def test_03_errors(self):
+        self.resp.content = b'[{"result": 1, "text": "bad"}]'
+        with self.assertRaises(KeaCmdError):
+            self.api.write_conf()
+        self.resp.content = b'<html>'
+        with self.assertRaises(KeaServerError):
+            self.api.write_conf()
+        self.resp.raise_for_status.side_effect = requests.HTTPError()
+        with self.assertRaises(KeaServerError):
+            self.api.write_conf()
+
+    def test_04_host_commands(self):
+        self.resp.content = b'[{"result": 0}]'
+        self.api.add_reservation(100, {'ip-address': '192.168.0.1'})
+        self.assertEqual(json.loads(self.api.session.post.call_args.kwargs[
+            'data'])['arguments'], {
+                'reservation': {'ip-address': '192.168.0.1', 'subnet-id': 100},
+                'operation-target': 'memory'})
+        self.api.del_reservation(100, '192.168.0.1')
+        self.assertEqual(json.loads(self.api.session.post.call_args.kwargs[
+            'data'])['arguments'], {
+                'subnet-id': 100, 'ip-address': '192.168.0.1',
+                'operation-target': 'memory'})
+
+
+class TestFileAPI(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _check_write(self):
+        fileapi = api.FileAPI(self.path)
+        self.assertEqual(fileapi.get_conf(), {})
+        fileapi.set_conf(CONF['Dhcp4'])
+        fileapi.write_conf()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.assertNotIn(b'\n', data)
+        self.assertEqual(json.loads(data), CONF)
+        self.assertEqual(api.FileAPI(self.path).get_conf(), CONF['Dhcp4'])
+
+    def test_01_write(self):
+        self._check_write()
+
+    def test_02_write_without_orjson(self):
+        with patch.object(api, 'orjson', None):
+            self._check_write()
@@ -0,0 +1,91 @@
+import io
+import json
+import threading
+import unittest
+from unittest.mock import Mock, patch
+from urllib.request import urlopen
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+
+from netboxkea.listener import ThreadingWSGIServer, WebhookListener
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class TestThreadingWSGIServer(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+
+        def app(environ, start_response):
+            if environ['PATH_INFO'] == '/slow/':
+                self.release.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'ok']
+
+        self.srv = make_server(
+            '127.0.0.1', 0, app, ThreadingWSGIServer, QuietHandler)
+        self.url = f'http://127.0.0.1:{self.srv.server_port}'
+        self.thread = threading.Thread(target=self.srv.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.srv.shutdown()
+        self.thread.join()
+        self.srv.server_close()
+
+    def test_01_slow_request_does_not_block(self):
+        slow = threading.Thread(target=lambda: urlopen(f'{self.url}/slow/'))
+        slow.start()
+        with urlopen(f'{self.url}/health/', timeout=2) as resp:
+            self.assertEqual(resp.read(), b'ok')
+        self.release.set()
+        slow.join()
+
+
+class TestWebhookListener(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = WebhookListener(
+            Mock(spec=['sync_ipaddress']), secret='s3cr3t',
+            secret_header='X-Secret')
+        self.listener.queue = Mock()
+        # Define routes without starting the web server
+        with patch.object(bottle, 'run'):
+            self.listener.run()
+
+    def post(self, path, body, secret='s3cr3t'):
+        data = json.dumps(body).encode()
+        environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': path,
+                   'CONTENT_TYPE': 'application/json',
+                   'CONTENT_LENGTH': str(len(data)),
+                   'HTTP_X_SECRET': secret, 'wsgi.input': io.BytesIO(data)}
+        setup_testing_defaults(environ)
+        status = []
+        bottle.default_app()(environ, lambda s, h: status.append(s))
+        return int(status[0].split()[0])
+
+    def test_01_event_queued(self):
+        status = self.post('/event/ipaddress/', {
+            'model': 'ipaddress', 'event': 'updated', 'data': {'id': 5}})
+        self.assertEqual(status, 202)
+        self.listener.queue.put.assert_called_once_with('ipaddress', 5)
+        self.listener.queue.start.assert_called_once()
+        self.listener.queue.stop.assert_called_once()
+
+    def test_02_rejected_events(self):
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.post('/event/x/', {}, secret='bad'), 403)
+            self.assertEqual(self.post('/event/x/', {'model': 'x'}), 400)
+            # Other sync methods of the connector are not events
+            for model in ('all', 'changes', 'events'):
+                self.assertEqual(self.post(f'/event/{model}/', {
+                    'model': model, 'event': 'updated', 'data': {'id': 1}}),
+                    400)
+        self.listener.queue.put.assert_not_called()
@@ -0,0 +1,114 @@
+import unittest
+from types import SimpleNamespace as NS
+from unittest.mock import Mock
+
+import requests
+
+from netboxkea.netbox import NetboxApp
+from ..fixtures.pynetbox import ip_addresses as fixtip
+from ..fixtures.pynetbox import ip_ranges as fixtr
+from ..fixtures.pynetbox import prefixes as fixtp
+
+
+class TestNetboxApp(unittest.TestCase):
+
+    def setUp(self):
+        self.nbapp = NetboxApp(
+            'http://netbox', 'token', prefix_filter={'cf_dhcp_enabled': True},
+            iprange_filter={'status': 'dhcp'})
+        self.nbapp.nb = Mock()
+        self.ipam = self.nbapp.nb.ipam
+        self.ipam.prefixes.filter.return_value = iter(
+            [fixtp.prefix_100, fixtp.prefix_101, fixtp.prefix_102])
+        self.ipam.ip_addresses.filter.return_value = iter(fixtip.ALL_IP)
+        self.ipam.ip_ranges.filter.return_value = iter([fixtr.ip_range_250])
+
+    def test_01_all_prefixes_with_children(self):
+        res = {p.id: (i, r) for p, i, r in
+               self.nbapp.all_prefixes_with_children()}
+        self.assertEqual(res, {
+            100: ([fixtip.ip_address_200, fixtip.ip_address_201,
+                   fixtip.ip_address_202], [fixtr.ip_range_250]),
+            101: ([fixtip.ip_address_250], []),
+            102: ([fixtip.ip_address_250], [])})
+        # One query per object type
+        self.ipam.prefixes.filter.assert_called_once_with(
+            cf_dhcp_enabled=True)
+        self.ipam.ip_addresses.filter.assert_called_once_with(status='dhcp')
+        self.ipam.ip_ranges.filter.assert_called_once_with(status='dhcp')
+
+    def test_02_prefetch_assigned_objects(self):
+        full_if = NS(id=300, mac_address='11:11:11:11:11:11', device=NS(id=1))
+        full_dev = NS(id=1, serial='ABC')
+        self.nbapp.nb.dcim.interfaces.filter.return_value = [full_if]
+        self.nbapp.nb.dcim.devices.filter.return_value = [full_dev]
+        ipaddrs = [NS(id=i, assigned_object_type='dcim.interface',
+                      assigned_object=NS(id=300, device=NS(id=1)))
+                   for i in (200, 202)]
+        ipaddrs.append(NS(id=201, assigned_object_type=None,
+                          assigned_object=None))
+        cache = {}
+        res = self.nbapp.prefetch_assigned_objects(
+            iter(ipaddrs), {'assigned_object', 'assigned_object.device'},
+            cache)
+        self.assertEqual(res, ipaddrs)
+        self.assertIs(ipaddrs[0].assigned_object, full_if)
+        self.assertIs(ipaddrs[1].assigned_object, full_if)
+        self.assertIs(full_if.device, full_dev)
+        self.nbapp.nb.dcim.interfaces.filter.assert_called_once_with(
+            id=[300])
+        self.nbapp.nb.dcim.devices.filter.assert_called_once_with(id=[1])
+        # Cached objects are not fetched again
+        self.nbapp.prefetch_assigned_objects(
+            ipaddrs[:1], {'assigned_object'}, cache)
+        self.nbapp.nb.dcim.interfaces.filter.assert_called_once()
+
+    def test_03_changes_since(self):
+        since = '2023-01-01T12:00:00.000000Z'
+        # Range 251 is out of the filters
+        out = NS(id=251)
+        self.ipam.ip_ranges.filter.side_effect = lambda **kw: iter(
+            [fixtr.ip_range_250] if 'status' in kw
+            else [fixtr.ip_range_250, out])
+        self.assertEqual(list(self.nbapp.updated_since('iprange', since)),
+                         [(250, fixtr.ip_range_250), (251, None)])
+        self.ipam.ip_ranges.filter.assert_any_call(last_updated__gte=since)
+        self.ipam.ip_ranges.filter.assert_any_call(
+            last_updated__gte=since, status='dhcp')
+        # Without filters, objects are fetched once
+        self.nbapp.prefix_filter = {}
+        self.ipam.prefixes.filter.reset_mock()
+        self.assertEqual(len(list(self.nbapp.updated_since('prefix', since))),
+                         3)
+        self.ipam.prefixes.filter.assert_called_once_with(
+            last_updated__gte=since)
+        # Change log of netbox < 4.1, in extras app
+        core, extras = self.nbapp.nb.core, self.nbapp.nb.extras
+        core.object_changes.filter.side_effect = requests.HTTPError(
+            response=Mock(status_code=404))
+        extras.object_changes.filter.side_effect = lambda **kw: iter(
+            [NS(changed_object_id=200, time='2023-01-02T08:00:00.000000Z')]
+            if kw['changed_object_type'] == 'ipam.ipaddress' else [])
+        self.assertEqual(list(self.nbapp.deleted_since(since)), [
+            ('ipaddress', 200, '2023-01-02T08:00:00.000000Z')])
+        extras.object_changes.filter.assert_any_call(
+            changed_object_type='ipam.prefix', action='delete',
+            time_after=since)
+        core.object_changes.filter.assert_called_once()
+        # Other errors are raised
+        self.nbapp._changelog = None
+        core.object_changes.filter.side_effect = requests.HTTPError(
+            response=Mock(status_code=500))
+        with self.assertRaises(requests.HTTPError):
+            list(self.nbapp.deleted_since(since))
+
+    def test_04_last_change_time(self):
+        changes = self.nbapp.nb.core.object_changes
+        changes.filter.return_value = iter(
+            [NS(time='2023-01-02T08:00:00.000000Z')])
+        self.assertEqual(
+            self.nbapp.last_change_time(), '2023-01-02T08:00:00.000000Z')
+        changes.filter.assert_called_once_with(
+            ordering='-time', limit=1, offset=0)
+        changes.filter.return_value = iter([])
+        self.assertIsNone(self.nbapp.last_change_time())
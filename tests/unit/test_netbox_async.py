@@ -0,0 +1,85 @@
+import asyncio
+import unittest
+
+from netboxkea.netbox import NetboxApp
+from netboxkea.netbox_async import AsyncNetboxAPI
+from netboxkea.record import Record
+
+
+class FakeNetboxAPI(AsyncNetboxAPI):
+    """ Serve objects from memory, at most 10 objects per page """
+
+    def __init__(self, objects, **kwargs):
+        self.objects = objects
+        self.requests = []
+        self.in_flight = self.max_in_flight = 0
+        super().__init__('http://netbox/', 'token', **kwargs)
+
+    def _mk_client(self):
+        return None
+
+    async def _request(self, path, params):
+        self.requests.append((path, params))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        objs = [o for o in self.objects.get(path, []) if all(
+            o.get(k) == v for k, v in params.items()
+            if k not in ('limit', 'offset'))]
+        offset, limit = params['offset'], min(params['limit'], 10)
+        return {'count': len(objs), 'results': objs[offset:offset + limit]}
+
+
+class TestAsyncNetboxAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.ipaddrs = [{
+            'id': n, 'address': f'192.168.0.{n}/24', 'display': 'ip',
+            'status': 'dhcp', 'custom_fields': {'hw': None},
+            'assigned_object': {'id': 300, 'name': 'eth0'}}
+            for n in range(1, 46)]
+        self.api = FakeNetboxAPI(
+            {'ipam/ip-addresses/': self.ipaddrs}, concurrency=2)
+
+    def tearDown(self):
+        self.api.close()
+
+    def test_01_filter_pages(self):
+        res = self.api.ipam.ip_addresses.filter(status='dhcp')
+        self.assertEqual([i.id for i in res], list(range(1, 46)))
+        # Pages are fetched concurrently, within the concurrency limit
+        self.assertEqual(
+            [p['offset'] for _, p in self.api.requests], [0, 10, 20, 30, 40])
+        self.assertEqual(self.api.max_in_flight, 2)
+        # Only one page is fetched with an offset
+        self.api.requests.clear()
+        res = self.api.ipam.ip_addresses.filter(limit=1, offset=5)
+        self.assertEqual([i.id for i in res], [6])
+        self.assertEqual(len(self.api.requests), 1)
+
+    def test_02_records(self):
+        ip = self.api.ipam.ip_addresses.get(id=1)
+        self.assertIsInstance(ip.assigned_object, Record)
+        self.assertEqual(ip.assigned_object.name, 'eth0')
+        self.assertEqual(ip.custom_fields, {'hw': None})
+        self.assertEqual(str(ip), 'ip')
+        self.assertIsNone(self.api.ipam.ip_addresses.get(id=99))
+        self.assertEqual(self.api.dcim.devices.all(), [])
+
+    def test_03_duplicates(self):
+        # An object is inserted after the first page is served
+        async def insert(path, params, request=self.api._request):
+            if params['offset'] == 10:
+                self.ipaddrs.insert(0, dict(self.ipaddrs[0], id=0))
+            return await request(path, params)
+        self.api._request = insert
+        res = self.api.ipam.ip_addresses.all()
+        self.assertEqual(len(res), len({i.id for i in res}))
+
+    def test_04_netbox_app(self):
+        nbapp = NetboxApp('http://netbox', 'token')
+        nbapp.nb = self.api
+        self.assertEqual(nbapp.ip_address(3).address, '192.168.0.3/24')
+        with self.assertRaises(ValueError):
+            NetboxApp('http://netbox', 'token', backend='unknown')
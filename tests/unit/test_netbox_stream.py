@@ -0,0 +1,108 @@
+import unittest
+from unittest.mock import Mock
+
+from netboxkea.connector import Connector, netbox_fields
+from netboxkea.netbox import NetboxApp
+from netboxkea.netbox_stream import StreamNetboxAPI
+from netboxkea.record import Record
+
+
+class FakeNetboxAPI(StreamNetboxAPI):
+    """ Serve objects from memory, at most 10 objects per page """
+
+    def __init__(self, objects, **kwargs):
+        self.objects = objects
+        self.requests = []
+        super().__init__('http://netbox/', 'token', **kwargs)
+
+    def _request(self, path, params):
+        self.requests.append((path, params))
+        objs = [o for o in self.objects.get(path, []) if all(
+            o.get(k) in v if isinstance(v, list) else o.get(k) == v
+            for k, v in params.items()
+            if k not in ('limit', 'offset', 'fields'))]
+        if 'fields' in params:
+            objs = [{k: v for k, v in o.items()
+                     if k in params['fields'].split(',')} for o in objs]
+        offset, limit = params['offset'], min(params['limit'], 10)
+        return {'count': len(objs), 'results': objs[offset:offset + limit]}
+
+
+class TestStreamNetboxAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.ipaddrs = [{
+            'id': n, 'address': f'192.168.0.{n}/24', 'display': 'ip',
+            'status': 'dhcp', 'description': 'x' * 100,
+            'assigned_object': {'id': 300, 'name': 'eth0'}}
+            for n in range(1, 26)]
+        self.api = FakeNetboxAPI(
+            {'ipam/ip-addresses/': self.ipaddrs},
+            fields={'ipam.ip_addresses': {'id', 'address', 'display',
+                                          'assigned_object'}})
+
+    def test_01_filter_pages(self):
+        res = self.api.ipam.ip_addresses.filter(status='dhcp')
+        # Pages are only fetched while records are consumed
+        self.assertEqual(next(res).id, 1)
+        self.assertEqual(len(self.api.requests), 1)
+        self.assertEqual([i.id for i in res], list(range(2, 26)))
+        self.assertEqual(
+            [p['offset'] for _, p in self.api.requests], [0, 10, 20])
+        self.assertEqual(self.api.requests[0][1]['fields'],
+                         'address,assigned_object,display,id')
+        # Only one page is fetched with an offset
+        self.api.requests.clear()
+        res = self.api.ipam.ip_addresses.filter(limit=1, offset=5)
+        self.assertEqual([i.id for i in res], [6])
+        self.assertEqual(len(self.api.requests), 1)
+
+    def test_02_slim_records(self):
+        ip = self.api.ipam.ip_addresses.get(id=1)
+        self.assertIsInstance(ip.assigned_object, Record)
+        self.assertEqual(ip.assigned_object.name, 'eth0')
+        self.assertFalse(hasattr(ip, 'description'))
+        self.assertEqual(str(ip), 'ip')
+        self.assertIsNone(self.api.ipam.ip_addresses.get(id=99))
+        # Endpoints without fields get all of them
+        self.assertEqual(list(self.api.dcim.devices.all()), [])
+        self.assertNotIn('fields', self.api.requests[-1][1])
+
+    def test_03_duplicates(self):
+        # An object is inserted after the first page is served
+        def insert(path, params, request=self.api._request):
+            if params['offset'] == 10:
+                self.ipaddrs.insert(0, dict(self.ipaddrs[0], id=0))
+            return request(path, params)
+        self.api._request = insert
+        res = list(self.api.ipam.ip_addresses.all())
+        self.assertEqual(len(res), len({i.id for i in res}))
+
+    def test_04_netbox_app(self):
+        nbapp = NetboxApp('http://netbox', 'token', backend='stream')
+        nbapp.nb = self.api
+        self.assertEqual(nbapp.ip_address(3).address, '192.168.0.3/24')
+        self.assertEqual(
+            len(list(nbapp.ip_addresses(address='192.168.0.4/24'))), 1)
+
+    def test_05_sync_ip_address_event(self):
+        # Interfaces assigned to IP addresses are only nested records
+        for i in self.ipaddrs:
+            i.update(assigned_object_type='dcim.interface', dns_name='pc')
+        resa_map = {'hw-address': 'assigned_object.mac_address',
+                    'hostname': 'dns_name'}
+        nbapp = NetboxApp('http://netbox', 'token', backend='stream',
+                          ipaddress_filter={})
+        nbapp.nb = FakeNetboxAPI({
+            'ipam/ip-addresses/': self.ipaddrs,
+            'ipam/prefixes/': [{'id': 100, 'prefix': '192.168.0.0/24'}],
+            'dcim/interfaces/': [{'id': 300, 'name': 'eth0',
+                                  'mac_address': '11:11:11:11:11:11'}]},
+            fields=netbox_fields({}, {}, resa_map))
+        kea = Mock()
+        conn = Connector(nbapp, kea, {}, {}, resa_map)
+        conn.sync_ipaddress(3)
+        kea.set_reservation.assert_called_once_with(100, 3, {
+            'ip-address': '192.168.0.3', 'hw-address': '11:11:11:11:11:11',
+            'hostname': 'pc'})
+        kea.del_resa.assert_not_called()
@@ -0,0 +1,49 @@
+import threading
+import unittest
+from time import monotonic
+from unittest.mock import Mock
+
+from netboxkea.connector import SyncTimeout
+from netboxkea.scheduler import Job, SyncScheduler
+
+
+class TestSyncScheduler(unittest.TestCase):
+
+    def test_01_periodic_runs(self):
+        calls, done = [], threading.Event()
+
+        def sync(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 3:
+                done.set()
+            return True
+
+        idle = Mock()
+        scheduler = SyncScheduler([Job('full', sync, 0.01, budget=60),
+                                   Job('incremental', idle, 3600)])
+        scheduler.start()
+        self.assertTrue(done.wait(5))
+        scheduler.stop()
+        self.assertEqual(calls[0], {'blocking': False, 'budget': 60})
+        idle.assert_not_called()
+
+    def test_02_jitter(self):
+        job = Job('full', Mock(), 10, jitter=5)
+        for _ in range(20):
+            start = monotonic()
+            job.schedule()
+            self.assertGreaterEqual(job.next_run, start + 10)
+            self.assertLessEqual(job.next_run, monotonic() + 15)
+
+    def test_03_failed_runs(self):
+        scheduler = SyncScheduler([])
+        with self.assertLogs(level='WARNING') as logs:
+            scheduler._run_job(Job('full', Mock(return_value=False), 1))
+            scheduler._run_job(
+                Job('full', Mock(side_effect=SyncTimeout()), 1, budget=2))
+            scheduler._run_job(Job('full', Mock(side_effect=OSError()), 1))
+        self.assertIn('full sync skipped', logs.output[0])
+        self.assertIn('lasted more than 2 s', logs.output[1])
+        self.assertIn('full sync failed', logs.output[2])
+        # Scheduler without job returns at once
+        scheduler.run()
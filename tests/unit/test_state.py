@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+from netboxkea.state import ObjectState, StateStore
+
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.state = StateStore(self.path)
+
+    def tearDown(self):
+        self.state.close()
+        os.unlink(self.path)
+
+    def test_01_update(self):
+        resa = ObjectState([100], {'ip-address': '192.168.0.1'}, 'h1',
+                           '2023-01-01T12:00:00Z')
+        subnet = ObjectState([100], {'subnet': '192.168.0.0/24'}, None, None)
+        self.state.update({('ipaddress', 200): resa, ('prefix', 100): subnet})
+        self.assertEqual(len(self.state), 2)
+        self.assertEqual(self.state.get('ipaddress', 200), resa)
+        self.assertIsNone(self.state.get('iprange', 200))
+        self.state.update({('prefix', 100): None, ('prefix', 101): None})
+        self.assertIsNone(self.state.get('prefix', 100))
+        self.assertEqual(len(self.state), 1)
+
+    def test_02_persistence(self):
+        resa = ObjectState([100, 101], {'ip-address': '10.0.0.1'}, 'h', None)
+        self.state.update({('ipaddress', 201): resa})
+        self.state.set_meta('watermark', '2023-01-01T12:00:00Z')
+        self.state.close()
+        self.state = StateStore(self.path)
+        self.assertEqual(self.state.get('ipaddress', 201), resa)
+        self.assertEqual(
+            self.state.get_meta('watermark'), '2023-01-01T12:00:00Z')
+        self.assertIsNone(self.state.get_meta('unknown'))